@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2019 Lukas Brunner, ETH Zurich
+
+This file is part of ClimWIP.
+
+ClimWIP is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Authors
+-------
+- Lukas Brunner || lukas.brunner@env.ethz.ch
+
+Abstract
+--------
+Create or refresh the catalog of the model archives given in a configuration
+(model_path and model_id). The catalog is written to the path given by the
+catalog parameter. The archives are scanned in parallel and running it again
+only lists directories and reads files which changed since the last run.
+
+Example: python build_catalog.py DEFAULT -f configs/config.ini
+"""
+import os
+import argparse
+import logging
+
+from core import utils
+from core.scan_archive import index_archive
+
+logger = logging.getLogger(__name__)
+
+
+def read_args():
+    """Read the given configuration from the config file"""
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        dest='config', nargs='?', default='DEFAULT',
+        help='Name of the configuration to use (optional).')
+    parser.add_argument(
+        '--filename', '-f', dest='filename', default='configs/config.ini',
+        help='Relative or absolute path/filename.ini of the config file.')
+    parser.add_argument(
+        '--catalog', '-c', dest='catalog', default=None,
+        help='Path of the catalog (overwrites the catalog parameter).')
+    parser.add_argument(
+        '--no-time', dest='read_time', action='store_false',
+        help='Do not open the files to read their time coverage (faster).')
+    parser.add_argument(
+        '--workers', '-w', dest='max_workers', default=16, type=int,
+        help='Number of threads used to scan the archive.')
+    return parser.parse_args()
+
+
+def main(args):
+    cfg = utils.read_config(args.config, args.filename)
+    catalog = args.catalog if args.catalog is not None else cfg.get('catalog')
+    if catalog is None:
+        raise ValueError('No catalog given, set the catalog parameter or use --catalog')
+
+    model_paths, model_ids = cfg.model_path, cfg.model_id
+    if not isinstance(model_paths, list):
+        model_paths, model_ids = [model_paths], [model_ids]
+
+    for base_path, id_ in zip(model_paths, model_ids):
+        with utils.LogTime(f'Index {id_} archive {base_path}'):
+            index_archive(catalog, id_, base_path,
+                          read_time=args.read_time, max_workers=args.max_workers)
+
+
+if __name__ == '__main__':
+    args = read_args()
+    utils.set_logger()
+    with utils.LogTime(os.path.basename(__file__).replace('py', 'main()')):
+        main(args)
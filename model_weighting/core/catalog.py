@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2019 Lukas Brunner, ETH Zurich
+
+This file is part of ClimWIP.
+
+ClimWIP is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Authors
+-------
+- Lukas Brunner || lukas.brunner@env.ethz.ch
+
+Abstract
+--------
+A persistent SQLite index of the model archive. Each file is stored with its
+variable, model, member, scenario, project (model_id), size, modification
+time, and time coverage so that get_filenames can look up files without
+scanning the archive. The index is updated incrementally: only new or
+changed files are (re-)read and deleted files are removed.
+"""
+import os
+import sqlite3
+import logging
+import xarray as xr
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    base_path TEXT NOT NULL,
+    project TEXT NOT NULL,
+    varn TEXT NOT NULL,
+    model TEXT NOT NULL,
+    member TEXT NOT NULL,
+    scenario TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    time_start TEXT,
+    time_end TEXT
+);
+CREATE INDEX IF NOT EXISTS files_query
+    ON files (base_path, project, varn, scenario);
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    base_path TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    subdirs TEXT NOT NULL,
+    files TEXT NOT NULL
+);
+"""
+
+
+def connect(catalog):
+    """Open (and if necessary create) the catalog at the given path."""
+    con = sqlite3.connect(catalog)
+    con.executescript(SCHEMA)
+    return con
+
+
+def parse_filename(filename):
+    """Split a filename of form <varn>_mon_<model>_<scenario>_<member>_g025.nc.
+
+    Returns
+    -------
+    varn, model, member, scenario : str
+    """
+    parts = os.path.basename(filename).split('_')
+    return parts[0], parts[2], parts[4], parts[3]
+
+
+def get_time_coverage(filename):
+    """Return the first and last time step of a file as 'yyyy-mm' strings."""
+    try:
+        with xr.open_dataset(filename, use_cftime=True) as ds:
+            time = ds['time'].data
+            return time[0].strftime('%Y-%m'), time[-1].strftime('%Y-%m')
+    except (OSError, KeyError, ValueError, AttributeError, IndexError):
+        logger.warning(f'Could not read time coverage of {filename}')
+        return None, None
+
+
+def update_catalog(catalog, filenames, base_path, id_, read_time=True, stats=None):
+    """
+    Incrementally update the catalog entries of one archive.
+
+    Parameters
+    ----------
+    catalog : str
+        Path of the SQLite catalog file (will be created if it does not exist).
+    filenames : list of str
+        All files currently in the archive (e.g., from a glob).
+    base_path : str
+        Base path of the archive (see model_path in the configuration).
+    id_ : {'CMIP6', 'CMIP5', 'CMIP3', 'LE'}
+    read_time : bool, optional
+        If True open each new or changed file to read its time coverage.
+    stats : dict, optional
+        Already known (size, mtime) of files, e.g., from a directory scan.
+        Files not in stats but already in the catalog are assumed to be
+        unchanged (see core.scan_archive). If None all files are checked.
+
+    Returns
+    -------
+    nr_new, nr_deleted : int
+        Number of added or updated and of deleted files.
+    """
+    base_path = os.path.normpath(base_path)
+    con = connect(catalog)
+    with con:
+        stored = {path: (size, mtime) for path, size, mtime in con.execute(
+            'SELECT path, size, mtime FROM files WHERE base_path=? AND project=?',
+            (base_path, id_))}
+
+        rows = []
+        for filename in filenames:
+            if stats is not None and filename in stats:
+                size, mtime = stats[filename]
+            elif stats is not None and filename in stored:
+                stored.pop(filename)
+                continue  # in an unchanged directory
+            else:
+                stat = os.stat(filename)
+                size, mtime = stat.st_size, stat.st_mtime
+            if stored.pop(filename, None) == (size, mtime):
+                continue  # unchanged
+            time_start, time_end = get_time_coverage(filename) if read_time else (None, None)
+            rows.append((filename, base_path, id_, *parse_filename(filename),
+                         size, mtime, time_start, time_end))
+        con.executemany(
+            'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        # everything left in stored is no longer in the archive
+        con.executemany('DELETE FROM files WHERE path=?', [(path,) for path in stored])
+    con.close()
+
+    logger.info(f'Catalog {catalog} ({id_}, {base_path}): {len(rows)} new or changed '
+                f'and {len(stored)} deleted files')
+    return len(rows), len(stored)
+
+
+def read_dir_cache(catalog, base_path):
+    """Return the cached directory listings of an archive.
+
+    Returns
+    -------
+    cache : dict
+        {path: (mtime, subdirs, files)} with subdirs and files being lists
+        of full paths.
+    """
+    if catalog is None or not os.path.isfile(catalog):
+        return {}
+    con = connect(catalog)
+    cache = {path: (mtime, subdirs.split('\n') if subdirs else [],
+                    files.split('\n') if files else [])
+             for path, mtime, subdirs, files in con.execute(
+                 'SELECT path, mtime, subdirs, files FROM dirs WHERE base_path=?',
+                 (os.path.normpath(base_path),))}
+    con.close()
+    return cache
+
+
+def write_dir_cache(catalog, base_path, cache):
+    """Replace the cached directory listings of an archive (see read_dir_cache)."""
+    base_path = os.path.normpath(base_path)
+    con = connect(catalog)
+    with con:
+        con.execute('DELETE FROM dirs WHERE base_path=?', (base_path,))
+        con.executemany(
+            'INSERT INTO dirs VALUES (?, ?, ?, ?, ?)',
+            [(path, base_path, mtime, '\n'.join(subdirs), '\n'.join(files))
+             for path, (mtime, subdirs, files) in cache.items()])
+    con.close()
+
+
+def is_indexed(catalog, base_path, id_):
+    """Check if the catalog contains entries for a given archive."""
+    if catalog is None or not os.path.isfile(catalog):
+        return False
+    con = connect(catalog)
+    row = con.execute(
+        'SELECT 1 FROM files WHERE base_path=? AND project=? LIMIT 1',
+        (os.path.normpath(base_path), id_)).fetchone()
+    con.close()
+    return row is not None
+
+
+def query_catalog(catalog, varn, id_, scenario, base_path):
+    """
+    Return all files of a given variable and scenario in a given archive.
+
+    Parameters
+    ----------
+    catalog : str
+        Path of the SQLite catalog file.
+    varn : str
+    id_ : {'CMIP6', 'CMIP5', 'CMIP3', 'LE'}
+    scenario : str
+    base_path : str
+
+    Returns
+    -------
+    filenames : list of str
+    """
+    con = connect(catalog)
+    filenames = [path for path, in con.execute(
+        'SELECT path FROM files WHERE base_path=? AND project=? AND varn=? AND scenario=?',
+        (os.path.normpath(base_path), id_, varn, scenario))]
+    con.close()
+    return filenames
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2019 Lukas Brunner, ETH Zurich
+
+This file is part of ClimWIP.
+
+ClimWIP is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Authors
+-------
+- Lukas Brunner || lukas.brunner@env.ethz.ch
+
+Abstract
+--------
+Stage-level checkpoints of the main script. The result of each stage is
+written to a run directory which is unique for the given configuration. If
+a run is restarted with resume=True completed stages are read from the run
+directory instead of being calculated again. Run directories of the same
+configuration with a different hash (i.e., left behind by runs of a
+previous version of the configuration) are removed after a successful run.
+"""
+import os
+import pickle
+import shutil
+import hashlib
+import logging
+
+from .utils import parameter_key
+
+logger = logging.getLogger(__name__)
+
+
+def config_hash(cfg):
+    """A short hash of all parameters of a configuration."""
+    parameters = {key: value for key, value in cfg.items() if key != 'config_path'}
+    return hashlib.sha1(parameter_key(parameters).encode()).hexdigest()[:12]
+
+
+class Checkpoint:
+    """
+    Checkpoint the results of the stages of one run.
+
+    Parameters
+    ----------
+    cfg : configuration object
+        See read_config() docstring for more information. The run directory
+        is <save_path>/checkpoints/<config>_<hash> (see config_hash).
+    resume : bool, optional
+        If True re-use the results of stages completed in a previous run.
+
+    Examples
+    --------
+    checkpoint = Checkpoint(cfg, resume=True)
+    filenames = checkpoint('filenames', get_filenames, cfg)
+    checkpoint.remove()  # after the run finished successfully
+    """
+
+    def __init__(self, cfg, resume=False):
+        self.resume = resume
+        self.config = cfg.config
+        self.run_dir = os.path.join(
+            cfg.save_path, 'checkpoints', f'{cfg.config}_{config_hash(cfg)}')
+        os.makedirs(self.run_dir, exist_ok=True)
+
+        stale_dirs = self.stale_dirs()
+        if len(stale_dirs) > 0:
+            logger.info(' '.join([
+                f'Found {len(stale_dirs)} checkpoint(s) of a previous version of',
+                f'configuration {cfg.config} which can not be resumed (removed',
+                f'after a successful run): {", ".join(stale_dirs)}']))
+
+    def stale_dirs(self):
+        """Run directories of the same configuration with a different hash."""
+        path, run_name = os.path.split(self.run_dir)
+        stale_dirs = []
+        for name in sorted(os.listdir(path)):
+            config, _, hash_ = name.rpartition('_')
+            if (config == self.config and name != run_name and len(hash_) == 12 and
+                    all(char in '0123456789abcdef' for char in hash_)):
+                stale_dirs.append(os.path.join(path, name))
+        return stale_dirs
+
+    def _filename(self, stage):
+        return os.path.join(self.run_dir, f'{stage}.pkl')
+
+    def done(self, *stages):
+        """Check if all given stages can be read from the run directory."""
+        return self.resume and all(
+            os.path.isfile(self._filename(stage)) for stage in stages)
+
+    def __call__(self, stage, func, *args, **kwargs):
+        """Return the checkpoint of stage if it exists, otherwise call
+        func(*args, **kwargs) and checkpoint its result."""
+        filename = self._filename(stage)
+        if self.done(stage):
+            logger.info(f'Resuming {stage} from {filename}')
+            with open(filename, 'rb') as ff:
+                return pickle.load(ff)
+
+        result = func(*args, **kwargs)
+        with open(f'{filename}.tmp', 'wb') as ff:
+            pickle.dump(result, ff, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{filename}.tmp', filename)  # never leave a partial file
+        return result
+
+    def remove(self):
+        """Delete the run directory and all stale run directories (see stale_dirs)."""
+        for run_dir in [self.run_dir, *self.stale_dirs()]:
+            shutil.rmtree(run_dir, ignore_errors=True)
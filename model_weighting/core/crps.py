@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2019 Lukas Brunner, ETH Zurich
+
+This file is part of ClimWIP.
+
+ClimWIP is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Authors
+-------
+- Lukas Brunner || lukas.brunner@env.ethz.ch
+
+Abstract
+--------
+A batched version of the (weighted) continuous ranked probability score
+(CRPS) of an ensemble. The ensemble is sorted once per cell and the CRPS is
+calculated for all cells and (pseudo) observations at once. The results are
+the same as properscoring.crps_ensemble (up to rounding errors).
+
+The CRPS of an ensemble x_k with normalized weights w_k and cumulative
+weights C_k (sorted in increasing order of x_k) and an observation y is
+
+    CRPS = sum_k w_k |x_k - y| - sum_k w_k (x_k - y) (2 C_k - w_k - 1)
+
+where the second term is 0.5 * E|X - X'| written in terms of the sorted
+ensemble (the same for all y).
+"""
+import numpy as np
+
+
+def sort_ensemble(forecasts, axis=-1):
+    """Sort the ensemble along the last axis (NaN values go to the end).
+
+    Parameters
+    ----------
+    forecasts : array_like, shape (..., N)
+    axis : int, optional
+        Ensemble axis of forecasts, will be moved to the end.
+
+    Returns
+    -------
+    sorted_forecasts, order : ndarray, shape (..., N)
+        The sorted forecasts and the indices which sort them.
+    """
+    forecasts = np.moveaxis(np.asarray(forecasts, dtype=float), axis, -1)
+    order = np.argsort(forecasts, axis=-1)
+    return np.take_along_axis(forecasts, order, axis=-1), order
+
+
+def crps_sorted(observations, forecasts, weights=None):
+    """CRPS of an ensemble which is already sorted along the last axis.
+
+    Parameters
+    ----------
+    observations : array_like, shape (...)
+    forecasts : array_like, shape (..., N)
+        Sorted forecasts (see sort_ensemble). NaN values have to be at the end.
+    weights : array_like, shape (..., N), optional
+        Weights in the order of the sorted forecasts. Need not be normalized.
+        Forecasts with NaN values get zero weight.
+
+    Returns
+    -------
+    crps : ndarray, shape (...)
+        All input shapes are broadcast against each other. NaN if the
+        observation is NaN or no forecast has a weight.
+    """
+    observations = np.asarray(observations, dtype=float)
+    forecasts = np.asarray(forecasts, dtype=float)
+    if weights is None:
+        weights = np.ones(forecasts.shape[-1])
+    weights = np.asarray(weights, dtype=float)
+    if np.any(weights < 0):
+        raise ValueError('weights must not be negative')
+
+    valid = ~np.isnan(forecasts)
+    weights = np.where(valid, weights, 0.)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weights = weights / weights.sum(axis=-1, keepdims=True)
+    cdf = np.cumsum(weights, axis=-1)
+
+    # shifting by the observation keeps the two terms small
+    diff = np.where(valid, forecasts, 0.) - observations[..., np.newaxis]
+    error = np.sum(weights * np.abs(diff), axis=-1)
+    spread = np.sum(weights * diff * (2 * cdf - weights - 1), axis=-1)
+    return error - spread
+
+
+def crps_ensemble(observations, forecasts, weights=None, axis=-1):
+    """Same as properscoring.crps_ensemble but vectorized over all cells.
+
+    Parameters
+    ----------
+    observations : array_like, shape (...)
+    forecasts : array_like, shape (..., N)
+    weights : array_like, shape (..., N) or (N,), optional
+        Same shape as forecasts or broadcastable to it.
+    axis : int, optional
+        Ensemble axis of forecasts (and weights).
+
+    Returns
+    -------
+    crps : ndarray, shape (...)
+    """
+    forecasts, order = sort_ensemble(forecasts, axis)
+    if weights is not None:
+        weights = np.moveaxis(np.asarray(weights, dtype=float), axis, -1)
+        weights, order = np.broadcast_arrays(weights, order)
+        weights = np.take_along_axis(weights, order, axis=-1)
+    return crps_sorted(observations, forecasts, weights)
+
+
+def crps_skill(observations, forecasts, weights, axis=-1):
+    """Unweighted and weighted CRPS sharing one sort of the ensemble.
+
+    Parameters
+    ----------
+    observations : array_like, shape (...)
+    forecasts : array_like, shape (..., N)
+    weights : array_like, shape (..., N) or (N,)
+    axis : int, optional
+        Ensemble axis of forecasts (and weights).
+
+    Returns
+    -------
+    baseline, weighted : ndarray, shape (...)
+    """
+    forecasts, order = sort_ensemble(forecasts, axis)
+    weights = np.moveaxis(np.asarray(weights, dtype=float), axis, -1)
+    weights, order = np.broadcast_arrays(weights, order)
+    weights = np.take_along_axis(weights, order, axis=-1)
+    baseline = crps_sorted(observations, forecasts)
+    weighted = crps_sorted(observations, forecasts, weights)
+    return baseline, weighted
+
+
+def perfect_model_mask(model_ensemble, perfect, exclude_ensembles='all'):
+    """Ensemble members used to predict each perfect model.
+
+    Parameters
+    ----------
+    model_ensemble : array_like, shape (N,)
+        Model identifiers of the form <model>_<ensemble>_<id>.
+    perfect : array_like, shape (M,)
+        Index of each perfect model in model_ensemble.
+    exclude_ensembles : {'all', 'same', 'none'}, optional
+        - all: only use one ensemble member per model
+        - same: use all ensemble members but exclude ensemble members from
+          the same model as the perfect model
+        - none: use all models and members except the perfect one
+
+    Returns
+    -------
+    mask : ndarray, shape (M, N)
+        mask[i, j] is True if member j is used for perfect model i.
+    """
+    assert exclude_ensembles in ['all', 'same', 'none']
+    models = np.array([str(mm).split('_')[0] for mm in np.asarray(model_ensemble)])
+    perfect = np.asarray(perfect)
+
+    if exclude_ensembles == 'all':
+        _, idx_sel = np.unique(models, return_index=True)
+        mask = np.zeros((len(perfect), len(models)), dtype=bool)
+        mask[:, idx_sel] = True
+    elif exclude_ensembles == 'same':
+        mask = models[perfect, np.newaxis] != models[np.newaxis, :]
+    else:
+        mask = np.ones((len(perfect), len(models)), dtype=bool)
+    mask[np.arange(len(perfect)), perfect] = False
+    return mask
+
+
+def crps_perfect_model(data, weights, model_ensemble=None, exclude_ensembles='all', axis=-1):
+    """Unweighted and weighted CRPS using each model as pseudo observation.
+
+    Parameters
+    ----------
+    data : array_like, shape (..., N)
+    weights : array_like, shape (M, N)
+        Weights for each of the M perfect models. Exactly one weight per
+        perfect model has to be NaN. This will be used to identify the
+        index of the perfect model.
+    model_ensemble : array_like, shape (N,), optional
+        List of model identifiers. Only needs to be given if exclude_ensembles
+        is not 'none'.
+    exclude_ensembles : {'all', 'same', 'none'}, optional
+        See perfect_model_mask.
+    axis : int, optional
+        Ensemble axis of data.
+
+    Returns
+    -------
+    baseline, weighted : ndarray, shape (M, ...)
+    """
+    weights = np.asarray(weights, dtype=float)
+    assert np.all(np.isnan(weights).sum(axis=-1) == 1), 'exactly one weight has to be np.nan!'
+    if exclude_ensembles != 'none' and model_ensemble is None:
+        raise ValueError('If exclude_ensembles is not none model_ensemble has to be given!')
+    if model_ensemble is None:
+        model_ensemble = np.arange(weights.shape[-1])
+
+    perfect = np.argmax(np.isnan(weights), axis=-1)
+    mask = perfect_model_mask(model_ensemble, perfect, exclude_ensembles)
+    weights = np.where(mask, weights, 0.)
+
+    data = np.moveaxis(np.asarray(data, dtype=float), axis, -1)
+    observations = np.moveaxis(data[..., perfect], -1, 0)  # (M, ...)
+    forecasts, order = sort_ensemble(data[np.newaxis])  # (1, ..., N)
+    order = np.broadcast_to(order, observations.shape + data.shape[-1:])
+    shape = (len(perfect),) + (1,) * (data.ndim - 1) + (data.shape[-1],)
+    weights = np.take_along_axis(
+        np.broadcast_to(weights.reshape(shape), order.shape), order, axis=-1)
+    mask = np.take_along_axis(
+        np.broadcast_to(mask.reshape(shape), order.shape), order, axis=-1)
+
+    baseline = crps_sorted(observations, forecasts, mask)
+    weighted = crps_sorted(observations, forecasts, weights)
+    return baseline, weighted
@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2020 Lukas Brunner, ETH Zurich
+
+This file is part of ClimWIP.
+
+ClimWIP is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Authors
+-------
+- Lukas Brunner || lukas.brunner@env.ethz.ch
+
+Abstract
+--------
+Plan and execute all diagnostics of a configuration as a small dependency
+graph. Each (basic or derived) diagnostic is expanded into the basic variable
+fields it depends on. Fields with identical settings (variable, time period,
+season, region, and land-sea mask) are only read and pre-processed once and
+are then shared by all diagnostics depending on them (e.g., 'tas' used as
+plain diagnostic and as part of 'tasclt' and 'taspr').
+"""
+import os
+import logging
+from collections import OrderedDict
+import numpy as np
+import xarray as xr
+
+from .diagnostics import (
+    ALL_REGIONS,
+    write_netcdf,
+    read_basic_field,
+    select_region,
+    global_mean_climatology,
+    aggregate_time,
+    get_outfile,
+)
+from .utils_xarray import correlation
+
+logger = logging.getLogger(__name__)
+
+# derived diagnostics and the basic variables they are calculated from
+DERIVED = {
+    'tashuss': ('huss', 'tas'),
+    'tasclt': ('clt', 'tas'),
+    'taspr': ('pr', 'tas'),
+    'rnet': ('rlds', 'rlus', 'rsds', 'rsus'),
+    'ef': ('hfls', 'hfss'),
+    'dtr': ('tasmax', 'tasmin'),
+}
+
+
+def expand_diagnostic(diagn):
+    """
+    Split a diagnostic into its name and the basic variables it depends on.
+
+    Parameters
+    ----------
+    diagn : str or dict
+        * if str and in DERIVED: derived diagnostic, the basic variables are
+          taken from DERIVED
+        * if str: basic diagnostic
+        * if dict: exactly one key-value pair with the key representing the
+          name of the diagnostic and the value the basic variables
+          (e.g., {'tas-clt': ['tas', 'clt']}, see read_config)
+
+    Returns
+    -------
+    key : str
+    varns : tuple of str
+    """
+    if isinstance(diagn, dict):
+        assert len(diagn.keys()) == 1
+        key, varns = [*diagn.items()][0]
+        return key, tuple(varns)
+    if diagn in DERIVED:
+        return diagn, DERIVED[diagn]
+    return diagn, (diagn,)
+
+
+def combine_fields(diagn, das, time_aggregation=None):
+    """
+    Calculate a derived diagnostic from its basic variable fields.
+
+    Parameters
+    ----------
+    diagn : str
+        Name of the derived diagnostic.
+    das : list of xarray.DataArray
+        Basic variables in the order given by expand_diagnostic.
+    time_aggregation : str, optional
+        If 'CORR' the temporal correlation of the two basic variables is
+        calculated, independent of diagn.
+
+    Returns
+    -------
+    da : xarray.DataArray
+    """
+    if time_aggregation == 'CORR':
+        assert len(das) == 2, 'can only correlate two variables'
+        assert das[0].name != das[1].name, 'can not correlate same variables'
+        da = xr.apply_ufunc(correlation, das[0], das[1],
+                            input_core_dims=[['time'], ['time']],
+                            vectorize=True)
+        da.attrs = {'units': '1'}
+        return da
+
+    if diagn == 'rnet':
+        da = (das[0] - das[1]) + (das[2] - das[3])
+        da.attrs = {
+            'units': das[0].attrs.get('units'),
+            'long_name': 'Surface Downwelling Net Radiation',
+            'standard_name': 'surface_downwelling_net_flux_in_air'}
+    elif diagn == 'dtr':
+        da = das[0] - das[1]
+        da.attrs = {'units': das[0].attrs.get('units'),
+                    'long_name': 'Diurnal Temperature Range'}
+    elif diagn == 'ef':
+        da = das[0] / (das[0] + das[1])
+        da.attrs = {'units': '1', 'long_name': 'Evaporative Fraction'}
+    else:
+        raise NotImplementedError(
+            f'No combination defined for {diagn} with time_aggregation={time_aggregation}')
+    return da
+
+
+def get_diagnostic_settings(cfg, kinds=('performance', 'independence', 'target')):
+    """
+    Collect the settings of all diagnostics needed by a configuration.
+
+    Parameters
+    ----------
+    cfg : configuration object
+        See read_config() docstring for more information.
+    kinds : tuple of {'performance', 'independence', 'target'}, optional
+        Which kind of diagnostics to collect.
+
+    Returns
+    -------
+    settings : OrderedDict
+        Keys are of the form (kind, idx) where kind is one of {'performance',
+        'independence', 'target', 'target_ref'} and idx is the index of the
+        diagnostic (None for the target). Values are dictionaries of keyword
+        arguments for DiagnosticGraph.add_diagnostic.
+    """
+    settings = OrderedDict()
+    for kind in ['performance', 'independence']:
+        if kind not in kinds or cfg[f'{kind}_diagnostics'] is None:
+            continue
+        if kind == 'performance' and cfg.obs_id is None:
+            continue
+        for idx, diagn in enumerate(cfg[f'{kind}_diagnostics']):
+            settings[(kind, idx)] = dict(
+                diagn=diagn,
+                time_period=(cfg[f'{kind}_startyears'][idx],
+                             cfg[f'{kind}_endyears'][idx]),
+                season=cfg[f'{kind}_seasons'][idx],
+                time_aggregation=cfg[f'{kind}_aggs'][idx],
+                mask_land_sea=cfg[f'{kind}_masks'][idx],
+                region=cfg[f'{kind}_regions'][idx],
+            )
+
+    if 'target' in kinds and cfg.target_diagnostic is not None:
+        settings[('target', None)] = dict(
+            diagn=cfg.target_diagnostic,
+            time_period=(cfg.target_startyear, cfg.target_endyear),
+            season=cfg.target_season,
+            time_aggregation=cfg.target_agg,
+            mask_land_sea=cfg.target_mask,
+            region=cfg.target_region,
+        )
+        if cfg.target_startyear_ref is not None:
+            settings[('target_ref', None)] = dict(
+                settings[('target', None)],
+                time_period=(cfg.target_startyear_ref, cfg.target_endyear_ref))
+
+    return settings
+
+
+def _hashable(value):
+    """Convert lists (e.g., of regions) to tuples to use them as keys."""
+    if isinstance(value, (list, np.ndarray)):
+        return tuple(value)
+    return value
+
+
+class DiagnosticGraph:
+    """
+    A dependency graph of diagnostics for one model (or observational dataset).
+
+    Diagnostics are added with add_diagnostic, which expands them into
+    basic-variable nodes. A node is identified by (variable, infile, time
+    period, season, land-sea mask, region, grid points) and nodes sharing the
+    same input field (i.e., only differing by region) are derived from the
+    same file read. Calling execute reads each field exactly once, derives
+    all nodes from it, and then runs the (derived) combination and time
+    aggregation steps for each diagnostic.
+
+    Parameters
+    ----------
+    id_ : {'CMIP6', 'CMIP5', 'CMIP3', 'LE'}, optional
+        A valid model ID or None for observations.
+    overwrite : bool, optional
+        If False diagnostics which already exist on disk are read instead of
+        being calculated (and their nodes are not added to the graph).
+    dtype : numpy.dtype, optional
+        If not None all fields are cast to dtype when they are read and the
+        diagnostics are returned (and saved) with this dtype. Saved
+        diagnostics get the dtype name appended to their filename.
+    cells : bool, optional
+        If True irregular regions are returned (and saved) in the cells
+        layout (see select_region). Saved diagnostics get '_cells' appended
+        to their filename.
+
+    Examples
+    --------
+    graph = DiagnosticGraph('CMIP6')
+    graph.add_diagnostic('clim', 'tas', {'tas': filename}, ...)
+    graph.add_diagnostic('corr', 'tasclt', {'tas': fn1, 'clt': fn2}, ...)
+    diagnostics = graph.execute()  # tas is only read once
+    """
+
+    def __init__(self, id_=None, overwrite=False, dtype=None, cells=False):
+        self.id_ = id_
+        self.overwrite = overwrite
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.cells = cells
+        self.fields = OrderedDict()  # field key -> set of node keys
+        self.diagnostics = OrderedDict()  # name -> diagnostic specification
+
+    def _add_node(self, infile, varn, time_period, season, mask_land_sea,
+                  region, idx_lats, idx_lons):
+        field_key = (varn, infile, _hashable(time_period), season, mask_land_sea)
+        node_key = field_key + (_hashable(region), _hashable(idx_lats), _hashable(idx_lons))
+        self.fields.setdefault(field_key, set()).add(node_key)
+        return node_key
+
+    def add_diagnostic(self, name, diagn, infiles,
+                       time_period=None,
+                       season=None,
+                       time_aggregation=None,
+                       mask_land_sea=False,
+                       region='GLOBAL',
+                       idx_lats=None,
+                       idx_lons=None,
+                       base_path=None):
+        """
+        Add a diagnostic to the graph.
+
+        Parameters
+        ----------
+        name : hashable
+            Identifier of the diagnostic in the output of execute.
+        diagn : str or dict
+            See expand_diagnostic.
+        infiles : dict
+            Input filename for each basic variable diagn depends on.
+        base_path : str, optional
+            If not None the diagnostic is saved in this path (and re-used if
+            overwrite is False).
+        See calculate_basic_diagnostic for all other parameters.
+        """
+        key, varns = expand_diagnostic(diagn)
+        if region in ALL_REGIONS:  # reduced to all regions later (see region_labels)
+            region = 'GLOBAL'
+
+        outfile = None
+        if base_path is not None:
+            outfile = get_outfile(
+                base_path, infile=infiles[varns[0]], time_period=time_period,
+                season=season, time_aggregation=time_aggregation,
+                mask_land_sea=mask_land_sea, region=region,
+                idx_lats=idx_lats, idx_lons=idx_lons)
+            if key != varns[0]:  # derived diagnostic
+                path, fn = os.path.split(outfile)
+                outfile = os.path.join(path, fn.replace(f'{varns[0]}_', f'{key}_', 1))
+            if self.dtype is not None:
+                outfile = outfile.replace('.nc', f'_{self.dtype.name}.nc')
+            if self.cells:
+                outfile = outfile.replace('.nc', '_cells.nc')
+
+        spec = {
+            'key': key,
+            'varns': varns,
+            'outfile': outfile,
+            'season': season,
+            'time_aggregation': time_aggregation,
+            'nodes': None,
+            'nodes_global': None,
+        }
+        self.diagnostics[name] = spec
+
+        if not self.overwrite and outfile is not None and os.path.isfile(outfile):
+            return  # no need to calculate anything
+
+        spec['nodes'] = [self._add_node(
+            infiles[varn], varn, time_period, season, mask_land_sea,
+            region, idx_lats, idx_lons) for varn in varns]
+
+        if time_aggregation == 'ANOM-GLOBAL':
+            # the reference is the global mean of the same field
+            spec['nodes_global'] = [self._add_node(
+                infiles[varn], varn, time_period, season, mask_land_sea,
+                'GLOBAL', None, None) for varn in varns]
+
+    @property
+    def nr_reads(self):
+        """Number of files reads needed to execute the graph."""
+        return len(self.fields)
+
+    def execute(self):
+        """
+        Calculate all diagnostics added to the graph.
+
+        Returns
+        -------
+        diagnostics : OrderedDict
+            Keys are the names given in add_diagnostic, values are
+            xarray.Datasets containing one variable named like the diagnostic.
+        """
+        nodes = {}
+        for field_key, node_keys in self.fields.items():
+            varn, infile, time_period, season, mask_land_sea = field_key
+            da = read_basic_field(
+                infile, varn, self.id_, time_period, season, mask_land_sea,
+                self.dtype)
+            for node_key in node_keys:
+                region, idx_lats, idx_lons = node_key[-3:]
+                region = list(region) if isinstance(region, tuple) else region
+                nodes[node_key] = select_region(
+                    da, region, idx_lats, idx_lons, mask_land_sea, self.cells)
+
+        diagnostics = OrderedDict()
+        for name, spec in self.diagnostics.items():
+            if spec['nodes'] is None:
+                logger.debug('Diagnostic already exists & overwrite=False, skipping.')
+                diagnostics[name] = xr.open_dataset(spec['outfile'], use_cftime=True)
+                continue
+
+            da = self._combine(spec, [nodes[key] for key in spec['nodes']])
+            if spec['time_aggregation'] == 'ANOM-GLOBAL':
+                da_global = self._combine(spec, [nodes[key] for key in spec['nodes_global']])
+                da_mean = global_mean_climatology(da_global, spec['season'])
+            else:
+                da_mean = None
+            da = aggregate_time(da, spec['season'], spec['time_aggregation'], da_mean)
+            if self.dtype is not None:  # some aggregations return float64
+                da = da.astype(self.dtype, copy=False)
+
+            ds = da.to_dataset(name=spec['key'])
+            if spec['outfile'] is not None:
+                write_netcdf(ds, spec['outfile'])
+            diagnostics[name] = ds
+
+        return diagnostics
+
+    @staticmethod
+    def _combine(spec, das):
+        if len(spec['varns']) == 1:
+            return das[0]
+        return combine_fields(spec['key'], das, spec['time_aggregation'])
+
+
+def build_graph(cfg, infiles, id_=None, kinds=('performance', 'independence', 'target'),
+                precision=None, names=None):
+    """
+    Set up the diagnostic graph of one model for a given configuration.
+
+    Parameters
+    ----------
+    cfg : configuration object
+        See read_config() docstring for more information.
+    infiles : dict
+        Input filename for each basic variable, e.g., {'tas': filename, ...}
+    id_ : {'CMIP6', 'CMIP5', 'CMIP3', 'LE'}, optional
+    kinds : tuple of {'performance', 'independence', 'target'}, optional
+    precision : {'float32', 'float64'}, optional
+        Overwrite cfg.precision.
+    names : list, optional
+        Only add the diagnostics with these names (see get_diagnostic_settings).
+
+    Returns
+    -------
+    graph : DiagnosticGraph
+    """
+    if precision is None:
+        precision = cfg.precision
+    graph = DiagnosticGraph(
+        id_, overwrite=cfg.overwrite, dtype=precision, cells=cfg.region_cells)
+    for name, settings in get_diagnostic_settings(cfg, kinds).items():
+        if names is not None and name not in names:
+            continue
+        key, _ = expand_diagnostic(settings['diagn'])
+        base_path = os.path.join(cfg.save_path, key)
+        os.makedirs(base_path, exist_ok=True)
+        graph.add_diagnostic(
+            name, infiles=infiles, base_path=base_path,
+            idx_lats=cfg.idx_lats, idx_lons=cfg.idx_lons, **settings)
+    return graph
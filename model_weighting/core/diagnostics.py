@@ -46,6 +46,8 @@ from .utils_xarray import (
     correlation,
     flip_antimeridian,
     area_weighted_mean,
+    to_cells,
+    sliding_windows,
 )
 
 cdo = Cdo()
@@ -54,6 +56,24 @@ logger = logging.getLogger(__name__)
 REGION_DIR = '{}/../shapefiles/'.format(os.path.dirname(__file__))
 MASK = 'land_sea_mask_regionsmask.nc'
 
+# region keywords of the batched all-regions mode and the regionmask regions
+# they stand for (see region_labels)
+ALL_REGIONS = {
+    'ALL_SREX': 'srex',
+    'ALL_AR6': 'ar6.all',
+}
+
+
+def write_netcdf(ds, outfile):
+    """Write ds to outfile via a temporary file.
+
+    Sections running at the same time (see run_all.py) share diagnostics, so
+    other processes must never find a partially written file.
+    """
+    tmpfile = f'{outfile}.{os.getpid()}.tmp'
+    ds.to_netcdf(tmpfile)
+    os.replace(tmpfile, outfile)
+
 
 def calculate_net_radiation(infile, varns, outname, diagn):
     assert varns == ('rlds', 'rlus', 'rsds', 'rsus')
@@ -73,11 +93,14 @@ def calculate_net_radiation(infile, varns, outname, diagn):
     # TODO: units; positive direction definition as attrs
     ds = da.to_dataset(name=diagn)
 
-    ds.to_netcdf(outname)
+    write_netcdf(ds, outname)
 
 
 def standardize_units(da, varn):
-    """Convert units to a common standard"""
+    """Convert units to a common standard.
+
+    The conversion is done in place and keeps the dtype of da (e.g., float32
+    fields stay float32)."""
     if 'units' in da.attrs.keys():
         unit = da.attrs['units']
     else:
@@ -259,58 +282,32 @@ def average_season(da, season, full_seasons_only=True):
 
 
 
-def calculate_basic_diagnostic(infile, varn,
-                               outfile=None,
-                               id_=None,
-                               time_period=None,
-                               season=None,
-                               time_aggregation=None,
-                               mask_land_sea=False,
-                               region='GLOBAL',
-                               overwrite=False,
-                               regrid=False,  # DELETE
-                               idx_lats=None,
-                               idx_lons=None):
+def read_basic_field(infile, varn,
+                     id_=None,
+                     time_period=None,
+                     season=None,
+                     mask_land_sea=False,
+                     dtype=None):
     """
-    Calculate a basic diagnostic from a given file.
+    Read a basic variable and apply the time and land-sea selection.
 
-    A basic diagnostic calculated from a input file by selecting a given
-    region, time period, and season as well as applying a land-sea mask.
-    Also, the time dimension is aggregated by different methods.
+    This is the first part of calculate_basic_diagnostic: the input file is
+    read (for CMIP6 including the historical file), the units are
+    standardized, the given time period and season are selected, and the
+    land-sea mask is applied. No regional selection or time aggregation
+    is done.
 
     Parameters
     ----------
-    infile : str
-        Full path of the input file. Must contain varn.
-    varn : str
-        The variable contained in infile.
-    outfile : str, optional
-        Full path of the output file. Path must exist.
-    id_ : {'CMIP6', 'CMIP5', 'CMIP3', 'LE'}, optional
-        A valid model ID
-    time_period : tuple of two strings, optional
-        Start and end of the time period. Both strings must be on of
-        {"yyyy", "yyyy-mm", "yyyy-mm-dd"}.
-    season : {'JJA', 'SON', 'DJF', 'MAM', 'ANN'}, optional
-    time_aggregation : {'CLIM', 'STD', 'TREND', 'ANOM-GOBAL', 'ANOM-LOCAL'}, optional
-        Type of time aggregation to use.
-    mask_land_sea : {'sea', 'land', False}, optional
-    region : list of strings or str, optional
-        Each string must be a valid SREX region
-    overwrite : bool, optional
-        If True overwrite existing outfiles otherwise read and return them.
-    regrid : DEPRECATED
-    idx_lats : list of int, optional
-    idx_lons : list of int, optional
+    dtype : numpy.dtype, optional
+        If not None the field is cast to dtype directly after reading, i.e.,
+        before the unit conversion. All following steps keep this dtype.
+    See calculate_basic_diagnostic for all other parameters.
 
     Returns
     -------
-    diagnostic : xarray.DataArray
+    da : xarray.DataArray, shape (time, lat, lon)
     """
-    if not overwrite and outfile is not None and os.path.isfile(outfile):
-        logger.debug('Diagnostic already exists & overwrite=False, skipping.')
-        return xr.open_dataset(outfile, use_cftime=True)
-
     if id_ == 'CMIP6':  # need to concat historical file and delete 'height'
         scenario = infile.split('_')[-3]
         da = xr.open_dataset(infile, use_cftime=True)[varn]
@@ -327,6 +324,9 @@ def calculate_basic_diagnostic(infile, varn,
     except ValueError:
         pass
 
+    if dtype is not None:
+        da = da.astype(dtype, copy=False)
+
     da = standardize_units(da, varn)
     da = flip_antimeridian(da)
     assert np.all(da['lat'].data == np.arange(-88.75, 90., 2.5))
@@ -335,12 +335,11 @@ def calculate_basic_diagnostic(infile, varn,
     if time_period is not None:
         da = da.sel(time=slice(str(time_period[0]), str(time_period[1])))
 
-    # NOTE: CAMS-CSM1-0 is missing the last year!
-    if str(time_period[1]) == '2100' and 'CAMS-CSM1-0' in infile:
-        da = da.sel(time=slice(None, '2099'))
+        # NOTE: CAMS-CSM1-0 is missing the last year!
+        if str(time_period[1]) == '2100' and 'CAMS-CSM1-0' in infile:
+            da = da.sel(time=slice(None, '2099'))
 
     if id_ in ['CMIP6', 'CMIP5', 'CMIP3', 'LE'] and np.any(np.isnan(da.data)):
-        import ipdb; ipdb.set_trace()
         raise ValueError('Missing value in model detected!')
 
     if season in ['JJA', 'SON', 'DJF', 'MAM']:
@@ -350,26 +349,66 @@ def calculate_basic_diagnostic(infile, varn,
     else:
         raise NotImplementedError('season={}'.format(season))
 
+    mask = land_sea_mask(da, mask_land_sea)
+    if mask is not None:
+        da = da.where(mask)
+
+    return da
+
+
+def land_sea_mask(da, mask_land_sea=False):
+    """
+    The grid points of a field which are kept by a land-sea mask.
+
+    Parameters
+    ----------
+    da : xarray.DataArray, shape (..., lat, lon)
+    mask_land_sea : {'sea', 'land', False}, optional
+
+    Returns
+    -------
+    mask : xarray.DataArray, shape (lat, lon) or None
+        True for grid points to keep. None if mask_land_sea is False.
+    """
     if isinstance(mask_land_sea, bool) and not mask_land_sea:
-        pass
+        return None
     elif mask_land_sea == 'sea':
         with warnings.catch_warnings():
             warnings.simplefilter('ignore')
-            sea_mask = regionmask.defined_regions.natural_earth.land_110.mask(da) == 0
-        da = da.where(sea_mask)
+            return regionmask.defined_regions.natural_earth.land_110.mask(da) == 0
     elif mask_land_sea == 'land':
         with warnings.catch_warnings():
             warnings.simplefilter('ignore')
-            land_mask = np.isnan(regionmask.defined_regions.natural_earth.land_110.mask(da))
-        da = da.where(land_mask)
-    else:
-        raise NotImplementedError
+            return np.isnan(regionmask.defined_regions.natural_earth.land_110.mask(da))
+    raise NotImplementedError
 
-    if time_aggregation == 'ANOM-GLOBAL':
-        da_mean = average_season(da, season)
-        da_mean = da_mean.mean('year', skipna=False)
-        da_mean = area_weighted_mean(da_mean)
 
+def select_region(da, region='GLOBAL', idx_lats=None, idx_lons=None,
+                  mask_land_sea=False, cells=False):
+    """
+    Select a region or a set of grid points from a field.
+
+    Parameters
+    ----------
+    da : xarray.DataArray, shape (time, lat, lon)
+    region : list of strings or str, optional
+        Each string must be a valid SREX region or the name of a file in
+        REGION_DIR (without extension) containing the region corners.
+    idx_lats : list of int, optional
+    idx_lons : list of int, optional
+    mask_land_sea : {'sea', 'land', False}, optional
+        The land-sea mask applied to da (only used if cells is True).
+    cells : bool, optional
+        If True return irregular regions (SREX regions and/or a land-sea
+        mask) in the cells layout (see utils_xarray.to_cells), i.e., only
+        the grid points inside the region and the mask are kept. The cells
+        are the same for all fields on the same grid.
+
+    Returns
+    -------
+    da : xarray.DataArray
+    """
+    cells_mask = None
     if region != 'GLOBAL':
         if (isinstance(region, str) and
             region not in regionmask.defined_regions.srex.abbrevs):
@@ -401,12 +440,22 @@ def calculate_basic_diagnostic(infile, varn,
                 masks.append(
                     regionmask.defined_regions.srex.mask(da) == key)
             mask = sum(masks) == 1
-            da = da.where(mask, drop=True)
-
-        if np.all(np.isnan(da.isel(time=0))):
-            errmsg = 'All grid points masked! Wrong masking settings?'
-            logger.error(errmsg)
-            raise ValueError(errmsg)
+            if cells:
+                cells_mask = mask
+            else:
+                da = da.where(mask, drop=True)
+
+    if cells and (idx_lats is None or idx_lons is None):
+        mask = land_sea_mask(da, mask_land_sea)
+        if mask is not None:
+            cells_mask = mask if cells_mask is None else cells_mask & mask
+        if cells_mask is not None:
+            da = to_cells(da, cells_mask)
+
+    if region != 'GLOBAL' and np.all(np.isnan(da.isel(time=0))):
+        errmsg = 'All grid points masked! Wrong masking settings?'
+        logger.error(errmsg)
+        raise ValueError(errmsg)
 
     if idx_lats is not None and idx_lons is not None:
         da = da.isel(lat=idx_lats, lon=idx_lons)
@@ -414,14 +463,105 @@ def calculate_basic_diagnostic(infile, varn,
             # end program if only nan (i.e., ocean with mask)
             sys.exit(f'{idx_lats, idx_lons} contains only nan')
 
-    attrs = da.attrs
+    return da
+
+
+def get_regions(regions='ALL_SREX'):
+    """The regionmask.Regions a keyword of the all-regions mode stands for."""
+    if regions not in ALL_REGIONS:
+        raise ValueError(f'{regions} is not in {", ".join(ALL_REGIONS)}')
+    defined_regions = regionmask.defined_regions
+    for attr in ALL_REGIONS[regions].split('.'):
+        defined_regions = getattr(defined_regions, attr)
+    return defined_regions
+
+
+def region_labels(da, regions='ALL_SREX'):
+    """
+    Labelled mask of all regions of a batched all-regions run.
+
+    Each grid point gets the index of the region it is in, so a field can be
+    reduced to all regions at once (see utils_xarray.labelled_mean). The
+    regions are the same as the ones used by select_region.
+
+    Parameters
+    ----------
+    da : xarray.DataArray, shape (..., lat, lon) or (..., cells)
+    regions : {'ALL_SREX', 'ALL_AR6'}, optional
+
+    Returns
+    -------
+    labels : ndarray of int, shape (lat*lon,) or (cells,)
+        Index of the region of each (flattened) grid point in abbrevs, -1
+        for grid points which are in none of the regions.
+    abbrevs : list of str
+    """
+    regions = get_regions(regions)
+    lats, lons = da['lat'].data, da['lon'].data
+    if 'cells' in da.dims:  # the grid points have to be looked up
+        lats, idx_lat = np.unique(lats, return_inverse=True)
+        lons, idx_lon = np.unique(lons, return_inverse=True)
+    else:
+        idx_lat, idx_lon = [idx.ravel() for idx in np.meshgrid(
+            np.arange(lats.size), np.arange(lons.size), indexing='ij')]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        mask = regions.mask(lons, lats).transpose('lat', 'lon').data
+    numbers = mask[idx_lat, idx_lon]
+
+    labels = np.full(numbers.shape, -1)
+    valid = np.isfinite(numbers)
+    sorter = np.argsort(regions.numbers)
+    labels[valid] = sorter[np.searchsorted(
+        np.asarray(regions.numbers)[sorter], numbers[valid])]
+    return labels, list(regions.abbrevs)
+
+
+def global_mean_climatology(da, season):
+    """The area weighted climatological mean used as reference by ANOM-GLOBAL.
+
+    Parameters
+    ----------
+    da : xarray.DataArray, shape (time, lat, lon)
+        Global (i.e., not regionally selected) field.
+    season : {'JJA', 'SON', 'DJF', 'MAM', 'ANN'} or None
+
+    Returns
+    -------
+    da_mean : xarray.DataArray, shape ()
+    """
+    da_mean = average_season(da, season)
+    da_mean = da_mean.mean('year', skipna=False)
+    return area_weighted_mean(da_mean)
+
+
+def aggregate_time(da, season=None, time_aggregation=None, da_mean=None):
+    """
+    Aggregate the time dimension of a (regionally selected) field.
+
+    Parameters
+    ----------
+    da : xarray.DataArray, shape (time, ...)
+    season : {'JJA', 'SON', 'DJF', 'MAM', 'ANN'}, optional
+    time_aggregation : {'CLIM', 'STD', 'TREND', 'ANOM-GOBAL', 'ANOM-LOCAL', 'CYC'}, optional
+        Type of time aggregation to use.
+    da_mean : xarray.DataArray, shape (), optional
+        Only used (and mandatory) for time_aggregation='ANOM-GLOBAL', see
+        global_mean_climatology.
+
+    Returns
+    -------
+    da : xarray.DataArray
+    """
+    attrs = dict(da.attrs)  # da might be shared with other diagnostics
 
     with warnings.catch_warnings():
         # suppress warnings on masked ocean grid cells
         warnings.filterwarnings('ignore', message='Mean of empty slice')
         warnings.filterwarnings('ignore', message='Degrees of freedom <= 0 for slice')
 
-        if time_aggregation == 'CLIM':
+        if time_aggregation in ['CLIM', 'CLIM-MEAN']:
             # mean of seasonal (annual) means
             da = average_season(da, season)
             da = da.mean('year', skipna=False)
@@ -473,13 +613,161 @@ def calculate_basic_diagnostic(infile, varn,
         else:
             NotImplementedError(f'time_aggregation={time_aggregation}')
 
+    da.attrs = attrs
+    return da
+
+
+def aggregate_windows(da, season=None, time_aggregation='CLIM', windows=None):
+    """
+    Aggregate the time dimension for several time periods (windows) at once.
+
+    Same as aggregate_time for the field selected to each time period but the
+    seasonal (annual) means are only calculated once and the mean or trend of
+    each window is calculated from cumulative sums over the years (see
+    utils_xarray.sliding_windows).
+
+    Parameters
+    ----------
+    da : xarray.DataArray, shape (time, ...)
+        Has to cover all windows.
+    season : {'JJA', 'SON', 'DJF', 'MAM', 'ANN'}, optional
+    time_aggregation : {'CLIM', 'TREND'}, optional
+    windows : list of tuple of int, shape (W, 2)
+        First and last year of each window (same as time_period).
+
+    Returns
+    -------
+    da : xarray.DataArray, shape (window, ...)
+        With the first and last year of each window as coordinates
+        window_start and window_end.
+    """
+    if time_aggregation not in ['CLIM', 'TREND']:
+        raise NotImplementedError(f'time_aggregation={time_aggregation}')
+    attrs = dict(da.attrs)
+    if time_aggregation == 'TREND':
+        attrs['units'] = '{} year**-1'.format(attrs['units'])
+
+    da = average_season(da, season).transpose('year', ...)
+    years = da['year'].data
+    if np.any(np.diff(years) != 1):
+        raise ValueError('Years have to be consecutive')
+
+    windows = np.array(windows)
+    # winters are labeled by the year of January and February (see average_season)
+    starts = windows[:, 0] + (season == 'DJF')
+    ends = windows[:, 1]
+    if starts.min() < years[0] or ends.max() > years[-1]:
+        errmsg = f'Windows not covered by the years {years[0]}-{years[-1]} of the field'
+        logger.error(errmsg)
+        raise ValueError(errmsg)
+
+    data = sliding_windows(
+        da.data, starts - years[0], ends - years[0] + 1,
+        slope=time_aggregation == 'TREND')
+    coords = {key: coord for key, coord in da.coords.items() if 'year' not in coord.dims}
+    return xr.DataArray(
+        data, dims=('window',) + da.dims[1:], attrs=attrs,
+        coords={**coords,
+                'window_start': ('window', windows[:, 0]),
+                'window_end': ('window', windows[:, 1])})
+
+
+def calculate_basic_diagnostic(infile, varn,
+                               outfile=None,
+                               id_=None,
+                               time_period=None,
+                               season=None,
+                               time_aggregation=None,
+                               mask_land_sea=False,
+                               region='GLOBAL',
+                               overwrite=False,
+                               regrid=False,  # DELETE
+                               idx_lats=None,
+                               idx_lons=None):
+    """
+    Calculate a basic diagnostic from a given file.
+
+    A basic diagnostic calculated from a input file by selecting a given
+    region, time period, and season as well as applying a land-sea mask.
+    Also, the time dimension is aggregated by different methods.
+
+    Parameters
+    ----------
+    infile : str
+        Full path of the input file. Must contain varn.
+    varn : str
+        The variable contained in infile.
+    outfile : str, optional
+        Full path of the output file. Path must exist.
+    id_ : {'CMIP6', 'CMIP5', 'CMIP3', 'LE'}, optional
+        A valid model ID
+    time_period : tuple of two strings, optional
+        Start and end of the time period. Both strings must be on of
+        {"yyyy", "yyyy-mm", "yyyy-mm-dd"}.
+    season : {'JJA', 'SON', 'DJF', 'MAM', 'ANN'}, optional
+    time_aggregation : {'CLIM', 'STD', 'TREND', 'ANOM-GOBAL', 'ANOM-LOCAL'}, optional
+        Type of time aggregation to use.
+    mask_land_sea : {'sea', 'land', False}, optional
+    region : list of strings or str, optional
+        Each string must be a valid SREX region
+    overwrite : bool, optional
+        If True overwrite existing outfiles otherwise read and return them.
+    regrid : DEPRECATED
+    idx_lats : list of int, optional
+    idx_lons : list of int, optional
+
+    Returns
+    -------
+    diagnostic : xarray.DataArray
+    """
+    if not overwrite and outfile is not None and os.path.isfile(outfile):
+        logger.debug('Diagnostic already exists & overwrite=False, skipping.')
+        return xr.open_dataset(outfile, use_cftime=True)
+
+    da = read_basic_field(infile, varn, id_, time_period, season, mask_land_sea)
+
+    if time_aggregation == 'ANOM-GLOBAL':
+        da_mean = global_mean_climatology(da, season)
+    else:
+        da_mean = None
+
+    da = select_region(da, region, idx_lats, idx_lons)
+    da = aggregate_time(da, season, time_aggregation, da_mean)
+
     ds = da.to_dataset(name=varn)
-    ds[varn].attrs = attrs
     if outfile is not None:
-        ds.to_netcdf(outfile)
+        write_netcdf(ds, outfile)
     return ds
 
 
+def get_outfile(base_path, **kwargs):
+    """Name of the file a diagnostic is saved to (see calculate_diagnostic)."""
+    kwargs['infile'] = os.path.basename(kwargs['infile']).replace('.nc', '')
+    if isinstance(kwargs['region'], (list, tuple)):
+        kwargs['region'] = '-'.join(kwargs['region'])
+
+    if kwargs['idx_lats'] is None and kwargs['idx_lons'] is None:
+        outfile = os.path.join(base_path, '_'.join([
+            '{infile}_{time_period[0]}-{time_period[1]}_{season}',
+            '{time_aggregation}_{region}_{masked}.nc']).format(
+                masked=(
+                    kwargs['mask_land_sea'] + 'masked'
+                    if not isinstance(kwargs['mask_land_sea'], bool) else 'unmasked'),
+                **kwargs))
+    else:
+        str_ = '_'.join(['-'.join(map(str, np.atleast_1d(kwargs['idx_lats']))),
+                         '-'.join(map(str, np.atleast_1d(kwargs['idx_lons'])))])
+        outfile = os.path.join(base_path, '_'.join([
+            '{infile}_{time_period[0]}-{time_period[1]}_{season}',
+            '{time_aggregation}_{region}_{masked}_{str_}.nc']).format(
+                str_=str_,
+                masked=(
+                    kwargs['mask_land_sea'] + 'masked'
+                    if not isinstance(kwargs['mask_land_sea'], bool) else 'unmasked'),
+                **kwargs))
+    return outfile
+
+
 def calculate_diagnostic(infile, diagn, base_path, **kwargs):
     """
     Calculate basic or derived diagnostics depending on input.
@@ -505,34 +793,8 @@ def calculate_diagnostic(infile, diagn, base_path, **kwargs):
     -------
     diagnostic : xarray.DataArray
     """
-    def get_outfile(**kwargs):
-        kwargs['infile'] = os.path.basename(kwargs['infile']).replace('.nc', '')
-        if isinstance(kwargs['region'], list):
-            kwargs['region'] = '-'.join(kwargs['region'])
-
-        if kwargs['idx_lats'] is None and kwargs['idx_lons'] is None:
-            outfile = os.path.join(base_path, '_'.join([
-                '{infile}_{time_period[0]}-{time_period[1]}_{season}',
-                '{time_aggregation}_{region}_{masked}.nc']).format(
-                    masked=(
-                        kwargs['mask_land_sea'] + 'masked'
-                        if not isinstance(kwargs['mask_land_sea'], bool) else 'unmasked'),
-                    **kwargs))
-        else:
-            str_ = '_'.join(['-'.join(map(str, kwargs['idx_lats'])),
-                             '-'.join(map(str, kwargs['idx_lons']))])
-            outfile = os.path.join(base_path, '_'.join([
-                '{infile}_{time_period[0]}-{time_period[1]}_{season}',
-                '{time_aggregation}_{region}_{masked}_{str_}.nc']).format(
-                    str_=str_,
-                    masked=(
-                        kwargs['mask_land_sea'] + 'masked'
-                        if not isinstance(kwargs['mask_land_sea'], bool) else 'unmasked'),
-                    **kwargs))
-        return outfile
-
     if isinstance(diagn, str):  # basic diagnostic
-        outfile = get_outfile(infile=infile, **kwargs)
+        outfile = get_outfile(base_path, infile=infile, **kwargs)
         return calculate_basic_diagnostic(infile, diagn, outfile, **kwargs)
     elif isinstance(diagn, dict):  # derived diagnostic
         diagn = dict(diagn)  # leave original alone (.pop!)
@@ -545,12 +807,12 @@ def calculate_diagnostic(infile, diagn, base_path, **kwargs):
             tmpfile = os.path.join(
                 base_path, os.path.basename(infile).replace(varns[0], diagn))
             calculate_net_radiation(infile, varns, tmpfile, diagn)
-            outfile = get_outfile(infile=tmpfile, **kwargs)
+            outfile = get_outfile(base_path, infile=tmpfile, **kwargs)
             return calculate_basic_diagnostic(tmpfile, diagn, outfile, **kwargs)
         elif kwargs['time_aggregation'] == 'CORR':
             assert len(varns) == 2, 'can only correlate two variables'
             assert varns[0] != varns[1], 'can not correlate same variables'
-            outfile1 = get_outfile(infile=infile, **kwargs)
+            outfile1 = get_outfile(base_path, infile=infile, **kwargs)
             ds1 = calculate_basic_diagnostic(infile, varns[0], outfile1, **kwargs)
 
             # !! '.../...Datasets...'.replace('tas', 'pr') -> '.../...Daprets...' !!
@@ -559,7 +821,7 @@ def calculate_diagnostic(infile, diagn, base_path, **kwargs):
             fn = fn.replace(f'{varns[0]}_', f'{varns[1]}_')
             path = (path+'/').replace(f'/{varns[0]}/', f'/{varns[1]}/')
             infile2 = os.path.join(path, fn)
-            outfile2 = get_outfile(infile=infile2, **kwargs)
+            outfile2 = get_outfile(base_path, infile=infile2, **kwargs)
             ds2 = calculate_basic_diagnostic(infile2, varns[1], outfile2, **kwargs)
             da = xr.apply_ufunc(correlation, ds1[varns[0]], ds2[varns[1]],
                                 input_core_dims=[['time'], ['time']],
@@ -567,5 +829,5 @@ def calculate_diagnostic(infile, diagn, base_path, **kwargs):
             outfile3 = outfile1.replace(f'/{varns[0]}_', f'/{diagn}_')
             ds3 = da.to_dataset(name=diagn)
             ds3[diagn].attrs = {'units': '1'}
-            ds3.to_netcdf(outfile3)
+            write_netcdf(ds3, outfile3)
             return ds3
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2019 Lukas Brunner, ETH Zurich
+
+This file is part of ClimWIP.
+
+ClimWIP is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Authors
+-------
+- Lukas Brunner || lukas.brunner@env.ethz.ch
+
+Abstract
+--------
+Streaming calculation of the model-model distance matrices. The diagnostic
+field of each model is added as soon as it is calculated and spilled to a
+temporary file, only the common finite mask and the sum over all models are
+kept in memory. The (weighted) Gram matrix is then accumulated over chunks
+of grid points, so the memory footprint is about one field plus the (N, N)
+distance matrix independent of the number of models.
+
+The results are the same as utils_xarray.weighted_distance_matrices (up to
+rounding errors).
+
+In addition, a persistent SQLite store of the distances between models (and
+between models and observations) so that only the distances of models which
+are new to a diagnostic need to be calculated.
+"""
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import numpy as np
+import xarray as xr
+
+from .utils_xarray import spatial_dims
+
+logger = logging.getLogger(__name__)
+
+
+class DistanceAccumulator:
+    """
+    Accumulate the area-weighted RMS distances between models whose fields
+    arrive one after the other.
+
+    Parameters
+    ----------
+    chunk_size : int, optional
+        Number of grid points read at once when finalizing.
+    dir : str, optional
+        Directory of the temporary file (default: see tempfile).
+
+    Examples
+    --------
+    accumulator = DistanceAccumulator()
+    for model_ensemble in model_ensembles:
+        accumulator.add(calc_field(model_ensemble), model_ensemble)
+    distances = accumulator.finalize()
+    """
+
+    def __init__(self, chunk_size=2**16, dir=None):
+        self.chunk_size = chunk_size
+        self.dir = dir
+        self.model_ensemble = []
+        self._file = None
+
+    def add(self, da, model_ensemble):
+        """Add the field of one model.
+
+        Parameters
+        ----------
+        da : xarray.DataArray
+            Has to contain the dimensions (lat, lon) or cells (see
+            utils_xarray.to_cells) and can contain others (e.g., month)
+            which have to be the same for all models.
+        model_ensemble : str
+        """
+        spatial = spatial_dims(da)
+        da = da.transpose(..., *spatial)
+        data = np.asarray(da.data, dtype=float)
+        if spatial == ['cells']:  # a grid with one longitude
+            data = data[..., np.newaxis]
+
+        if self._file is None:
+            self._dims = da.dims[:-len(spatial)]
+            self._coords = {dim: da[dim] for dim in self._dims if dim in da.coords}
+            self._shape = data.shape
+            self._lat = da['lat'].data
+            self._finite = np.isfinite(data)
+            self._sum = np.zeros(data.shape)
+            self._file = tempfile.TemporaryFile(dir=self.dir)
+        elif data.shape != self._shape:
+            raise ValueError(f'Shape of {model_ensemble} differs: {data.shape} != {self._shape}')
+
+        # same as np.all(np.isfinite(data), axis=0) over all models
+        self._finite &= np.isfinite(data)
+        self._sum += np.where(np.isfinite(data), data, 0.)
+        data.tofile(self._file)
+        self.model_ensemble.append(model_ensemble)
+
+    def _chunks(self, data, mean, finite, weights):
+        """Yield the centered and sqrt-weight-scaled data of each chunk."""
+        for start in range(0, data.shape[-1], self.chunk_size):
+            stop = start + self.chunk_size
+            valid = finite[start:stop]
+            chunk = np.where(valid, data[:, start:stop] - mean[start:stop], 0.)
+            yield chunk * np.sqrt(weights[start:stop])
+
+    def finalize(self, compensated=True, tolerance=1e-6):
+        """Calculate the distance matrices and delete the temporary file.
+
+        Parameters
+        ----------
+        compensated : bool, optional
+            See utils_xarray.weighted_distance_matrices.
+        tolerance : float, optional
+
+        Returns
+        -------
+        d_matrix : xarray.DataArray, shape (..., N, N)
+            Dimensions (..., perfect_model_ensemble, model_ensemble).
+        """
+        nr = len(self.model_ensemble)
+        self._file.flush()
+        batch = int(np.prod(self._shape[:-2]))
+        grid = self._shape[-2] * self._shape[-1]
+        data = np.memmap(self._file, dtype=float, mode='r', shape=(nr, batch, grid))
+        finite = self._finite.reshape(batch, grid)
+        mean = self._sum.reshape(batch, grid) / nr
+        weights = np.repeat(np.cos(np.radians(self._lat)), self._shape[-1])
+
+        d_matrix = np.empty((batch, nr, nr))
+        for bb in range(batch):
+            weights_bb = np.where(finite[bb], weights, 0.)
+            weights_bb /= weights_bb.sum()  # normalize (!)
+            gram = np.zeros((nr, nr))
+            for chunk in self._chunks(data[:, bb], mean[bb], finite[bb], weights_bb):
+                gram += chunk @ chunk.T
+
+            norms = np.diag(gram).copy()
+            norms_sum = norms[:, np.newaxis] + norms[np.newaxis, :]
+            d_matrix_bb = norms_sum - 2 * gram
+
+            if compensated:
+                idx_i, idx_j = np.where(np.triu(d_matrix_bb < tolerance * norms_sum, k=1))
+                nr_pairs = max(1, 2**22 // self.chunk_size)  # limit the memory
+                diff = np.zeros(len(idx_i))
+                for chunk in (self._chunks(data[:, bb], mean[bb], finite[bb], weights_bb)
+                              if len(idx_i) > 0 else []):
+                    for start in range(0, len(idx_i), nr_pairs):
+                        ii, jj = idx_i[start:start+nr_pairs], idx_j[start:start+nr_pairs]
+                        diff[start:start+nr_pairs] += np.sum((chunk[ii] - chunk[jj])**2, axis=-1)
+                d_matrix_bb[idx_i, idx_j] = diff
+                d_matrix_bb[idx_j, idx_i] = diff
+
+            d_matrix[bb] = np.sqrt(np.maximum(d_matrix_bb, 0.))
+            np.fill_diagonal(d_matrix[bb], np.nan)
+
+        del data
+        self._file.close()
+        self._file = None
+        logger.debug(f'Finalized distances of {nr} models ({batch} x {grid} grid points)')
+
+        return xr.DataArray(
+            d_matrix.reshape(self._shape[:-2] + (nr, nr)),
+            dims=self._dims + ('perfect_model_ensemble', 'model_ensemble'),
+            coords={**self._coords, 'model_ensemble': self.model_ensemble})
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS distances (
+    key TEXT NOT NULL,
+    model_1 TEXT NOT NULL,
+    model_2 TEXT NOT NULL,
+    distance REAL,
+    PRIMARY KEY (key, model_1, model_2)
+);
+"""
+
+OBS = ''  # model_2 of the distances to the observations
+
+
+def mask_hash(mask):
+    """A short hash of a (boolean) mask of grid points."""
+    mask = np.asarray(mask, dtype=bool)
+    return hashlib.sha1(str(mask.shape).encode() + mask.tobytes()).hexdigest()
+
+
+def select_rows(found):
+    """
+    Select models such that re-calculating their rows (and columns) fills
+    all missing distances (greedy, models with most missing distances first).
+
+    Parameters
+    ----------
+    found : ndarray, shape (N, N)
+        Symmetric, True for all distances which are available.
+
+    Returns
+    -------
+    rows : list of int
+    """
+    missing = ~np.asarray(found, dtype=bool)
+    np.fill_diagonal(missing, False)
+    rows = []
+    while missing.any():
+        row = int(missing.sum(axis=1).argmax())
+        rows.append(row)
+        missing[row, :] = False
+        missing[:, row] = False
+    return rows
+
+
+class DistanceStore:
+    """
+    A persistent store of the distances of each pair of models (and of each
+    model to the observations) for different diagnostics.
+
+    Parameters
+    ----------
+    path : str
+        Path of the SQLite file (created if it does not exist).
+
+    Notes
+    -----
+    Distances are identified by a key (which should contain all settings
+    of the diagnostic, see utils.parameter_key) and the model_ensemble
+    identifiers. The distance matrices depend on the grid points which are
+    valid for all models, therefore a hash of this mask is part of the key
+    of the model-model distances (see mask_key). If the mask changes (e.g.,
+    because a new model has missing values where all others have not) the
+    distances are calculated again and stored in addition to the ones of
+    the previous mask. If the data of an existing model change the store has
+    to be deleted.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as con:
+            con.executescript(SCHEMA)
+
+    def _connect(self):
+        # several configurations might be run in parallel (see run_all.py)
+        return sqlite3.connect(self.path, timeout=600)
+
+    @staticmethod
+    def mask_key(key, mask=None):
+        """The key of the distances of the given key and mask."""
+        return key if mask is None else f'{key}_{mask}'
+
+    def _read(self, key, mask=None):
+        with self._connect() as con:
+            return con.execute(
+                'SELECT model_1, model_2, distance FROM distances WHERE key = ?',
+                (self.mask_key(key, mask),)).fetchall()
+
+    def read_matrix(self, key, model_ensembles, mask=None):
+        """
+        Read the distance matrix of the given models.
+
+        Parameters
+        ----------
+        key : str
+        model_ensembles : list of str, shape (N,)
+        mask : str, optional
+            See mask_hash. Only distances calculated with the same mask are
+            returned.
+
+        Returns
+        -------
+        d_matrix : ndarray, shape (N, N)
+            NaN on the diagonal and for distances which are not found.
+        found : ndarray of bool, shape (N, N)
+        """
+        index = {model_ensemble: idx for idx, model_ensemble in enumerate(model_ensembles)}
+        d_matrix = np.full((len(index), len(index)), np.nan)
+        found = np.zeros(d_matrix.shape, dtype=bool)
+        np.fill_diagonal(found, True)
+        for model_1, model_2, distance in self._read(key, mask):
+            if model_1 in index and model_2 in index:
+                ii, jj = index[model_1], index[model_2]
+                d_matrix[ii, jj] = d_matrix[jj, ii] = np.nan if distance is None else distance
+                found[ii, jj] = found[jj, ii] = True
+        return d_matrix, found
+
+    def write_matrix(self, key, model_ensembles, d_matrix, rows=None, mask=None):
+        """
+        Write (the given rows of) a distance matrix.
+
+        Parameters
+        ----------
+        key : str
+        model_ensembles : list of str, shape (N,)
+        d_matrix : ndarray, shape (N, N)
+        rows : list of int, optional
+            Only write the distances of these models (to all others).
+        mask : str, optional
+            See mask_hash. Distances of other masks are kept.
+        """
+        nr = len(model_ensembles)
+        if rows is None:
+            rows = range(nr)
+        pairs = {(min(ii, jj), max(ii, jj)) for ii in rows for jj in range(nr) if ii != jj}
+        key = self.mask_key(key, mask)
+        with self._connect() as con:
+            con.executemany(
+                'INSERT OR REPLACE INTO distances VALUES (?, ?, ?, ?)',
+                [(key, model_ensembles[ii], model_ensembles[jj],
+                  None if np.isnan(d_matrix[ii, jj]) else float(d_matrix[ii, jj]))
+                 for ii, jj in sorted(pairs)])
+        logger.debug(f'Stored {len(pairs)} distances')
+
+    def read_obs(self, key, model_ensembles):
+        """
+        Read the distances of the given models to the observations.
+
+        Returns
+        -------
+        distances : ndarray, shape (N,)
+            NaN for distances which are not found.
+        found : ndarray of bool, shape (N,)
+        """
+        index = {model_ensemble: idx for idx, model_ensemble in enumerate(model_ensembles)}
+        distances = np.full(len(index), np.nan)
+        found = np.zeros(len(index), dtype=bool)
+        for model_1, model_2, distance in self._read(key):
+            if model_2 == OBS and model_1 in index:
+                distances[index[model_1]] = np.nan if distance is None else distance
+                found[index[model_1]] = True
+        return distances, found
+
+    def write_obs(self, key, model_ensembles, distances):
+        """Write the distances of the given models to the observations."""
+        with self._connect() as con:
+            con.executemany(
+                'INSERT OR REPLACE INTO distances VALUES (?, ?, ?, ?)',
+                [(key, model_ensemble, OBS, None if np.isnan(distance) else float(distance))
+                 for model_ensemble, distance in zip(model_ensembles, distances)])
+        logger.debug(f'Stored {len(model_ensembles)} distances to the observations')
@@ -36,6 +36,9 @@ import warnings
 import numpy as np
 from natsort import natsorted, ns
 
+from .diagnostic_graph import expand_diagnostic
+from .catalog import is_indexed, query_catalog
+
 logger = logging.getLogger(__name__)
 
 
@@ -45,24 +48,29 @@ def get_model_from_filename(filename, id_):
     return f'{parts[2]}_{parts[4]}_{id_}'
 
 
-def cmip6_test_hist(filenames, scenario):
+def cmip6_test_hist(filenames, scenario, histfiles=None):
     """For CMIP6 we currently need to check if the historical file for a given
-    scenario already exists as it is needed for merging in 'diagnostics.py'"""
+    scenario already exists as it is needed for merging in 'diagnostics.py'.
+    If histfiles (a set of existing historical files) is given it is used
+    instead of checking each file on disk."""
     if scenario == 'historical':  # no need to check if scenario is historical
         return filenames
 
     del_files = []
     for filename in filenames:
         histfile = filename.replace(scenario, 'historical')
-        if not os.path.isfile(histfile):
+        if histfiles is not None:
+            if histfile not in histfiles:
+                del_files.append(filename)
+        elif not os.path.isfile(histfile):
             del_files.append(filename)
     for del_file in del_files:
         filenames.remove(del_file)
     return filenames
 
 
-def get_filenames_var(varn, id_, scenario, base_path):
-    """Get all filenames matching the set criteria."""
+def get_filename_pattern(varn, id_, scenario):
+    """Return the glob pattern of a variable and scenario in an archive."""
     if id_ == 'CMIP6':
         filename_pattern = f'{varn}/mon/g025/{varn}_mon_*_{scenario}_*_g025.nc'
     elif id_ == 'CMIP5':
@@ -73,11 +81,27 @@ def get_filenames_var(varn, id_, scenario, base_path):
         filename_pattern = f'{varn}_mon_*_{scenario}_*_g025.nc'
     else:
         raise ValueError(f'{id_} is not a valid model_id')
-    fullpath = os.path.join(base_path, filename_pattern)
-    filenames = glob.glob(fullpath)
+    return filename_pattern
 
-    if id_ == 'CMIP6':
-        filenames = cmip6_test_hist(filenames, scenario)
+
+def get_filenames_var(varn, id_, scenario, base_path, catalog=None):
+    """Get all filenames matching the set criteria.
+
+    If catalog is given and contains the archive, the files are looked up in
+    the catalog, otherwise the archive is scanned."""
+    if is_indexed(catalog, base_path, id_):
+        filenames = query_catalog(catalog, varn, id_, scenario, base_path)
+        if id_ == 'CMIP6':
+            histfiles = set(query_catalog(catalog, varn, id_, 'historical', base_path))
+            filenames = cmip6_test_hist(filenames, scenario, histfiles)
+    else:
+        if catalog is not None:
+            logger.warning(f'{base_path} ({id_}) not in catalog {catalog}, falling back to glob')
+        fullpath = os.path.join(base_path, get_filename_pattern(varn, id_, scenario))
+        filenames = glob.glob(fullpath)
+
+        if id_ == 'CMIP6':
+            filenames = cmip6_test_hist(filenames, scenario)
 
     assert len(filenames) != 0, f'no models found for {varn}, {id_}, {scenario}'
     return {get_model_from_filename(fn, id_): fn for fn in filenames}
@@ -91,7 +115,7 @@ def get_filenames_variants(filenames, unique_models):
     return filenames
 
 
-def select_variants(common_model_ensembles, variants_use, variants_select):
+def select_variants(common_model_ensembles, variants_use, variants_select, rng=None):
     """
     Select the given number of variants of the same model (if avaliable).
 
@@ -115,6 +139,9 @@ def select_variants(common_model_ensembles, variants_use, variants_select):
         * random: Do not sort but pick random members. This can be used for
           bootstrapping of model variants:
           [r24i*, r7i*, r13i*, ...]
+    rng : numpy.random.Generator, optional
+        Random number generator used if variants_select is 'random'. If None
+        the global numpy random state is used.
 
     Returns
     -------
@@ -133,7 +160,10 @@ def select_variants(common_model_ensembles, variants_use, variants_select):
     elif variants_select == 'natsorted':
         common_model_ensembles = natsorted(common_model_ensembles)
     elif variants_select == 'random':
-        np.random.shuffle(common_model_ensembles)
+        if rng is None:
+            np.random.shuffle(common_model_ensembles)
+        else:
+            rng.shuffle(common_model_ensembles)
 
     selected_models = []
     selected_model_ensembles = []
@@ -153,7 +183,7 @@ def select_variants(common_model_ensembles, variants_use, variants_select):
             natsorted(natsorted(selected_model_ensembles, alg=ns.IC), key=lambda x: x.split('_')[2]))
 
 
-def get_filenames(cfg):
+def get_filenames(cfg, cache=None):
     """
     Collects all filenames matching the set criteria.
 
@@ -164,6 +194,9 @@ def get_filenames(cfg):
     Parameters
     ----------
     cfg : config object
+    cache : dict, optional
+        If given the files found for each variable and archive are stored in
+        (and re-used from) cache, e.g., when running several configurations.
 
     Returns
     -------
@@ -182,22 +215,14 @@ def get_filenames(cfg):
     # get basic variables for diagnostics
     varns = []
     if cfg.performance_diagnostics is not None:
-        for varn in cfg.performance_diagnostics:
-            if isinstance(varn, dict):  # multi-variable diagnostic
-                varns.append([*varn.values()][0][0])
-                varns.append([*varn.values()][0][1])
-            else:
-                varns.append(varn)
+        for diagn in cfg.performance_diagnostics:
+            varns += expand_diagnostic(diagn)[1]
     if cfg.independence_diagnostics is not None:
-        for varn in cfg.independence_diagnostics:
-            if isinstance(varn, dict):
-                varns.append([*varn.values()][0][0])
-                varns.append([*varn.values()][0][1])
-            else:
-                varns.append(varn)
+        for diagn in cfg.independence_diagnostics:
+            varns += expand_diagnostic(diagn)[1]
     if cfg.target_diagnostic is not None:
         # only if sigmas are None we need to calculate the target
-        varns += [cfg.target_diagnostic]
+        varns += expand_diagnostic(cfg.target_diagnostic)[1]
 
     varns = np.unique(varns)  # we need each variable only once
 
@@ -208,7 +233,14 @@ def get_filenames(cfg):
     for varn in varns:  # get all files for all variables first
         filenames[varn] = {}
         for id_, scenario, base_path in zip(cfg.model_id, cfg.model_scenario, cfg.model_path):
-            filenames[varn].update(get_filenames_var(varn, id_, scenario, base_path))
+            key = (varn, id_, scenario, base_path)
+            if cache is None or key not in cache:
+                filenames_var = get_filenames_var(varn, id_, scenario, base_path, cfg.catalog)
+                if cache is not None:
+                    cache[key] = filenames_var
+            else:
+                filenames_var = cache[key]
+            filenames[varn].update(filenames_var)
 
         try:
             common_model_ensembles = list(
@@ -236,10 +268,16 @@ def get_filenames(cfg):
         for delete_model in delete_models:
             common_model_ensembles.remove(delete_model)
 
+    if cfg.variants_bootstrap is not None:
+        # all variants are needed, they are re-sampled later (see calc_bootstrap)
+        variants_use = 'all'
+    else:
+        variants_use = cfg.variants_use
+    rng = None if cfg.variants_seed is None else np.random.default_rng(cfg.variants_seed)
     selected_models, selected_model_ensembles = select_variants(
-        common_model_ensembles, cfg.variants_use, cfg.variants_select)
+        common_model_ensembles, variants_use, cfg.variants_select, rng)
 
-    if cfg.variants_use != 'all':
+    if variants_use != 'all':
         filenames = get_filenames_variants(filenames, selected_model_ensembles)
 
     logger.info(f'{len(selected_models)} models found')
@@ -31,6 +31,7 @@ for more information.
 """
 import numpy as np
 
+from . import utils_xarray
 from .utils_xarray import quantile
 
 
@@ -123,3 +124,36 @@ def perfect_model_test(data, weights_sigmas, perc_lower, perc_upper):
     # assert not np.any(np.isclose(tmp[..., 1] - tmp[..., 0], 0, atol=1.e-7)), errmsg
     inside = (tmp[..., 0] <= data) & (data <= tmp[..., 1])
     return inside.sum(axis=-1) / float(inside.shape[-1])
+
+
+def perfect_model_test_batched(data, weights_sigmas, perc_lower, perc_upper):
+    """Same as perfect_model_test but without looping over the weights.
+
+    Uses utils_xarray.weighted_quantile (values with zero weight are ignored,
+    tied values keep their order).
+
+    Parameters
+    ----------
+    data : array_like, shape (M,) or (K, M)
+        Array of data (for each of K subsets of models).
+    weights_sigmas : array_like, shape (..., M, M) or (K, ..., M, M)
+        Array of weights (see perfect_model_test) (for each of K subsets).
+    perc_lower : float
+        Has to be in [0, 1] and < perc_upper
+    perc_upper : float
+        Has to be in [0, 1] and > perc_lower
+
+    Returns
+    -------
+    inside_ratio : ndarray, shape (...) or (K, ...)
+    """
+    data = np.asarray(data)
+    weights_sigmas = np.asarray(weights_sigmas)
+    # align the subset dimension of data with the one of weights_sigmas
+    data = data.reshape(
+        data.shape[:-1] + (1,) * (weights_sigmas.ndim - data.ndim - 1) + data.shape[-1:])
+    tmp = utils_xarray.weighted_quantile(
+        data[..., None, :], weights_sigmas, (perc_lower, perc_upper))
+    assert np.all(tmp[..., 0] <= tmp[..., 1])
+    inside = (tmp[..., 0] <= data) & (data <= tmp[..., 1])
+    return inside.sum(axis=-1) / float(inside.shape[-1])
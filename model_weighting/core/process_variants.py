@@ -11,10 +11,10 @@ Abstract:
 
 """
 import logging
+import warnings
 import numpy as np
 import xarray as xr
-from copy import copy
-from natsort import natsorted
+from natsort import natsorted, index_natsorted
 
 logger = logging.getLogger(__name__)
 
@@ -33,25 +33,65 @@ def get_model_variants(model_ensemble):
         Each sub-list contains all variants of the same model ordered by
         natsort. If there is only one variant per model M=N otherwise M<N.
     """
-    models = np.array(['_'.join([me.split('_')[0], me.split('_')[2]])
-                       for me in model_ensemble])
-    model_ensemble_nested = []
-    for model in natsorted(np.unique(models)):
-        idx = np.where(models == model)[0]
-        model_ensemble_nested.append(natsorted(np.array(model_ensemble)[idx]))
-    return model_ensemble_nested
+    order, counts, _ = group_variants(model_ensemble)
+    model_ensemble = np.asarray(model_ensemble)[order]
+    return [list(me) for me in np.split(model_ensemble, np.cumsum(counts)[:-1])]
 
 
-def _tile(data, reps=None):
-    """Tile means to fill into each variant."""
-    return np.tile(data, (reps, 1))
+def group_variants(model_ensemble):
+    """
+    Group index of the variants of each model (see get_model_variants).
+
+    Parameters
+    ----------
+    model_ensemble : array-like, shape (N,)
+
+    Returns
+    -------
+    order : ndarray of int, shape (N,)
+        Indices which sort model_ensemble by model, i.e., model_ensemble[order]
+        are the variants of all models in the order of get_model_variants.
+    counts : ndarray of int, shape (M,)
+        Number of variants of each model.
+    model_ids : ndarray of str, shape (M,)
+        The identifier of each model: <model>_<nr variants>_<id> for models
+        with more than one variant, the model_ensemble otherwise.
+    """
+    model_ensemble = np.asarray(model_ensemble)
+    groups = {}
+    for idx, me in enumerate(model_ensemble):
+        model, _, id_ = me.split('_')[:3]
+        groups.setdefault(f'{model}_{id_}', []).append(idx)
+
+    order, counts, model_ids = [], [], []
+    for model in natsorted(groups):
+        idx = np.array(groups[model])
+        idx = idx[index_natsorted(model_ensemble[idx])]
+        order.append(idx)
+        counts.append(len(idx))
+        if len(idx) == 1:
+            model_ids.append(model_ensemble[idx[0]])
+        else:
+            first = model_ensemble[idx[0]].split('_')
+            model_ids.append('_'.join([first[0], str(len(idx)), first[2]]))
+    return np.concatenate(order), np.array(counts), np.array(model_ids)
+
+
+def _group_mean(data, counts, axis=0):
+    """NaN-ignoring mean over consecutive groups of counts elements along axis."""
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    valid = ~np.isnan(data)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (np.add.reduceat(np.where(valid, data, 0.), starts, axis=axis) /
+                np.add.reduceat(valid.astype(int), starts, axis=axis))
 
 
-def _set_diagonal(data):
-    """Set the diagonal elements to nan again"""
-    data = copy(data)  # the original array is write-protected
-    np.fill_diagonal(data, np.nan)  # NOTE: this works in place!
-    return data
+def _group_std(data, counts, axis=0, mean=None):
+    """NaN-ignoring standard deviation over consecutive groups (see _group_mean)."""
+    if mean is None:
+        mean = _group_mean(data, counts, axis)
+    return np.sqrt(_group_mean(
+        (data - np.repeat(mean, counts, axis=axis))**2, counts, axis))
 
 
 # NOTE: this function is not used in the current implementation
@@ -170,9 +210,11 @@ def spread_to_weight(ratios, metric='logistic', **kwargs):
         raise ValueError
 
 
-def _mean(data, weights):
-    """Weighted average of diagnostics."""
-    return np.average(data, weights=weights)
+def _mean(da, weights):
+    """Weighted average over the diagnostic dimension (same as np.average)."""
+    if not isinstance(weights, xr.DataArray):
+        weights = xr.DataArray(weights, dims='diagnostic')
+    return (da * weights).sum('diagnostic', skipna=False) / weights.sum('diagnostic')
 
 
 def independence_sigma_from_variants(delta_i, delta_i_temp, model_ensemble_nested):
@@ -260,76 +302,66 @@ def process_variants(da, cfg):
     # make sure they are normalized
     diagnostic_weights_user = diagnostic_weights_user / diagnostic_weights_user.sum()
 
-    model_ensemble_nested = get_model_variants(da['model_ensemble'].data)
+    order, counts, model_ids = group_variants(da['model_ensemble'].data)
 
-    if (np.all([len(me) == 1 for me in model_ensemble_nested]) or
-        not cfg.variants_combine):
+    if np.all(counts == 1) or not cfg.variants_combine:
         if len(da['diagnostic']) > 1:
-            delta_i = xr.apply_ufunc(
-                _mean, da, diagnostic_weights_user,
-                input_core_dims=[['diagnostic'], ['diagnostic']],
-                vectorize=True)
+            delta_i = _mean(da, diagnostic_weights_user)
         else:
             delta_i = da.squeeze()
         delta_i.name = 'delta_i'
 
         return delta_i, None, da
 
-    variants_std = []
-    da_list = []
-    for model_ensemble in model_ensemble_nested:
-        if len(model_ensemble) == 1:
-            da_list.append(da.sel(model_ensemble=model_ensemble))
-            continue  # skip models with only one variant
-
-        # select all variants
-        da_sel = da.sel(model_ensemble=model_ensemble)
+    # sort all variants of the same model next to each other once and
+    # use segmented reductions for all models at once
+    dims = ['diagnostic', 'model_ensemble']
+    if inter_model:
+        dims.append('perfect_model_ensemble')
+    data = da.transpose(*dims).data[:, order]
+    multi = counts > 1  # models with more than one variant
 
-        # get mean and standard deviation over all variants of the same model
-        mean_ = da_sel.mean('model_ensemble', skipna=True)
-        std_ = da_sel.std('model_ensemble', skipna=True)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)  # all-nan slices
 
+        # mean and standard deviation over all variants of the same model
+        data_mean = _group_mean(data, counts, axis=1)
+        std_ = _group_std(data, counts, axis=1, mean=data_mean)[:, multi]
         if inter_model:
             # If there are only two model variants they have only one non-nan value
             # in the perfect model setting since the other one is from the model
             # to itself and had been set to nan in the distance matrix!
             # In this case we can not use the standard deviation
-            std_.data[std_.data == 0.] = np.nan
-
-        model_id = '_'.join([
-            model_ensemble[0].split('_')[0],
-            str(len(model_ensemble)),
-            model_ensemble[0].split('_')[2]])
-        da_list.append(mean_.expand_dims({'model_ensemble': [model_id]}))
-        variants_std.append(std_.expand_dims({'model_ensemble': [model_id]}))
-
-    da_mean = xr.concat(da_list, dim='model_ensemble')
-    variant_std = xr.concat(variants_std, dim='model_ensemble').mean('model_ensemble')
-    model_std = da_mean.std('model_ensemble')
-
-    if inter_model:  # do the same for the perfect model dimension
-        # this still contains all variant in the perfect model dimension for the sigma_i calculation
-        da_mean_temp = da_mean.copy()
-        da_list = []
-        variants_std = []
-        for model_ensemble in model_ensemble_nested:
-            if len(model_ensemble) == 1:
-                da_list.append(da_mean.sel(perfect_model_ensemble=model_ensemble))
-                continue  # skip models with only one variant
-            da_sel = da_mean.sel(perfect_model_ensemble=model_ensemble)
-            da_std_sel = variant_std.sel(perfect_model_ensemble=model_ensemble)
-            mean_ = da_sel.mean('perfect_model_ensemble', skipna=True)
-            std_ = da_std_sel.mean('perfect_model_ensemble', skipna=True)
-            model_id = '_'.join([
-                model_ensemble[0].split('_')[0],
-                str(len(model_ensemble)),
-                model_ensemble[0].split('_')[2]])
-            da_list.append(mean_.expand_dims({'perfect_model_ensemble': [model_id]}))
-            variants_std.append(std_.expand_dims({'perfect_model_ensemble': [model_id]}))
-
-        da_mean = xr.concat(da_list, dim='perfect_model_ensemble')
-        variant_std = xr.concat(variants_std, dim='perfect_model_ensemble').mean('perfect_model_ensemble')
-        model_std = da_mean.std('model_ensemble').mean('perfect_model_ensemble')
+            std_[std_ == 0.] = np.nan
+        variant_std = np.nanmean(std_, axis=1)
+        model_std = np.nanstd(data_mean, axis=1)
+
+        perfect_ids = None
+        if inter_model:  # do the same for the perfect model dimension
+            # this still contains all variant in the perfect model dimension for the sigma_i calculation
+            da_mean_temp = xr.DataArray(
+                data_mean, dims=dims, coords={
+                    'diagnostic': da['diagnostic'], 'model_ensemble': model_ids,
+                    'perfect_model_ensemble': da['perfect_model_ensemble']})
+
+            perfect_order, perfect_counts, perfect_ids = group_variants(
+                da['perfect_model_ensemble'].data)
+            data_mean = _group_mean(data_mean[..., perfect_order], perfect_counts, axis=2)
+            variant_std = _group_mean(variant_std[:, perfect_order], perfect_counts, axis=1)
+            variant_std = np.nanmean(variant_std[:, perfect_counts > 1], axis=1)
+            model_std = np.nanmean(np.nanstd(data_mean, axis=1), axis=1)
+
+    # sort the models (and perfect models) the same way
+    idx_sort = index_natsorted(model_ids)
+    model_ensemble = model_ids[idx_sort]
+    data_mean = data_mean[:, idx_sort]
+    coords = {'diagnostic': da['diagnostic'], 'model_ensemble': model_ensemble}
+    if inter_model:
+        data_mean = data_mean[:, :, index_natsorted(perfect_ids)]
+        coords['perfect_model_ensemble'] = natsorted(perfect_ids)
+    da_mean = xr.DataArray(data_mean, dims=dims, coords=coords)
+    variant_std = xr.DataArray(variant_std, dims='diagnostic', coords={'diagnostic': da['diagnostic']})
+    model_std = xr.DataArray(model_std, dims='diagnostic', coords={'diagnostic': da['diagnostic']})
 
     # NOTE: this is not used in the current implementation
     # the spread ratio is an estimate of the quality of a predictor; the larger it is
@@ -345,41 +377,24 @@ def process_variants(da, cfg):
     diagnostic_weights = diagnostic_weights / diagnostic_weights.sum('diagnostic')
 
     if len(da_mean['diagnostic']) > 1:
-        diagnostic = xr.apply_ufunc(
-            _mean, da_mean, diagnostic_weights,
-            input_core_dims=[['diagnostic'], ['diagnostic']],
-            vectorize=True)
+        diagnostic = _mean(da_mean, diagnostic_weights)
     else:
         diagnostic = da_mean.squeeze()
 
-    model_ensemble = natsorted(diagnostic['model_ensemble'].data)
-    diagnostic = diagnostic.sel(model_ensemble=model_ensemble)
-    da_mean = da_mean.sel(model_ensemble=model_ensemble)
     if inter_model:
-        # make sure they are sorted the same way
-        diagnostic = diagnostic.sel(perfect_model_ensemble=model_ensemble)
-        da_mean = da_mean.sel(perfect_model_ensemble=model_ensemble)
         # set the diagonal elements to nan again (have been overwritten by mean)
-        diagnostic = xr.apply_ufunc(
-            _set_diagonal, diagnostic,
-            input_core_dims=[['model_ensemble', 'perfect_model_ensemble']],
-            output_core_dims=[['model_ensemble', 'perfect_model_ensemble']],
-            vectorize=True)
-
-        da_mean = xr.apply_ufunc(
-            _set_diagonal, da_mean,
-            input_core_dims=[['model_ensemble', 'perfect_model_ensemble']],
-            output_core_dims=[['model_ensemble', 'perfect_model_ensemble']],
-            vectorize=True)
+        diagnostic = diagnostic.transpose(..., 'model_ensemble', 'perfect_model_ensemble').copy()
+        da_mean = da_mean.transpose(..., 'model_ensemble', 'perfect_model_ensemble')
+        idx = np.arange(len(model_ensemble))
+        diagnostic.data[..., idx, idx] = np.nan
+        da_mean.data[..., idx, idx] = np.nan
 
         if cfg.variants_independence:
             if len(da_mean['diagnostic']) > 1:
-                diagnostic_temp = xr.apply_ufunc(
-                    _mean, da_mean_temp, diagnostic_weights,
-                    input_core_dims=[['diagnostic'], ['diagnostic']],
-                    vectorize=True)
+                diagnostic_temp = _mean(da_mean_temp, diagnostic_weights)
             else:
                 diagnostic_temp = da_mean_temp.squeeze()
+            model_ensemble_nested = get_model_variants(da['model_ensemble'].data)
             sigma_i = independence_sigma_from_variants(diagnostic, diagnostic_temp, model_ensemble_nested)
         else:
             sigma_i = None
@@ -427,28 +442,22 @@ def process_variants_target(da, cfg):
         An array where all models with more than one variant are reduced
         to the respective mean value.
     """
-    model_ensemble_nested = get_model_variants(da['model_ensemble'].data)
+    order, counts, model_ids = group_variants(da['model_ensemble'].data)
 
-    if np.all([len(me) == 1 for me in model_ensemble_nested]) or not cfg.variants_combine:
+    if np.all(counts == 1) or not cfg.variants_combine:
         return da
 
-    da_list = []
-    for model_ensemble in model_ensemble_nested:
-        if len(model_ensemble) == 1:
-            da_list.append(da.sel(model_ensemble=model_ensemble))
-            continue  # skip models with only one variant
-
-        da_sel = da.sel(model_ensemble=model_ensemble)
-        mean_ = da_sel.mean('model_ensemble', skipna=True)
-        model_id = '_'.join([
-            model_ensemble[0].split('_')[0],
-            str(len(model_ensemble)),
-            model_ensemble[0].split('_')[2]])
-        da_list.append(mean_.expand_dims({'model_ensemble': [model_id]}))
+    axis = da.get_axis_num('model_ensemble')
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)  # all-nan slices
+        data = _group_mean(np.take(da.data, order, axis=axis), counts, axis=axis).astype(da.dtype)
 
-    da_mean = xr.concat(da_list, dim='model_ensemble')
-    da_mean = da_mean.sel(model_ensemble=natsorted(da_mean['model_ensemble'].data))
-    return da_mean
+    idx_sort = index_natsorted(model_ids)
+    coords = {key: coord for key, coord in da.coords.items() if 'model_ensemble' not in coord.dims}
+    coords['model_ensemble'] = model_ids[idx_sort]
+    return xr.DataArray(
+        np.take(data, idx_sort, axis=axis), dims=da.dims, coords=coords,
+        attrs=da.attrs, name=da.name)
 
 
 def expand_variants(ds, model_ensemble):
@@ -490,6 +499,7 @@ def expand_variants(ds, model_ensemble):
 
     ds_expanded = xr.merge(da_list)
     ds_expanded['weights'].data /= ds_expanded['variant_count'].data
-    ds_expanded['weights'].data /= ds_expanded['weights'].sum('model_ensemble').data
+    weights = ds_expanded['weights'] / ds_expanded['weights'].sum('model_ensemble')
+    ds_expanded['weights'].data = weights.transpose(*ds_expanded['weights'].dims).data
     ds = ds.rename({'model_ensemble': 'model', 'perfect_model_ensemble': 'perfect_model'})
     return xr.merge([ds, ds_expanded])
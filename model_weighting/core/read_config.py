@@ -15,6 +15,7 @@ import logging
 import numpy as np
 
 from core import utils
+from core.diagnostics import ALL_REGIONS
 
 logger = logging.getLogger(__name__)
 
@@ -24,18 +25,29 @@ types = {
     'variants_select': str,
     'variants_independence': bool,
     'variants_combine': bool,
+    'variants_bootstrap': (int, type(None)),
+    'variants_seed': (int, type(None)),
+    'catalog': (str, type(None)),
+    'distance_store': (str, type(None)),
+    'series_store': (str, type(None)),
     'idx_lats': (int, type(None)),
     'idx_lons': (int, type(None)),
     'inside_ratio': (float, str, type(None)),
     'overwrite': bool,
     'percentiles': float,
     'performance_metric': str,
+    'precision': (str, type(None)),
     'plot_path': (str, type(None)),
     'plot': bool,
     'subset': (str, type(None)),
+    'subset_samples': (int, type(None)),
+    'subset_size': (int, type(None)),
+    'subset_seed': (int, type(None)),
     'save_path': str,
     'sigma_i': (int, float, type(None)),
     'sigma_q': (int, float, type(None)),
+    'stream_distances': bool,
+    'region_cells': bool,
 
     # --- data ---
     'model_path': str,
@@ -81,18 +93,27 @@ types = {
 
 values = {
     # --- other parameters ---
+    'catalog': None,
+    'distance_store': None,
+    'series_store': None,
     'idx_lats': None,
     'idx_lons': None,
     'inside_ratio': None,  # TODO
     'overwrite': [True, False],
     'percentiles': None,
     'performance_metric': ['RMSE'],
+    'precision': [None, 'float32', 'float64'],
     'plot_path': None,  # TODO: writable
     'plot': [True, False],
     'subset': None,
+    'subset_samples': None,
+    'subset_size': None,
+    'subset_seed': None,
     'save_path': None,  # TODO: writable
     'sigma_i': None,
     'sigma_q': None,
+    'stream_distances': [True, False],
+    'region_cells': [True, False],
 
     # --- data ---
     'model_path': None,  # TODO: exists
@@ -102,6 +123,8 @@ values = {
     'variants_select': ['sorted', 'natsorted', 'random'],
     'variants_independence': [True, False],
     'variants_combine': [True, False],
+    'variants_bootstrap': None,
+    'variants_seed': None,
     'obs_path': None,  # TODO: None or exists
     'obs_id': None,
     'obs_uncertainty': [None, 'range', 'mean', 'median', 'center'],
@@ -189,6 +212,56 @@ def set_default_values(cfg):
     except AttributeError:
         cfg.subset = None
 
+    try:
+        cfg.subset_samples
+    except AttributeError:
+        cfg.subset_samples = None
+
+    try:
+        cfg.subset_size
+    except AttributeError:
+        cfg.subset_size = None
+
+    try:
+        cfg.subset_seed
+    except AttributeError:
+        cfg.subset_seed = None
+
+    try:
+        cfg.variants_bootstrap
+    except AttributeError:
+        cfg.variants_bootstrap = None
+
+    try:
+        cfg.variants_seed
+    except AttributeError:
+        cfg.variants_seed = None
+
+    try:
+        cfg.catalog
+    except AttributeError:
+        cfg.catalog = None
+
+    try:
+        cfg.stream_distances
+    except AttributeError:
+        cfg.stream_distances = False
+
+    try:
+        cfg.distance_store
+    except AttributeError:
+        cfg.distance_store = None
+
+    try:
+        cfg.region_cells
+    except AttributeError:
+        cfg.region_cells = False
+
+    try:
+        cfg.series_store
+    except AttributeError:
+        cfg.series_store = None
+
     try:
         cfg.idx_lats
     except AttributeError:
@@ -204,6 +277,11 @@ def set_default_values(cfg):
     except AttributeError:
         cfg.performance_metric = 'RMSE'
 
+    try:
+        cfg.precision
+    except AttributeError:
+        cfg.precision = None
+
     independence_parameters = [
         'independence_diagnostics',
         'independence_aggs',
@@ -226,22 +304,37 @@ def process_other_parameters(cfg):
         'variants_use',
         'variants_select',
         'variants_independence',
+        'variants_bootstrap',
         'idx_lats',
         'idx_lons',
         'inside_ratio',
         'overwrite',
         'percentiles',
         'performance_metric',
+        'precision',
         'plot_path',
         'plot',
         'subset',
+        'subset_samples',
         'save_path',
+        'distance_store',
     }
 
     for param in other_parameters:
         if param == 'variants_independence':
             if cfg['variants_independence'] and cfg['variants_use'] == 1:
                 raise ValueError('Can not use variants_independence without variants')
+        elif param == 'variants_bootstrap':
+            if cfg[param] is None:
+                continue
+            if cfg[param] < 1:
+                raise ValueError('variants_bootstrap has to be a positive integer')
+            if cfg['variants_use'] == 'all':
+                raise ValueError('variants_bootstrap needs variants_use to be an integer')
+            if cfg['subset_samples'] is not None:
+                raise ValueError('variants_bootstrap and subset_samples can not be combined')
+            if cfg['plot']:  # the plots would be overwritten by each realization
+                raise ValueError('variants_bootstrap and plot can not be combined')
         elif param == 'percentiles':
             if not np.all((value > 0) & (value < 1) for value in cfg[param]):
                 raise ValueError
@@ -259,6 +352,22 @@ def process_other_parameters(cfg):
             if not cfg[param] in ['RMSE']:
                 raise ValueError
 
+        elif param == 'precision':
+            if cfg[param] not in [None, 'float32', 'float64']:
+                raise ValueError(f'precision has to be float32 or float64 not {cfg[param]}')
+
+        elif param == 'subset_samples':
+            if cfg[param] is None:
+                continue
+            if cfg[param] < 1:
+                raise ValueError('subset_samples has to be a positive integer')
+            if cfg['subset_size'] is None or cfg['subset_size'] < 3:
+                raise ValueError('subset_size has to be set to at least 3 if subset_samples is set')
+            if cfg['obs_id'] is None or cfg['obs_path'] is None:
+                raise ValueError('subset_samples requires observations (obs_path and obs_id)')
+            if not cfg['variants_combine'] and cfg['variants_use'] != 1:
+                raise ValueError('subset_samples requires variants_combine=True or variants_use=1')
+
         elif param == 'plot_path':
             if cfg['plot']:
                 if cfg['plot_path'] is None:
@@ -266,6 +375,10 @@ def process_other_parameters(cfg):
                 if not os.access(cfg.plot_path, os.W_OK | os.X_OK):
                     raise ValueError('plot_path is not writable')
 
+        elif param == 'distance_store':
+            if cfg[param] is not None and cfg['stream_distances']:
+                raise ValueError('distance_store and stream_distances can not be combined')
+
         elif param == 'save_path':
             if not os.access(cfg.plot_path, os.W_OK | os.X_OK):
                 raise ValueError('save_path is not writable')
@@ -525,6 +638,40 @@ def check_perfect_model_test(cfg):
         raise ValueError(errmsg)
 
 
+def check_all_regions(cfg):
+    """
+    Set cfg.all_regions to the keyword of the batched all-regions mode (e.g.,
+    target_region = ALL_SREX) or to None and check if it can be used.
+
+    In this mode each field is only read once and reduced to all regions
+    which gives the weights for each region in one run.
+    """
+    regions = [cfg.target_region]
+    for kind in ['performance', 'independence']:
+        if cfg[f'{kind}_regions'] is None:
+            continue
+        for region, agg in zip(cfg[f'{kind}_regions'], cfg[f'{kind}_aggs']):
+            if region in ALL_REGIONS and agg == 'ANOM-LOCAL':
+                # the anomaly would be relative to the global mean
+                raise ValueError(f'ANOM-LOCAL can not be combined with {region}')
+            regions.append(region)
+    keywords = {region for region in regions
+                if isinstance(region, str) and region.startswith('ALL_')}
+    if len(keywords) == 0:
+        cfg.all_regions = None
+        return
+    if len(keywords) > 1 or not keywords.issubset(ALL_REGIONS):
+        raise ValueError(' '.join([
+            'All regions have to use the same keyword out of',
+            f'{", ".join(ALL_REGIONS)} not {", ".join(sorted(keywords))}']))
+    cfg.all_regions = keywords.pop()
+
+    for param in ['stream_distances', 'distance_store', 'variants_bootstrap',
+                  'subset_samples', 'idx_lats', 'idx_lons', 'plot']:
+        if cfg[param] is not None and cfg[param] is not False:
+            raise ValueError(f'{param} can not be combined with {cfg.all_regions}')
+
+
 def read_config(config, config_file):
     """Read a configuration from a configuration file.
 
@@ -552,5 +699,6 @@ def read_config(config, config_file):
     process_multi_vars(cfg)
     process_sigmas(cfg)
     check_perfect_model_test(cfg)
+    check_all_regions(cfg)
     utils.log_parser(cfg)
     return cfg
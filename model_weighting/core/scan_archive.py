@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2019 Lukas Brunner, ETH Zurich
+
+This file is part of ClimWIP.
+
+ClimWIP is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Authors
+-------
+- Lukas Brunner || lukas.brunner@env.ethz.ch
+
+Abstract
+--------
+A parallel scanner for the model archives. The directory tree given by the
+filename patterns in get_filenames is walked with os.scandir in a thread
+pool (one task per directory). If a catalog is given, the listing of each
+directory is cached together with its modification time and only
+directories whose modification time changed are listed again.
+"""
+import os
+import logging
+from fnmatch import fnmatch
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .catalog import read_dir_cache, write_dir_cache, update_catalog
+from .get_filenames import get_filename_pattern
+
+logger = logging.getLogger(__name__)
+
+
+def _scan_dir(path, patterns, cached=None):
+    """
+    List one directory.
+
+    Parameters
+    ----------
+    path : str
+    patterns : list of str
+        The remaining parts of the filename pattern (relative to path).
+    cached : tuple, optional
+        (mtime, subdirs, files) from a previous scan. Used if the directory
+        modification time did not change.
+
+    Returns
+    -------
+    path, mtime, subdirs, files, stats : str, float, list, list, dict
+        stats contains (size, mtime) of each file if the directory was
+        listed and is None if the cached listing was used.
+    """
+    mtime = os.stat(path).st_mtime
+    if cached is not None and cached[0] == mtime:
+        return path, mtime, cached[1], cached[2], None
+
+    subdirs, files, stats = [], [], {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith('.') or not fnmatch(entry.name, patterns[0]):
+                continue  # like glob, ignore hidden files
+            if len(patterns) > 1 and entry.is_dir():
+                subdirs.append(entry.path)
+            elif len(patterns) == 1 and entry.is_file():
+                stat = entry.stat()
+                files.append(entry.path)
+                stats[entry.path] = (stat.st_size, stat.st_mtime)
+    return path, mtime, subdirs, files, stats
+
+
+def scan_archive(base_path, pattern, catalog=None, max_workers=16):
+    """
+    Find all files matching a (glob) pattern using a thread pool.
+
+    Parameters
+    ----------
+    base_path : str
+    pattern : str
+        A pattern relative to base_path, see get_filename_pattern.
+    catalog : str, optional
+        If given use and update the directory listings cached in the catalog.
+    max_workers : int, optional
+        Number of threads.
+
+    Returns
+    -------
+    filenames : list of str
+        Same as glob.glob(os.path.join(base_path, pattern)).
+    stats : dict
+        (size, mtime) of all files in directories which were (re-)listed.
+    """
+    patterns = pattern.split('/')
+    cache = read_dir_cache(catalog, base_path)
+    new_cache, filenames, stats = {}, [], {}
+    nr_listed = 0
+
+    t0 = datetime.now()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        root = base_path.rstrip(os.sep) or os.sep
+        depth = {root: 0}
+        pending = {pool.submit(_scan_dir, root, patterns, cache.get(root))}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, mtime, subdirs, files, dir_stats = future.result()
+                new_cache[path] = (mtime, subdirs, files)
+                filenames += files
+                if dir_stats is not None:
+                    nr_listed += 1
+                    stats.update(dir_stats)
+                for subdir in subdirs:
+                    depth[subdir] = depth[path] + 1
+                    pending.add(pool.submit(
+                        _scan_dir, subdir, patterns[depth[subdir]:], cache.get(subdir)))
+    dt = (datetime.now() - t0).total_seconds()
+
+    logger.info(' '.join([
+        f'Scanned {base_path}: {len(new_cache)} directories ({nr_listed} listed),',
+        f'{len(filenames)} files in {dt:.2f}s ({len(filenames) / max(dt, 1e-6):.0f} files/s)']))
+
+    if catalog is not None:
+        write_dir_cache(catalog, base_path, new_cache)
+    return filenames, stats
+
+
+def index_archive(catalog, id_, base_path, read_time=True, max_workers=16):
+    """Add all files of an archive to the catalog (see core.catalog)."""
+    filenames, stats = scan_archive(
+        base_path, get_filename_pattern('*', id_, '*'), catalog, max_workers)
+    return update_catalog(catalog, filenames, base_path, id_,
+                          read_time=read_time, stats=stats)
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2020 Lukas Brunner, ETH Zurich
+
+This file is part of ClimWIP.
+
+ClimWIP is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Authors
+-------
+- Lukas Brunner || lukas.brunner@env.ethz.ch
+
+Abstract
+--------
+A persistent SQLite store of area-weighted monthly mean time series per
+input file, variable, region (GLOBAL, SREX regions, or region files), and
+land-sea mask. Each series is calculated from the full monthly field once
+and re-calculated only if the input file(s) change (size or modification
+time, same as in core.catalog).
+
+Scalar (regional mean) diagnostics of any time period and season are then
+calculated from the stored series without reading the model files. This is
+only possible for time aggregations which commute with the area-weighted
+mean (mean, trend, and anomaly to the global mean) and for models (which
+have no missing values, i.e., the same grid points are valid at each time
+step). The results are the same as the area-weighted mean of the gridded
+diagnostic (up to rounding errors).
+"""
+import os
+import sqlite3
+import logging
+import numpy as np
+
+from .diagnostics import ALL_REGIONS, read_basic_field, select_region
+from .diagnostic_graph import expand_diagnostic
+from .utils_xarray import area_weighted_mean, trend
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    infile TEXT NOT NULL,
+    varn TEXT NOT NULL,
+    region TEXT NOT NULL,
+    mask TEXT NOT NULL,
+    version TEXT NOT NULL,
+    units TEXT,
+    months BLOB NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (infile, varn, region, mask)
+);
+"""
+
+# time aggregations which commute with the area-weighted mean
+AGGS = ['CLIM', 'CLIM-MEAN', 'TREND', 'TREND-MEAN', 'ANOM-GLOBAL']
+
+# derived diagnostics which are linear combinations of their basic variables
+# (see diagnostic_graph.combine_fields)
+LINEAR = {
+    'dtr': (1., -1.),
+    'rnet': (1., -1., 1., -1.),
+}
+
+SEASONS = {
+    'JJA': (6, 7, 8),
+    'SON': (9, 10, 11),
+    'DJF': (12, 1, 2),
+    'MAM': (3, 4, 5),
+}
+
+
+def _key(value):
+    """Region or mask as string (see diagnostics.get_outfile)."""
+    if isinstance(value, (list, tuple)):
+        return '-'.join(value)
+    return str(value)
+
+
+def get_infiles(infile, id_=None):
+    """All files read for a basic variable (see diagnostics.read_basic_field)."""
+    if id_ == 'CMIP6':
+        scenario = infile.split('_')[-3]
+        if scenario != 'historical':
+            return [infile, infile.replace(scenario, 'historical')]
+    return [infile]
+
+
+def file_version(infile, id_=None):
+    """Size and modification time of all files read for a basic variable."""
+    stats = [os.stat(filename) for filename in get_infiles(infile, id_)]
+    return ';'.join(f'{stat.st_size}-{stat.st_mtime}' for stat in stats)
+
+
+def is_supported(diagn, time_aggregation=None, id_=None, time_period=None,
+                 region='GLOBAL', idx_lats=None, idx_lons=None, **kwargs):
+    """
+    Check if a diagnostic can be calculated from the store.
+
+    Parameters
+    ----------
+    diagn : str or dict
+        See diagnostic_graph.expand_diagnostic.
+    id_ : {'CMIP6', 'CMIP5', 'CMIP3', 'LE'}, optional
+        Observations (id_=None) can have missing values and are not supported.
+    See SeriesStore.diagnostic for all other parameters.
+
+    Returns
+    -------
+    supported : bool
+    """
+    key, varns = expand_diagnostic(diagn)
+    return (
+        id_ in ['CMIP6', 'CMIP5', 'CMIP3', 'LE'] and
+        time_aggregation in AGGS and
+        ((key,) == varns or len(LINEAR.get(key, ())) == len(varns)) and
+        idx_lats is None and idx_lons is None and
+        region not in ALL_REGIONS and
+        (time_period is None or all(str(year).isdigit() for year in time_period)))
+
+
+def season_means(months, data, season=None):
+    """
+    Seasonal (annual) means of a monthly series (see diagnostics.average_season).
+
+    Parameters
+    ----------
+    months : ndarray of int, shape (T,)
+        Months since year 0 (i.e., year * 12 + month - 1).
+    data : ndarray, shape (T,)
+    season : {'JJA', 'SON', 'DJF', 'MAM', 'ANN'}, optional
+
+    Returns
+    -------
+    data : ndarray, shape (Y,)
+    """
+    years, month = months // 12, months % 12 + 1
+    if season in SEASONS:
+        sel = np.isin(month, SEASONS[season])
+        years, month, data = years[sel], month[sel], data[sel]
+    elif season is not None and season != 'ANN':
+        raise NotImplementedError(f'season={season}')
+
+    if season == 'DJF':  # label winters by the year of January and February
+        year_first, year_last = years[0], years[-1]
+        years = years + (month == 12)
+        # drop not-complete winter seasons
+        sel = (years > year_first) & (years <= year_last)
+        years, data = years[sel], data[sel]
+
+    _, starts, counts = np.unique(years, return_index=True, return_counts=True)
+    if season == 'DJF':
+        assert np.all(counts == 3)
+    return np.add.reduceat(data, starts) / counts
+
+
+class SeriesStore:
+    """
+    A persistent store of regional mean monthly time series.
+
+    Parameters
+    ----------
+    path : str
+        Path of the SQLite file (created if it does not exist).
+
+    Examples
+    --------
+    store = SeriesStore('series.sqlite')
+    value, units = store.diagnostic(
+        {'tas': filename}, 'tas', 'CMIP6', time_period=(1995, 2014),
+        season='JJA', time_aggregation='CLIM', region='CEU')
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._series = {}  # series already read by this instance
+        with self._connect() as con:
+            con.executescript(SCHEMA)
+
+    def _connect(self):
+        # several configurations might be run in parallel (see run_all.py)
+        return sqlite3.connect(self.path, timeout=600)
+
+    def read(self, infile, varn, id_=None, regions=('GLOBAL',), mask_land_sea=False):
+        """
+        Read the regional mean series of one variable.
+
+        Series which are not in the store (or whose input files changed)
+        are calculated from one read of the field and written to the store.
+
+        Parameters
+        ----------
+        infile : str
+        varn : str
+        id_ : {'CMIP6', 'CMIP5', 'CMIP3', 'LE'}, optional
+        regions : list of (str or list of str), optional
+            See diagnostics.select_region.
+        mask_land_sea : {'sea', 'land', False}, optional
+
+        Returns
+        -------
+        series : list of tuple (months, data, units)
+            One entry per region, see season_means for months.
+        """
+        version = file_version(infile, id_)
+        mask = _key(mask_land_sea)
+        keys = {_key(region): (infile, varn, _key(region), mask, version) for region in regions}
+        series = {region: self._series[key] for region, key in keys.items() if key in self._series}
+
+        missing = [region for region in regions if _key(region) not in series]
+        if len(missing) > 0:
+            with self._connect() as con:
+                for region in missing:
+                    row = con.execute(
+                        'SELECT version, units, months, data FROM series WHERE '
+                        'infile = ? AND varn = ? AND region = ? AND mask = ?',
+                        (infile, varn, _key(region), mask)).fetchone()
+                    if row is not None and row[0] == version:
+                        series[_key(region)] = (
+                            np.frombuffer(row[2], dtype=np.int64),
+                            np.frombuffer(row[3], dtype=np.float64), row[1])
+
+        missing = [region for region in regions if _key(region) not in series]
+        if len(missing) > 0:
+            logger.debug(f'Calculate {len(missing)} regional mean series of {infile}')
+            da = read_basic_field(infile, varn, id_, mask_land_sea=mask_land_sea,
+                                  dtype=np.float64)
+            months = np.array([time.year * 12 + time.month - 1
+                               for time in da['time'].data], dtype=np.int64)
+            rows = []
+            for region in missing:
+                da_region = select_region(
+                    da, region, mask_land_sea=mask_land_sea, cells=True)
+                data = np.asarray(area_weighted_mean(da_region).data, dtype=np.float64)
+                units = da.attrs.get('units')
+                series[_key(region)] = (months, data, units)
+                rows.append((infile, varn, _key(region), mask, version, units,
+                             months.tobytes(), data.tobytes()))
+            with self._connect() as con:
+                con.executemany(
+                    'INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+        for region, key in keys.items():
+            self._series[key] = series[region]
+        return [series[_key(region)] for region in regions]
+
+    def diagnostic(self, infiles, diagn, id_=None,
+                   time_period=None,
+                   season=None,
+                   time_aggregation=None,
+                   mask_land_sea=False,
+                   region='GLOBAL'):
+        """
+        Calculate a scalar (regional mean) diagnostic from the stored series.
+
+        Parameters
+        ----------
+        infiles : dict
+            Input filename for each basic variable diagn depends on.
+        diagn : str or dict
+            See diagnostic_graph.expand_diagnostic.
+        time_aggregation : {'CLIM', 'CLIM-MEAN', 'TREND', 'TREND-MEAN', 'ANOM-GLOBAL'}
+        See diagnostics.calculate_basic_diagnostic for all other parameters.
+
+        Returns
+        -------
+        value : float
+            Same as the area-weighted mean of the gridded diagnostic.
+        units : str
+        """
+        assert is_supported(diagn, time_aggregation, id_, time_period)
+        key, varns = expand_diagnostic(diagn)
+        factors = LINEAR.get(key, (1.,))
+
+        regions = [region]
+        if time_aggregation == 'ANOM-GLOBAL':
+            regions.append('GLOBAL')  # the reference is the global mean
+
+        combined = None
+        for varn, factor in zip(varns, factors):
+            series = self.read(infiles[varn], varn, id_, regions, mask_land_sea)
+            data = np.array([data for _, data, _ in series]) * factor
+            if combined is None:
+                months, _, units = series[0]
+                combined = data
+            else:
+                combined = combined + data
+
+        if time_period is not None:
+            end = int(time_period[1])
+            # NOTE: CAMS-CSM1-0 is missing the last year! (see diagnostics.read_basic_field)
+            if end == 2100 and 'CAMS-CSM1-0' in infiles[varns[0]]:
+                end = 2099
+            sel = (months // 12 >= int(time_period[0])) & (months // 12 <= end)
+            months, combined = months[sel], combined[:, sel]
+
+        means = [season_means(months, data, season) for data in combined]
+        if time_aggregation in ['TREND', 'TREND-MEAN']:
+            return trend(means[0]), f'{units} year**-1'
+        value = means[0].mean()
+        if time_aggregation == 'ANOM-GLOBAL':
+            value -= means[1].mean()
+        return value, units
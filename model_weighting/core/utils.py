@@ -28,6 +28,7 @@ Abstract
 A collection of general utility functions.
 """
 import os
+import json
 import logging
 import traceback
 import numpy as np
@@ -144,6 +145,12 @@ def read_config(cname='DEFAULT', path='config.ini', separator=','):
     return cc
 
 
+def parameter_key(*args):
+    """Convert (nested) parameters into a string which can be used as key,
+    e.g., to memoize results depending on these parameters."""
+    return json.dumps(args, sort_keys=True, default=str)
+
+
 class LogTime:
     """A logger for keeping track of code timing.
 
@@ -30,6 +30,7 @@ xarray.Datasets or via xarray.apply_ufunc.
 """
 import os
 import logging
+import functools
 import warnings
 import datetime
 import subprocess
@@ -43,10 +44,87 @@ from statsmodels.stats.weightstats import DescrStatsW
 logger = logging.getLogger(__name__)
 
 
-def area_weighted_mean_data(data, lat, lon):
+def to_cells(da, mask):
+    """
+    Compress the (lat, lon) dimensions of a field into one dimension cells.
+
+    Only the grid points where mask is True are kept, which saves memory and
+    compute for irregular (e.g., SREX or land) regions. The cells dimension
+    has the flat index of each grid point in the (lat, lon) grid as
+    coordinate and lat and lon as additional coordinates. So the area weights
+    can still be calculated (see area_weighted_mean) and the field can be
+    restored with from_cells.
+
+    Parameters
+    ----------
+    da : {xarray.Dataset, xarray.DataArray}
+        Has to contain the dimensions (lat, lon).
+    mask : xarray.DataArray, shape (lat, lon)
+
+    Returns
+    -------
+    da : same type as input with (lat, lon) replaced by cells
+    """
+    mask = np.asarray(mask.transpose('lat', 'lon').data, dtype=bool)
+    idx_lat, idx_lon = np.nonzero(mask)
+    da = da.isel(lat=xr.DataArray(idx_lat, dims='cells'),
+                 lon=xr.DataArray(idx_lon, dims='cells'))
+    return da.assign_coords(cells=idx_lat * mask.shape[1] + idx_lon)
+
+
+def from_cells(da):
+    """
+    Restore the (lat, lon) dimensions of a field in the cells layout.
+
+    The grid is the bounding box of the cells (same as da.where(mask,
+    drop=True)), grid points which are not in cells are NaN. Fields which
+    are not in the cells layout are returned unchanged.
+
+    Parameters
+    ----------
+    da : {xarray.Dataset, xarray.DataArray}
+
+    Returns
+    -------
+    da : same type as input with cells replaced by (lat, lon)
+    """
+    if 'cells' not in da.dims:
+        return da
+    return da.drop_vars('cells').set_index(cells=['lat', 'lon']).unstack('cells')
+
+
+def spatial_dims(da):
+    """The spatial dimensions of a field: [cells] (see to_cells) or [lat, lon]."""
+    if 'cells' in da.dims:
+        return ['cells']
+    return ['lat', 'lon']
+
+
+@functools.lru_cache(maxsize=32)
+def _area_weights(lat_bytes, dtype, nr_lon):
+    """Cached cos(lat) weights tiled to all longitudes and flattened."""
+    lat = np.frombuffer(lat_bytes, dtype=dtype)
+    weights = np.repeat(np.cos(np.radians(lat)), nr_lon)
+    weights.flags.writeable = False
+    return weights
+
+
+def area_weights(lat, nr_lon=1):
+    """cos(lat) weights of a (lat, lon) grid flattened to shape (lat*lon,).
+
+    The weights are cached for each grid, so this is cheap to call repeatedly.
+    """
+    lat = np.ascontiguousarray(lat)
+    return _area_weights(lat.tobytes(), lat.dtype.str, nr_lon)
+
+
+def area_weighted_mean_data(data, lat, lon=None):
     """Calculates an area-weighted average of data depending on latitude [and
     longitude] and handles missing values correctly.
 
+    Non-finite values are ignored, i.e., the mean is
+    sum(w * x) / sum(w) over all finite x (NaN if there are none).
+
     Parameters:
     - data (np.array): Data to be averaged, shape has to be (..., lat[, lon]).
     - lat (np.array): Array giving the latitude values.
@@ -61,16 +139,17 @@ def area_weighted_mean_data(data, lat, lon):
     was_masked = False
     if isinstance(data, np.ma.core.MaskedArray):
         was_masked = True
+        data = data.astype(float).filled(np.nan)
     else:  # in case it a Python list
-        data = np.array(data)
-    lat = np.array(lat)
+        data = np.asarray(data)
+    lat = np.asarray(lat)
     assert len(lat.shape) == 1, 'lat has to be a 1D array'
     assert ((-90 <= lat) & (lat <= 90)).all(), 'lat has to be in [-90, 90]!'
     if lon is None:
         assert data.shape[-1] == len(lat), 'Axis -1 of data has to match lat!'
-        data, lon = data.reshape(data.shape + (1,)), np.array([])
+        data = data.reshape(data.shape + (1,))
     else:
-        lon = np.array(lon)
+        lon = np.asarray(lon)
         assert len(lon.shape) == 1, 'lon has to be a 1D array'
         assert data.shape[-1] == len(lon), 'Axis -1 of data has to match lon!'
         assert data.shape[-2] == len(lat), 'Axis -2 of data has to match lat!'
@@ -78,26 +157,32 @@ def area_weighted_mean_data(data, lat, lon):
         assert (((-180 <= lon) & (lon <= 180)).all() or
                 ((0 <= lon) & (lon <= 360)).all()), errmsg
 
-    # create latitude weights and tile them to all longitudes, then flatten
-    w_lat = np.cos(np.radians(lat))
-    weights = np.tile(w_lat, (data.shape[-1], 1)).swapaxes(0, 1).ravel()
-    # flatten lat-lon dimensions, mask missing values, average
-    data_flat = np.ma.masked_invalid(data.reshape(data.shape[:-2] + (-1,)))
-    mean = np.ma.average(data_flat, axis=-1, weights=weights)
-
-    # NOTE: if data is a single value and not invalid it will be a normal
-    # float at this point and no longer masked!
-    if isinstance(mean, float):
-        return mean
+    # flatten lat-lon dimensions, ignore missing values, average
+    weights = area_weights(lat, data.shape[-1])
+    data_flat = data.reshape(data.shape[:-2] + (-1,))
+    valid = np.isfinite(data_flat)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if valid.all():
+            mean = np.sum(data_flat * weights, axis=-1) / weights.sum()
+        else:
+            mean = (np.sum(np.where(valid, data_flat * weights, 0.), axis=-1) /
+                    np.sum(np.where(valid, weights, 0.), axis=-1))
+
+    # NOTE: if data is a single field return a float
+    if mean.ndim == 0:
+        return mean[()]
     elif was_masked:  # if input was masked array also return a masked array
-        return mean
-    return mean.filled(fill_value=np.nan)
+        return np.ma.masked_invalid(mean)
+    return mean
 
 
 def area_weighted_mean(
         ds, latn=None, lonn=None, keep_attrs=True, suppress_warning=False):
     """xarray version of utils_python.physics.area_weighed_mean
 
+    All variables with the same dimensions are averaged in one call. Fields
+    in the cells layout (see to_cells) are averaged over all cells.
+
     Parameters
     ----------
     ds : {xarray.Dataset, xarray.DataArray}
@@ -115,7 +200,10 @@ def area_weighted_mean(
     """
     if suppress_warning:
         warnings.simplefilter('ignore')
-    if latn is None and 'lat' in ds.dims:
+    cells = latn is None and lonn is None and 'cells' in ds.dims
+    if cells:  # one dimension with the latitude of each cell as coordinate
+        latn = lonn = 'cells'
+    elif latn is None and 'lat' in ds.dims:
         latn = 'lat'
     elif latn is None:
         raise ValueError
@@ -128,25 +216,36 @@ def area_weighted_mean(
     if was_da:
         ds = ds.to_dataset(name='data')
 
-    ds_mean = ds.mean((latn, lonn), keep_attrs=keep_attrs)  # create this just to fill
-    for varn in set(ds.variables).difference(ds.dims):
-        if latn in ds[varn].dims and lonn in ds[varn].dims:
-            var = ds[varn].data
-            axis_lat = ds[varn].dims.index(latn)
-            axis_lon = ds[varn].dims.index(lonn)
-            var = np.moveaxis(var, (axis_lat, axis_lon), (-2, -1))
+    # create the reduced dataset (without calculating anything) just to fill
+    drop = [varn for varn in ds.coords if latn in ds[varn].dims or lonn in ds[varn].dims]
+    ds_mean = ds.drop_vars(drop).isel(
+        {dim: 0 for dim in [latn, lonn] if dim in ds.dims}, drop=True)
+    if not keep_attrs:
+        ds_mean.attrs = {}
+        for varn in ds_mean.data_vars:
+            ds_mean[varn].attrs = {}
+
+    groups = {}
+    for varn in set(ds.data_vars):
+        if latn in ds[varn].dims:
+            groups.setdefault(ds[varn].dims, []).append(varn)
+        elif lonn in ds[varn].dims:
+            ds_mean[varn].data = ds[varn].mean(lonn).data
+
+    for dims, varns in groups.items():
+        var = np.stack([ds[varn].data for varn in varns])
+        axis_lat = dims.index(latn) + 1
+        if cells:
+            var = np.moveaxis(var, axis_lat, -1)
+            mean = area_weighted_mean_data(var, ds['lat'].data)
+        elif lonn in dims:
+            var = np.moveaxis(var, (axis_lat, dims.index(lonn) + 1), (-2, -1))
             mean = area_weighted_mean_data(var, ds[latn].data, ds[lonn].data)
-        elif latn in ds[varn].dims:
-            var = ds[varn].data
-            axis_lat = ds[varn].dims.index(latn)
+        else:
             var = np.moveaxis(var, axis_lat, -1)
             mean = area_weighted_mean_data(var, ds[latn].data)
-        elif lonn in ds[varn].dims:
-            mean = ds[varn].mean(lonn).data
-        else:
-            continue
-
-        ds_mean[varn].data = mean
+        for varn, mean_varn in zip(varns, mean):
+            ds_mean[varn].data = mean_varn
 
     warnings.resetwarnings()
     if was_da:
@@ -244,12 +343,357 @@ def weighted_distance_matrix(data, lat=None):
     return d_matrix
 
 
+def _gram_distance_matrix(data, weights, compensated, tolerance):
+    """Weighted RMS distance matrix of data (N, M) based on the Gram matrix."""
+    # only select grid points which are not nan for all models
+    idx = np.where(np.all(np.isfinite(data), axis=0))[0]
+    weights = weights[idx] / weights[idx].sum()  # normalize (!)
+    data = data[:, idx]
+    data = (data - data.mean(axis=0)) * np.sqrt(weights)
+
+    norms = np.einsum('ng,ng->n', data, data)
+    norms_sum = norms[:, np.newaxis] + norms[np.newaxis, :]
+    d_matrix = norms_sum - 2 * data @ data.T
+
+    if compensated:
+        idx_i, idx_j = np.where(np.triu(d_matrix < tolerance * norms_sum, k=1))
+        for chunk in range(0, len(idx_i), 1000):
+            ii, jj = idx_i[chunk:chunk+1000], idx_j[chunk:chunk+1000]
+            diff = np.sum((data[ii] - data[jj])**2, axis=-1)
+            d_matrix[ii, jj] = diff
+            d_matrix[jj, ii] = diff
+
+    d_matrix = np.sqrt(np.maximum(d_matrix, 0.))
+    np.fill_diagonal(d_matrix, np.nan)
+    return d_matrix
+
+
+def weighted_distance_matrices(data, lat=None, compensated=False, tolerance=1e-6, cells=False):
+    """Same as weighted_distance_matrix but batched and based on matrix products.
+
+    Uses ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b on the sqrt-weight-scaled
+    data, so that the main work is one (multi-threaded) BLAS matrix product
+    per batch element. The data are centered (per grid point) first to
+    reduce cancellation. Batch elements are processed one after the other
+    to keep the memory footprint small.
+
+    Parameters
+    ----------
+    data : array_like, shape (..., N, lat, lon)
+    lat : array_like, shape (lat,), optional
+        If given use area weights.
+    compensated : bool, optional
+        If True re-calculate all pairs which are prone to cancellation (i.e.,
+        squared distance < tolerance * (||a||^2 + ||b||^2)) directly. In
+        particular, identical members have a distance of exactly zero.
+    tolerance : float, optional
+    cells : bool, optional
+        If True data has the shape (..., N, cells) and lat gives the latitude
+        of each cell (see to_cells).
+
+    Returns
+    -------
+    d_matrix : ndarray, shape (..., N, N)
+        Grid points which are not finite for all models are ignored
+        separately for each batch element. The diagonal is NaN.
+    """
+    data = np.asarray(data)
+    if cells:  # a grid with one longitude
+        data = data[..., np.newaxis]
+    shape, nr = data.shape[:-3], data.shape[-3]
+    if lat is None:
+        w_lat = np.ones(data.shape[-2])
+    else:
+        w_lat = np.cos(np.radians(lat))
+    weights = np.repeat(w_lat, data.shape[-1])
+    data = data.reshape((-1, nr, weights.shape[0]))
+
+    d_matrix = np.empty((data.shape[0], nr, nr))
+    for idx, data_idx in enumerate(data):
+        d_matrix[idx] = _gram_distance_matrix(
+            data_idx.astype(float), weights, compensated, tolerance)
+    return d_matrix.reshape(shape + (nr, nr))
+
+
+def weighted_distance_rows(data, rows, lat=None, cells=False):
+    """Only the given rows of weighted_distance_matrix.
+
+    Parameters
+    ----------
+    data : array_like, shape (..., N, lat, lon)
+    rows : array_like of int, shape (K,)
+        Indices of the models for which the distances to all models are
+        calculated.
+    lat : array_like, shape (lat,), optional
+        If given use area weights.
+    cells : bool, optional
+        See weighted_distance_matrices.
+
+    Returns
+    -------
+    d_rows : ndarray, shape (..., K, N)
+        Grid points which are not finite for all N models are ignored (same
+        as in weighted_distance_matrix). The distance of each model to
+        itself is NaN.
+    """
+    data = np.asarray(data)
+    if cells:  # a grid with one longitude
+        data = data[..., np.newaxis]
+    shape, nr = data.shape[:-3], data.shape[-3]
+    rows = np.asarray(rows, dtype=int)
+    if lat is None:
+        w_lat = np.ones(data.shape[-2])
+    else:
+        w_lat = np.cos(np.radians(lat))
+    weights = np.repeat(w_lat, data.shape[-1])
+    data = data.reshape((-1, nr, weights.shape[0]))
+
+    d_rows = np.empty((data.shape[0], len(rows), nr))
+    for idx, data_idx in enumerate(data):
+        # only select grid points which are not nan for all models
+        valid = np.where(np.all(np.isfinite(data_idx), axis=0))[0]
+        weights_idx = weights[valid] / weights[valid].sum()  # normalize (!)
+        data_idx = data_idx[:, valid].astype(float)
+        for jdx, row in enumerate(rows):
+            d_rows[idx, jdx] = np.sqrt(np.sum(weights_idx * (data_idx - data_idx[row])**2, axis=-1))
+        d_rows[idx, np.arange(len(rows)), rows] = np.nan
+    return d_rows.reshape(shape + (len(rows), nr))
+
+
 def distance_matrix(data):
     d_matrix = squareform(pdist(data.reshape(-1, 1), metric='euclidean'))
     np.fill_diagonal(d_matrix, np.nan)
     return d_matrix
 
 
+def weighted_obs_distance(data, obs_min, obs_max, lat=None, chunk_size=16, cells=False):
+    """Area-weighted RMS distance of each model to the observations.
+
+    Same as np.sqrt(area_weighted_mean(distance_uncertainty(...)**2)) but
+    fused into one vectorized kernel which processes chunk_size models at a
+    time, so the difference fields of all models are never allocated.
+    Distances within [obs_min, obs_max] are zero, for obs_min == obs_max this
+    is the area-weighted RMSE.
+
+    Parameters
+    ----------
+    data : array_like, shape (N, ..., lat, lon)
+    obs_min, obs_max : array_like, shape (..., lat, lon)
+        Lower and upper bound of the observations (broadcast against
+        data[0]).
+    lat : array_like, shape (lat,), optional
+        If given use area weights.
+    chunk_size : int, optional
+    cells : bool, optional
+        If True the last axis of all arrays are cells and lat gives the
+        latitude of each cell (see to_cells).
+
+    Returns
+    -------
+    distances : ndarray, shape (N, ...)
+        Grid points at which the model or the observations are NaN are
+        ignored. NaN if there are no valid grid points.
+    """
+    data = np.asarray(data)
+    obs_min, obs_max = np.asarray(obs_min), np.asarray(obs_max)
+    if cells:  # a grid with one longitude
+        data = data[..., np.newaxis]
+        obs_min, obs_max = obs_min[..., np.newaxis], obs_max[..., np.newaxis]
+    if lat is None:
+        w_lat = np.ones(data.shape[-2])
+    else:
+        w_lat = np.cos(np.radians(lat))
+    weights = w_lat[:, np.newaxis]
+
+    distances = np.empty(data.shape[:-2])
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = data[start:start+chunk_size].astype(float)
+        diff = np.maximum(obs_min - chunk, chunk - obs_max)
+        np.maximum(diff, 0., out=diff)  # NaN in either array stays NaN
+        valid = np.isfinite(diff)
+        diff[~valid] = 0.
+        diff *= diff
+        diff *= weights
+        w_sum = np.sum(np.where(valid, weights, 0.), axis=(-2, -1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            distances[start:start+chunk_size] = np.sqrt(
+                np.sum(diff, axis=(-2, -1)) / w_sum)
+    return distances
+
+
+def _labelled_sums(data, weights, labels, nr_labels):
+    """Weighted sums of data (B, G) and of the weights over the valid grid
+    points of each label with one bincount each (see labelled_mean)."""
+    labels = np.asarray(labels)
+    valid = np.isfinite(data) & (labels >= 0)
+    idx = (np.arange(data.shape[0])[:, np.newaxis] * nr_labels + labels)[valid]
+    size = data.shape[0] * nr_labels
+    sums = np.bincount(idx, weights=(data * weights)[valid], minlength=size)
+    weights_sums = np.bincount(
+        idx, weights=np.broadcast_to(weights, data.shape)[valid], minlength=size)
+    return sums.reshape(-1, nr_labels), weights_sums.reshape(-1, nr_labels)
+
+
+def labelled_mean(data, labels, nr_labels, lat=None, cells=False):
+    """Area-weighted mean over the grid points of each label (e.g., region).
+
+    Same as area_weighted_mean_data for each label selected separately but
+    all labels are reduced at once with weighted bincounts.
+
+    Parameters
+    ----------
+    data : array_like, shape (..., lat, lon)
+    labels : array_like of int, shape (lat*lon,)
+        Label of each (flattened) grid point in [0, nr_labels), grid points
+        with a negative label are ignored (see diagnostics.region_labels).
+    nr_labels : int
+    lat : array_like, shape (lat,), optional
+        If given use area weights.
+    cells : bool, optional
+        If True the last axis of data are cells and lat gives the latitude
+        of each cell (see to_cells).
+
+    Returns
+    -------
+    means : ndarray, shape (..., nr_labels)
+        Non-finite values are ignored. NaN for labels without valid grid
+        points.
+    """
+    data = np.asarray(data)
+    if cells:  # a grid with one longitude
+        data = data[..., np.newaxis]
+    shape = data.shape[:-2]
+    if lat is None:
+        lat = np.zeros(data.shape[-2])
+    weights = area_weights(lat, data.shape[-1])
+    sums, weights_sums = _labelled_sums(
+        data.reshape((-1, weights.shape[0])).astype(float), weights, labels, nr_labels)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums / weights_sums).reshape(shape + (nr_labels,))
+
+
+def labelled_obs_distance(data, obs_min, obs_max, labels, nr_labels, lat=None,
+                          chunk_size=16, cells=False):
+    """Same as weighted_obs_distance for the grid points of each label.
+
+    Parameters
+    ----------
+    data : array_like, shape (N, ..., lat, lon)
+    obs_min, obs_max : array_like, shape (..., lat, lon)
+    labels : array_like of int, shape (lat*lon,)
+    nr_labels : int
+        See labelled_mean.
+    See weighted_obs_distance for all other parameters.
+
+    Returns
+    -------
+    distances : ndarray, shape (N, ..., nr_labels)
+    """
+    data = np.asarray(data)
+    obs_min, obs_max = np.asarray(obs_min), np.asarray(obs_max)
+    if cells:  # a grid with one longitude
+        data = data[..., np.newaxis]
+        obs_min, obs_max = obs_min[..., np.newaxis], obs_max[..., np.newaxis]
+    if lat is None:
+        lat = np.zeros(data.shape[-2])
+    weights = area_weights(lat, data.shape[-1])
+
+    distances = np.empty(data.shape[:-2] + (nr_labels,))
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = data[start:start+chunk_size].astype(float)
+        diff = np.maximum(obs_min - chunk, chunk - obs_max)
+        np.maximum(diff, 0., out=diff)  # NaN in either array stays NaN
+        diff *= diff
+        sums, weights_sums = _labelled_sums(
+            diff.reshape((-1, weights.shape[0])), weights, labels, nr_labels)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            distances[start:start+chunk_size] = np.sqrt(
+                sums / weights_sums).reshape(diff.shape[:-2] + (nr_labels,))
+    return distances
+
+
+def labelled_distance_matrices(data, labels, nr_labels, lat=None, compensated=False,
+                               tolerance=1e-6, cells=False):
+    """Same as weighted_distance_matrices for the grid points of each label.
+
+    The grid points are sorted by label once, so each label is a contiguous
+    segment which is passed to the Gram matrix kernel.
+
+    Parameters
+    ----------
+    data : array_like, shape (..., N, lat, lon)
+    labels : array_like of int, shape (lat*lon,)
+    nr_labels : int
+        See labelled_mean.
+    See weighted_distance_matrices for all other parameters.
+
+    Returns
+    -------
+    d_matrix : ndarray, shape (..., nr_labels, N, N)
+        All NaN for labels without grid points.
+    """
+    data = np.asarray(data)
+    if cells:  # a grid with one longitude
+        data = data[..., np.newaxis]
+    shape, nr = data.shape[:-3], data.shape[-3]
+    if lat is None:
+        lat = np.zeros(data.shape[-2])
+    weights = area_weights(lat, data.shape[-1])
+    data = data.reshape((-1, nr, weights.shape[0]))
+
+    labels = np.asarray(labels)
+    order = np.argsort(labels, kind='stable')
+    bounds = np.searchsorted(labels[order], np.arange(nr_labels + 1))
+
+    d_matrix = np.full((data.shape[0], nr_labels, nr, nr), np.nan)
+    for label in range(nr_labels):
+        idx = order[bounds[label]:bounds[label+1]]
+        if len(idx) == 0:
+            continue
+        for batch, data_batch in enumerate(data):
+            with np.errstate(invalid='ignore', divide='ignore'):
+                d_matrix[batch, label] = _gram_distance_matrix(
+                    data_batch[:, idx].astype(float), weights[idx], compensated, tolerance)
+    return d_matrix.reshape(shape + (nr_labels, nr, nr))
+
+
+def obs_envelope(obs, obs_uncertainty=None, dim='dataset_dim'):
+    """Lower and upper bound of the observations (see weighted_obs_distance).
+
+    Parameters
+    ----------
+    obs : xarray.DataArray
+        Contains the dimension dim (one entry per observational dataset).
+    obs_uncertainty : {'range', 'center', 'mean', 'median', None}, optional
+        - range: the full range of the observations
+        - center: the center of the range
+        - mean, median: the mean or median of the observations
+        - None: only one observational dataset is used
+    dim : str, optional
+
+    Returns
+    -------
+    obs_min, obs_max : xarray.DataArray
+    """
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore')
+        if obs_uncertainty == 'range':
+            return obs.min(dim, skipna=False), obs.max(dim, skipna=False)
+        elif obs_uncertainty == 'center':
+            obs_center = .5*(obs.min(dim, skipna=False) + obs.max(dim, skipna=False))
+            return obs_center, obs_center
+        elif obs_uncertainty == 'mean':
+            obs_mean = obs.mean(dim, skipna=False)
+            return obs_mean, obs_mean
+        elif obs_uncertainty == 'median':
+            obs_median = obs.median(dim, skipna=False)
+            return obs_median, obs_median
+        elif obs_uncertainty is None:
+            # obs_min and obs_max are the same for this case
+            return obs.squeeze(), obs.squeeze()
+    raise NotImplementedError
+
+
 def distance_uncertainty(var, obs_min, obs_max):
     """Account for uncertainties in the observations by setting
     distances within the observational spread to zero"""
@@ -277,6 +721,56 @@ def trend(data):
     return stats.linregress(xx, data).slope
 
 
+def sliding_windows(data, starts, ends, slope=False):
+    """Mean (or trend) of each window along the first axis.
+
+    Same as data[start:end].mean(axis=0) (or utils_xarray.trend of each grid
+    point) for each window but based on cumulative sums, i.e., the work per
+    window does not depend on its length. The data are centered first to
+    reduce cancellation.
+
+    Parameters
+    ----------
+    data : array_like, shape (Y, ...)
+    starts, ends : array_like of int, shape (W,)
+        Index of the first and after the last element of each window.
+    slope : bool, optional
+        If True calculate the slope of the linear regression against the
+        index (per element) instead of the mean.
+
+    Returns
+    -------
+    windows : ndarray, shape (W, ...)
+        NaN for windows which contain a NaN value (same as skipna=False).
+    """
+    data = np.asarray(data, dtype=float)
+    starts, ends = np.asarray(starts), np.asarray(ends)
+    valid = np.isfinite(data)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        offset = np.where(valid, data, 0.).sum(axis=0) / valid.sum(axis=0)
+    data = np.where(valid, data - offset, 0.)
+
+    def _window_sums(values):
+        cumsum = np.cumsum(values, axis=0)
+        cumsum = np.concatenate([np.zeros((1,) + cumsum.shape[1:], cumsum.dtype), cumsum])
+        return cumsum[ends] - cumsum[starts]
+
+    shape = (-1,) + (1,) * (data.ndim - 1)
+    nr = (ends - starts).reshape(shape)
+    sum_ = _window_sums(data)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if slope:
+            index = np.arange(data.shape[0]).reshape(shape)
+            index_mean = ((starts + ends - 1) / 2).reshape(shape)
+            # sum((x - mean(x)) * y) / sum((x - mean(x))**2) with x = index
+            windows = ((_window_sums(index * data) - index_mean * sum_) /
+                       (nr * (nr**2 - 1) / 12))
+        else:
+            windows = sum_ / nr + offset
+    windows[_window_sums(~valid) > 0] = np.nan
+    return windows
+
+
 def correlation(arr1, arr2):
     if np.any(np.isnan(arr1)) or np.any(np.isnan(arr2)):
         return np.nan
@@ -492,6 +986,149 @@ def quantile(data, quantiles, weights=None, interpolation='linear',
         raise ValueError(errmsg)
 
 
+def weighted_quantile(data, weights, quantiles, interpolation='linear',
+                      old_style=False):
+    """Same as quantile but vectorized over arbitrary leading dimensions.
+
+    The data are sorted only once along the last axis and all quantiles of
+    all cells are calculated at once.
+
+    NOTE: the results are identical to quantile except for tied values with
+    different weights: quantile uses an unstable sort, so the order of tied
+    values (and therefore the cumulative weights) is not defined there; here
+    tied values keep their original order (stable sort).
+
+    Parameters
+    ----------
+    data : array_like, shape (..., N)
+    weights : array_like, shape (..., N) or (N,) or None
+        Non-negative weights, broadcastable to data. Values with zero weight
+        are ignored (same as in quantile). None means equal weights.
+    quantiles : float or array_like, shape (M,)
+        Quantile(s) in [0, 1].
+    interpolation : {'linear', 'lower', 'higher', 'nearest'}, optional
+        See quantile.
+    old_style : bool, optional
+        See quantile.
+
+    Returns
+    -------
+    quantiles : ndarray, shape (...) or (..., M)
+        NaN for all cells where data contain missing values.
+    """
+    data = np.asarray(data, dtype=float)
+    quantiles = np.asarray(quantiles, dtype=float)
+    if np.any(quantiles < 0.) or np.any(quantiles > 1.):
+        errmsg = 'quantiles should be in [0, 1] not {}'.format(quantiles)
+        raise ValueError(errmsg)
+    if interpolation == 'midpoint':
+        raise NotImplementedError
+    if interpolation not in ['linear', 'lower', 'higher', 'nearest']:
+        errmsg = ' '.join([
+            'interpolation has to be one of [linear | lower | higher |',
+            'nearest | midpoint] and not {}'.format(interpolation)])
+        raise ValueError(errmsg)
+    if weights is None:
+        weights = np.ones(data.shape[-1])
+    weights = np.asarray(weights, dtype=float)
+    if np.any(weights < 0.):
+        raise ValueError('weights have to be non-negative')
+    data, weights = np.broadcast_arrays(data, weights)
+
+    shape = data.shape[:-1]
+    data = data.reshape(-1, data.shape[-1])
+    weights = weights.reshape(data.shape)
+    missing = np.any(np.isnan(data), axis=-1)
+
+    # sort by value with values with zero weight at the end
+    sorter = np.argsort(np.where(weights == 0, np.inf, data), axis=-1, kind='stable')
+    data = np.take_along_axis(data, sorter, axis=-1)
+    weights = np.take_along_axis(weights, sorter, axis=-1)
+    valid = weights > 0
+    last = np.maximum(valid.sum(axis=-1) - 1, 0)[:, np.newaxis]
+
+    weighted_quantiles = np.cumsum(weights, axis=-1) - .5*weights
+    if old_style:  # consistent with np.percentile
+        weighted_quantiles -= weighted_quantiles[:, :1]
+        weighted_quantiles /= np.take_along_axis(weighted_quantiles, last, axis=-1)
+    else:  # more correct (see reference for a discussion)
+        weighted_quantiles /= np.sum(weights, axis=-1, keepdims=True)
+    weighted_quantiles[~valid] = np.inf
+
+    # same as np.interp(quantiles, weighted_quantiles, data) for each cell
+    qq = np.atleast_1d(quantiles)
+    idx = np.sum(weighted_quantiles[:, np.newaxis, :] <= qq[:, np.newaxis], axis=-1)
+    idx_lower = np.minimum(np.maximum(idx - 1, 0), last)
+    idx_upper = np.minimum(idx, last)
+    x_lower = np.take_along_axis(weighted_quantiles, idx_lower, axis=-1)
+    x_upper = np.take_along_axis(weighted_quantiles, idx_upper, axis=-1)
+    y_lower = np.take_along_axis(data, idx_lower, axis=-1)
+    y_upper = np.take_along_axis(data, idx_upper, axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (y_upper - y_lower) / (x_upper - x_lower)
+        results = np.where(
+            idx_lower == idx_upper, y_lower, slope * (qq - x_lower) + y_lower)
+
+    if interpolation != 'linear':
+        values = np.where(valid, data, np.nan)[:, np.newaxis, :]
+        results = results[..., np.newaxis]
+        if interpolation == 'lower':
+            idx = np.sum(values <= results, axis=-1) - 1
+        elif interpolation == 'higher':
+            idx = last - np.sum(values >= results, axis=-1) + 1
+        else:
+            idx = np.argmin(np.where(
+                np.isnan(values), np.inf, np.abs(values - results)), axis=-1)
+        results = np.take_along_axis(data, np.clip(idx, 0, last), axis=-1)
+
+    results[missing] = np.nan
+    if quantiles.ndim == 0:
+        return results.reshape(shape)
+    return results.reshape(shape + qq.shape)
+
+
+@xr.register_dataarray_accessor('weighted_quantile')
+class WeightedQuantileAccessor:
+    """
+    Weighted quantiles of a DataArray along one dimension.
+
+    Examples
+    --------
+    da.weighted_quantile((.1, .9), weights, dim='model_ensemble')
+    """
+
+    def __init__(self, da):
+        self._da = da
+
+    def __call__(self, quantiles, weights=None, dim='model_ensemble', **kwargs):
+        """See weighted_quantile, kwargs are passed on.
+
+        Parameters
+        ----------
+        quantiles : float or array_like, shape (M,)
+        weights : xarray.DataArray, optional
+            Needs to contain dim, other dimensions are broadcast.
+        dim : str, optional
+
+        Returns
+        -------
+        quantiles : xarray.DataArray
+            Has a dimension quantile (first) if quantiles is array-like.
+        """
+        if weights is None:
+            weights = xr.ones_like(self._da[dim], dtype=float)
+        scalar = np.ndim(quantiles) == 0
+        result = xr.apply_ufunc(
+            weighted_quantile, self._da, weights,
+            input_core_dims=[[dim], [dim]],
+            output_core_dims=[[]] if scalar else [['quantile']],
+            kwargs={'quantiles': quantiles, **kwargs})
+        if scalar:
+            return result.assign_coords(quantile=quantiles)
+        result['quantile'] = np.asarray(quantiles)
+        return result.transpose('quantile', ...)
+
+
 def variance(data, weights=None, biased=False):
     """Calculates the (biased/unbiased) weighted variance.
 
@@ -117,6 +117,100 @@ def calculate_weights_sigmas(distances, sigmas_q, sigmas_i):
     return weights
 
 
+def calculate_weights_sigmas_batched(distances, sigmas_q, sigmas_i):
+    """Same as calculate_weights_sigmas but for all sigma combinations at once.
+
+    Parameters
+    ----------
+    distances : array_like, shape (..., N, N)
+        Array specifying the distances between each model. Leading
+        dimensions (e.g., subsets of models) are calculated independently.
+    sigmas_q : array_like, shape (..., M)
+        Array of sigma values for the weighting function of the quality.
+    sigmas_i : array_like, shape (..., L)
+        Array of sigma values for the weighting function of the independence.
+
+    Returns
+    -------
+    weights : ndarray, shape (..., M, L, N, N)
+        Array of weights for each model and sigma combination (equal to
+        calculate_weights_sigmas up to rounding).
+    """
+    distances = np.asarray(distances, dtype=float)
+    sigmas_q = np.asarray(sigmas_q, dtype=float)
+    sigmas_i = np.asarray(sigmas_i, dtype=float)
+    ss = distances.shape
+    assert len(ss) >= 2, 'distances needs to be at least a 2D array'
+    assert ss[-2] == ss[-1], 'distances needs to be of shape (..., N, N)'
+    assert np.all(np.isnan(np.diagonal(distances, axis1=-2, axis2=-1))), '(i, i) should be nan'
+    assert sigmas_q.shape[:-1] == ss[:-2], 'sigmas_q needs to be of shape (..., M)'
+    assert sigmas_i.shape[:-1] == ss[:-2], 'sigmas_i needs to be of shape (..., L)'
+
+    distances = distances[..., None, :, :]
+    # numerator[..., m, d, n]: quality of model n with model d as 'truth'
+    numerator = np.exp(-((distances / sigmas_q[..., None, None])**2))
+    numerator[sigmas_q == -99.] = numerator[sigmas_q == -99.] * 0 + 1  # (except NaN)
+    # denominator[..., l, n]: 1 + sum_{j!=n} exp(-(delta_i[n, j]/sigma_i)**2)
+    exp = np.exp(-((distances / sigmas_i[..., None, None])**2))
+    denominator = 1 + np.nansum(exp, axis=-1)
+    denominator[sigmas_i == -99.] = 1.
+
+    weights = numerator[..., :, None, :, :] / denominator[..., None, :, None, :]
+    weights[..., np.arange(ss[-1]), np.arange(ss[-1])] = 0.  # exclude the 'True' model
+    weights_sum = weights.sum(axis=-1, keepdims=True)
+    assert np.all(weights_sum != 0), 'weights = 0! sigma_q too small?'
+    return weights / weights_sum
+
+
+def calculate_weights_subsets(quality, independence, sigmas_q, sigmas_i, masks):
+    """Calculates the normalised weights for K subsets of the N models.
+
+    The weights of each subset are the same as the weights calculated with
+    calculate_weights using only the models in the subset.
+
+    Parameters
+    ----------
+    quality : array_like, shape (N,)
+        Array specifying the model quality.
+    independence : array_like, shape (N, N)
+        Array specifying the model independence.
+    sigmas_q : array_like, shape (K,)
+        Quality sigma value of each subset.
+    sigmas_i : array_like, shape (K,)
+        Independence sigma value of each subset.
+    masks : array_like, shape (K, N)
+        Boolean array which is True for the models in a subset.
+
+    Returns
+    -------
+    weights, numerator, denominator : ndarray, shape (K, N)
+        Weights are normalized for each subset and zero for models not in
+        the subset. Numerator and denominator are NaN for models not in the
+        subset.
+    """
+    quality = np.asarray(quality, dtype=float)
+    independence = np.asarray(independence, dtype=float)
+    sigmas_q = np.asarray(sigmas_q, dtype=float)
+    sigmas_i = np.asarray(sigmas_i, dtype=float)
+    masks = np.asarray(masks, dtype=bool)
+    assert len(quality.shape) == 1, 'quality needs to be a 1D array'
+    assert independence.shape == quality.shape * 2, 'independence needs to be (N, N)'
+    assert masks.shape == sigmas_q.shape + quality.shape, 'masks needs to be (K, N)'
+    assert np.all(np.isnan(np.diagonal(independence))), '(i, i) should be nan'
+
+    numerator = np.exp(-((quality / sigmas_q[:, None])**2))
+    numerator[sigmas_q == -99.] = numerator[sigmas_q == -99.] * 0 + 1  # (except NaN)
+    exp = np.exp(-((independence / sigmas_i[:, None, None])**2))
+    denominator = 1 + np.nansum(np.where(masks[:, None, :], exp, 0.), axis=-1)
+    denominator[sigmas_i == -99.] = 1.
+
+    numerator = np.where(masks, numerator, np.nan)
+    denominator = np.where(masks, denominator, np.nan)
+    weights = np.where(masks, numerator / denominator, 0.)
+    weights /= weights.sum(axis=-1, keepdims=True)
+    return weights, numerator, denominator
+
+
 def calculate_independence_ensembles(distances, sigmas_i):
     """Similar to calculate_weights_sigmas but only calculate the independence.
 
@@ -49,23 +49,34 @@ Eniron. Res. Lett., https://doi.org/10.1088/1748-9326/ab492f
 import os
 import logging
 import argparse
-import warnings
 import numpy as np
 import xarray as xr
 from natsort import natsorted
+from configparser import ConfigParser
 
 from core.get_filenames import get_filenames, select_variants
-from core.diagnostics import calculate_diagnostic
-from core.perfect_model_test import perfect_model_test
+from core.diagnostic_graph import (
+    build_graph,
+    expand_diagnostic,
+    get_diagnostic_settings,
+)
+from core.perfect_model_test import perfect_model_test, perfect_model_test_batched
 from core.read_config import read_config
+from core.diagnostics import ALL_REGIONS, get_regions, region_labels
+from core.checkpoint import Checkpoint
+from core.distances import DistanceAccumulator, DistanceStore, mask_hash, select_rows
+from core.series_store import SeriesStore, is_supported
 from core.process_variants import (
     process_variants,
     process_variants_target,
     independence_sigma_from_variants,
     expand_variants,
+    get_model_variants,
 )
 from core.weights import (
     calculate_weights_sigmas,
+    calculate_weights_sigmas_batched,
+    calculate_weights_subsets,
     calculate_weights,
     independence_sigma,
 )
@@ -73,9 +84,16 @@ from core import utils
 from core.utils_xarray import (
     add_revision,
     area_weighted_mean,
-    weighted_distance_matrix,
+    from_cells,
+    spatial_dims,
+    weighted_distance_matrices,
+    weighted_distance_rows,
+    weighted_obs_distance,
+    obs_envelope,
     distance_matrix,
-    distance_uncertainty
+    labelled_mean,
+    labelled_obs_distance,
+    labelled_distance_matrices,
 )
 from core.plots import (
     plot_rmse,
@@ -86,17 +104,6 @@ from core.plots import (
 
 logger = logging.getLogger(__name__)
 
-DERIVED = {
-    'tashuss': ('huss', 'tas'),
-    'tasclt': ('clt', 'tas'),
-    'taspr': ('pr', 'tas'),
-    'rnet': ('rlds', 'rlus', 'rsds', 'rsus'),
-    'ef': ('hfls', 'hfss'),
-    'dtr': ('tasmax', 'tasmin'),
-}
-REGRID_OBS = [
-    'ERA-Interim']
-
 
 def read_args():
     """Read the given configuration from the config file"""
@@ -104,11 +111,19 @@ def read_args():
         description=__doc__,
         formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument(
-        dest='config', nargs='?', default='DEFAULT',
-        help='Name of the configuration to use (optional).')
+        dest='configs', nargs='*', default=['DEFAULT'],
+        help=' '.join([
+            'Name(s) of the configuration(s) to use (optional). Several',
+            'configurations are run in one process and share diagnostics.']))
     parser.add_argument(
         '--filename', '-f', dest='filename', default='configs/config.ini',
         help='Relative or absolute path/filename.ini of the config file.')
+    parser.add_argument(
+        '--all-sections', '-a', dest='all_sections', action='store_true',
+        help='Run all configurations in the config file (excluding DEFAULT).')
+    parser.add_argument(
+        '--resume', '-r', dest='resume', action='store_true',
+        help='Skip stages which were completed by a previous (failed) run.')
     parser.add_argument(
         '--logging-level', '-log-level', dest='log_level', default=20,
         type=str, choices=['error', 'warning', 'info', 'debug'],
@@ -119,83 +134,236 @@ def read_args():
     return parser.parse_args()
 
 
-def calc_target(filenames, cfg):
+def get_cached(cache, key, model_ensembles):
     """
-    Calculates the target variable for each model.
+    Return a cached result for the given models.
 
     Parameters
     ----------
-    filenames : dictionary
+    cache : dict or None
+    key : str
+        See utils.parameter_key
+    model_ensembles : list of str
+
+    Returns
+    -------
+    result : xarray.DataArray or None
+        The cached result sub-set to model_ensembles (in both model dimensions
+        if it is a distance matrix). None if there is no cached result for
+        key or if it does not contain all model_ensembles.
+    """
+    if cache is None or key not in cache:
+        return None
+    result = cache[key]
+    if not set(model_ensembles).issubset(result['model_ensemble'].data):
+        return None
+    logger.info('Re-using result from a previous configuration')
+    return result.sel({dim: model_ensembles for dim in [
+        'model_ensemble', 'perfect_model_ensemble'] if dim in result.dims})
+
+
+def calc_diagnostics(filenames, cfg, cache=None):
+    """
+    Calculate all performance, independence, and target diagnostics for each model.
+
+    For each model the diagnostics are planned as a dependency graph (see
+    core.diagnostic_graph) so that each basic variable field is only read and
+    pre-processed once, even if several (derived) diagnostics depend on it.
+
+    Parameters
+    ----------
+    filenames : nested dictionary
         See get_filenames() docstring for more information.
     cfg : configuration object
         See read_config() docstring for more information.
+    cache : dict, optional
+        If given the diagnostics of each model are stored in (and re-used
+        from) cache based on their input file(s) and settings.
+
+    If cfg.series_store is given CLIM-MEAN and TREND-MEAN diagnostics are
+    calculated from the stored regional mean time series and are returned
+    as regional means (see core.series_store.SeriesStore).
+
+    Returns
+    -------
+    diagnostics : dict
+        Keys are of the form (kind, idx) (see get_diagnostic_settings), values
+        are xarray.Datasets with the additional dimension model_ensemble.
+    """
+    model_ensembles = [*filenames[[*filenames.keys()][0]].keys()]
+    settings = get_diagnostic_settings(cfg)
+
+    stored = []  # diagnostics calculated from the series store
+    if cfg.series_store is not None:
+        series_store = SeriesStore(cfg.series_store)
+        stored = [
+            name for name in settings if name[0] in ['performance', 'independence'] and
+            settings[name]['time_aggregation'] in ['CLIM-MEAN', 'TREND-MEAN'] and
+            is_supported(id_=model_ensembles[0].split('_')[2], idx_lats=cfg.idx_lats,
+                         idx_lons=cfg.idx_lons, **settings[name])]
+
+    diagnostics = {}
+    accumulators = {}
+    if cfg.stream_distances:  # do not keep the gridded independence diagnostics
+        accumulators = {
+            name: DistanceAccumulator() for name in settings
+            if name[0] == 'independence' and
+            cfg.independence_aggs[name[1]] not in ['CLIM-MEAN', 'TREND-MEAN']}
+    nr_reads = 0
+    for model_ensemble in model_ensembles:
+        with utils.LogTime(model_ensemble, level='debug'):
+            infiles = {varn: filenames[varn][model_ensemble] for varn in filenames}
+            # only the inputs of each diagnostic go into its key so that it is also
+            # re-used by configurations which read a different set of variables
+            keys = {name: utils.parameter_key(
+                {varn: infiles[varn] for varn in expand_diagnostic(settings[name]['diagn'])[1]},
+                settings[name], cfg.idx_lats, cfg.idx_lons, cfg.precision,
+                cfg.region_cells) for name in settings}
+            names = [name for name in settings if name not in stored and (
+                cache is None or keys[name] not in cache)]
+            graph = build_graph(cfg, infiles, model_ensemble.split('_')[2], names=names)
+            nr_reads += graph.nr_reads
+            results = graph.execute()
+            for name in stored:
+                value, units = series_store.diagnostic(
+                    infiles, id_=model_ensemble.split('_')[2], **settings[name])
+                results[name] = xr.DataArray(value, attrs={'units': units}).to_dataset(
+                    name=expand_diagnostic(settings[name]['diagn'])[0])
+            for name in settings:
+                if name in results:
+                    diagnostic = results[name]
+                    if cache is not None:
+                        cache[keys[name]] = diagnostic
+                else:
+                    diagnostic = cache[keys[name]]
+                if name in accumulators:
+                    varn = expand_diagnostic(cfg.independence_diagnostics[name[1]])[0]
+                    accumulators[name].add(diagnostic[varn], model_ensemble)
+                    continue
+                diagnostic = diagnostic.copy()
+                diagnostic['model_ensemble'] = xr.DataArray(
+                    [model_ensemble], dims='model_ensemble')
+                diagnostics.setdefault(name, []).append(diagnostic)
+
+    logger.info(f'Read {nr_reads} fields for {len(diagnostics) + len(accumulators)} diagnostics')
+
+    if cfg.precision == 'float32':
+        # re-calculate the first model in double precision as a reference
+        model_ensemble = model_ensembles[0]
+        infiles = {varn: filenames[varn][model_ensemble] for varn in filenames}
+        graph = build_graph(cfg, infiles, model_ensemble.split('_')[2], precision='float64',
+                            names=[name for name in settings if name not in stored])
+        for name, diagnostic in graph.execute().items():
+            if name in diagnostics:
+                log_precision_difference(name, diagnostics[name][0], diagnostic)
+
+    return {**{name: xr.concat(diagnostic, dim='model_ensemble')
+               for name, diagnostic in diagnostics.items()},
+            **accumulators}
+
+
+def log_precision_difference(name, ds, ds_ref):
+    """Log the maximum difference of a diagnostic to its float64 reference."""
+    for varn in ds.data_vars:
+        diff = np.abs(ds[varn].astype(np.float64) - ds_ref[varn])
+        diff_max = float(diff.max())
+        ref_max = float(np.abs(ds_ref[varn]).max())
+        logger.info(' '.join([
+            f'float32 vs. float64 {name} {varn}: max. absolute difference',
+            f'{diff_max:.3g} (relative: {diff_max / ref_max:.3g})']))
+
+
+def calc_target(diagnostics, cfg):
+    """
+    Calculates the target variable for each model.
+
+    Parameters
+    ----------
+    diagnostics : dictionary
+        See calc_diagnostics() docstring for more information.
+    cfg : configuration object
+        See read_config() docstring for more information.
 
     Returns
     -------
     targets : xarray.DataArray, shape (L, M, N)
-        DataArray of targets depending on models, lat, lon
+        DataArray of targets depending on models, lat, lon. In the
+        all-regions mode the regional means with dimensions (model_ensemble,
+        region).
     targets_clim : xarray.DataArray, shape (L, M, N)
         DataArray of target climatologies. If no reference period is given,
         this will be None.
     """
-    # build and create path
-    base_path = os.path.join(cfg.save_path, cfg.target_diagnostic)
-    os.makedirs(base_path, exist_ok=True)
+    diagn_key = expand_diagnostic(cfg.target_diagnostic)[0]
+    targets = diagnostics[('target', None)][diagn_key]
+    if cfg.precision == 'float32':  # weights in double precision
+        targets = targets.astype(np.float64)
+    if cfg.target_region in ALL_REGIONS:
+        targets = reduce_regions(targets, cfg)
+
+    # calculate change rather than absolute value
+    if cfg.target_startyear_ref is not None:
+        clim = diagnostics[('target_ref', None)][diagn_key]
+        if cfg.precision == 'float32':
+            clim = clim.astype(np.float64)
+        if cfg.target_region in ALL_REGIONS:
+            clim = reduce_regions(clim, cfg)
+        targets = xr.DataArray(targets - clim, attrs=targets.attrs, name=targets.name)
+        return targets, clim
+    return targets, None
+
+
+def reduce_regions(da, cfg):
+    """
+    Area-weighted means of a global field over all regions of the all-regions mode.
 
-    targets = []
-    clims = []
-    for model_ensemble, filename in filenames.items():
-        with utils.LogTime(model_ensemble, level='debug'):
-            target = calculate_diagnostic(
-                infile=filename,
-                diagn=cfg.target_diagnostic,
-                id_=model_ensemble.split('_')[2],
-                base_path=base_path,
-                time_period=(
-                    cfg.target_startyear,
-                    cfg.target_endyear),
-                season=cfg.target_season,
-                time_aggregation=cfg.target_agg,
-                mask_land_sea=cfg.target_mask,
-                region=cfg.target_region,
-                overwrite=cfg.overwrite,
-                idx_lats=cfg.idx_lats,
-                idx_lons=cfg.idx_lons,
-            )
+    Parameters
+    ----------
+    da : {xarray.DataArray, xarray.Dataset}
+        Contains the dimensions (lat, lon) or cells.
+    cfg : configuration object
+        See read_config() docstring for more information.
 
-            # calculate change rather than absolute value
-            if cfg.target_startyear_ref is not None:
-                target_hist = calculate_diagnostic(
-                    infile=filename,
-                    id_=model_ensemble.split('_')[2],
-                    diagn=cfg.target_diagnostic,
-                    base_path=base_path,
-                    time_period=(
-                        cfg.target_startyear_ref,
-                        cfg.target_endyear_ref),
-                    season=cfg.target_season,
-                    time_aggregation=cfg.target_agg,
-                    mask_land_sea=cfg.target_mask,
-                    region=cfg.target_region,
-                    overwrite=cfg.overwrite,
-                    idx_lats=cfg.idx_lats,
-                    idx_lons=cfg.idx_lons,
-                )
-                target[cfg.target_diagnostic] -= target_hist[cfg.target_diagnostic]
-                target_hist['model_ensemble'] = xr.DataArray([model_ensemble], dims='model_ensemble')
-
-                clims.append(target_hist)
-
-        target['model_ensemble'] = xr.DataArray([model_ensemble], dims='model_ensemble')
-        targets.append(target)
-        logger.debug('Calculate diagnostics for file {}... DONE'.format(filename))
-
-    return (xr.concat(targets, dim='model_ensemble')[cfg.target_diagnostic],
-            xr.concat(clims, dim='model_ensemble')[cfg.target_diagnostic]
-            if cfg.target_startyear_ref is not None else None)
-
-
-def calc_performance(filenames, cfg):
+    Returns
+    -------
+    da : same type as input with the spatial dimensions replaced by region
+    """
+    spatial = spatial_dims(da)
+    labels, abbrevs = region_labels(da, cfg.all_regions)
+    da = xr.apply_ufunc(
+        labelled_mean, da,
+        kwargs={'labels': labels, 'nr_labels': len(abbrevs), 'lat': da['lat'].data,
+                'cells': spatial == ['cells']},
+        input_core_dims=[spatial], output_core_dims=[['region']], keep_attrs=True)
+    return da.assign_coords(region=abbrevs)
+
+
+def broadcast_regions(diffs, cfg):
+    """
+    Repeat distances which do not depend on the region for all regions.
+
+    In the all-regions mode diagnostics can also use a fixed region (e.g.,
+    GLOBAL), which is then used for the weights of each region.
+
+    Parameters
+    ----------
+    diffs : list of xarray.DataArray
+    cfg : configuration object
+        See read_config() docstring for more information.
+
+    Returns
+    -------
+    diffs : list of xarray.DataArray
+        All with region as first dimension (if cfg.all_regions is set).
+    """
+    if cfg.all_regions is None:
+        return diffs
+    abbrevs = list(get_regions(cfg.all_regions).abbrevs)
+    return [(diff if 'region' in diff.dims else diff.expand_dims({'region': abbrevs}))
+            .transpose('region', ...) for diff in diffs]
+
+
+def calc_performance(diagnostics, cfg, cache=None):
     """
     Calculate the performance predictor diagnostics for each model.
 
@@ -204,145 +372,147 @@ def calc_performance(filenames, cfg):
 
     Parameters
     ----------
-    filenames : nested dictionary
-        See get_filenames() docstring for more information.
+    diagnostics : dictionary
+        See calc_diagnostics() docstring for more information.
     cfg : configuration object
         See read_config() docstring for more information.
+    cache : dict, optional
+        If given the result is stored in (and re-used from) cache based on
+        the performance and observation settings.
+
+    If cfg.distance_store is given only the distances of models which are not
+    yet in the store are calculated (see core.distances.DistanceStore).
 
     Returns
     -------
     differences : xarray.DataArray, shape (N, M)
         A data array with dimensions (number of diagnostics, number of models).
+        In the all-regions mode with the additional dimension region.
     """
-    # for each file in filenames calculate all diagnostics for each time period
+    model_ensembles = diagnostics[('performance', 0)]['model_ensemble'].data
+    key = utils.parameter_key(
+        'performance', [*get_diagnostic_settings(cfg, ('performance',)).values()],
+        cfg.obs_path, cfg.obs_id, cfg.obs_uncertainty, cfg.model_path,
+        cfg.model_scenario, cfg.idx_lats, cfg.idx_lons, cfg.precision)
+    cached = get_cached(cache, key, model_ensembles)
+    if cached is not None:
+        return cached
+
+    stored = {}
+    if cfg.distance_store is not None:
+        store = DistanceStore(cfg.distance_store)
+        settings = get_diagnostic_settings(cfg, ('performance',))
+        for name, settings_idx in settings.items():
+            store_key = utils.parameter_key(
+                'performance', settings_idx, cfg.obs_path, cfg.obs_id, cfg.obs_uncertainty,
+                cfg.model_path, cfg.model_scenario, cfg.idx_lats, cfg.idx_lons,
+                cfg.precision)
+            stored[name[1]] = (store_key, *store.read_obs(store_key, model_ensembles))
+
+    logger.debug('Calculate diagnostics for observations...')
+    obs_diagnostics = {}
+    for obs_path, obs_id in zip(cfg.obs_path, cfg.obs_id):
+        if all(idx in stored and stored[idx][2].all()
+               for idx in range(len(cfg.performance_diagnostics))):
+            break  # all distances are in the store: no need to read the observations
+        with utils.LogTime(f'Calculate diagnostic for {obs_id}', level='debug'):
+            infiles = {}
+            for diagn in cfg.performance_diagnostics:
+                for varn in expand_diagnostic(diagn)[1]:
+                    infiles[varn] = os.path.join(obs_path, f'{varn}_mon_{obs_id}_g025.nc')
+            graph = build_graph(cfg, infiles, kinds=('performance',))
+            for name, obs in graph.execute().items():
+                obs_diagnostics.setdefault(name, []).append(obs)
+
     diffs = []
     for idx, diagn in enumerate(cfg.performance_diagnostics):
         logger.info(f'Calculate performance diagnostic {diagn}{cfg.performance_aggs[idx]}...')
-
-        base_path = os.path.join(cfg.save_path, diagn)
-        os.makedirs(base_path, exist_ok=True)
-
-        # if its a derived diagnostic: get first basic variable to get one of
-        # the filenames (the others will be created by replacement)
-        varn = [*diagn.values()][0][0] if isinstance(diagn, dict) else diagn
-        diagn_key = [*diagn.keys()][0] if isinstance(diagn, dict) else diagn
-
-        diagnostics = []
-        for model_ensemble, filename in filenames[varn].items():
-            with utils.LogTime(model_ensemble, level='debug'):
-
-                diagnostic = calculate_diagnostic(
-                    infile=filename,
-                    id_=model_ensemble.split('_')[2],
-                    diagn=diagn,
-                    base_path=base_path,
-                    time_period=(
-                        cfg.performance_startyears[idx],
-                        cfg.performance_endyears[idx]),
-                    season=cfg.performance_seasons[idx],
-                    time_aggregation=cfg.performance_aggs[idx],
-                    mask_land_sea=cfg.performance_masks[idx],
-                    region=cfg.performance_regions[idx],
-                    overwrite=cfg.overwrite,
-                    idx_lats=cfg.idx_lats,
-                    idx_lons=cfg.idx_lons,
-                )
-
-            diagnostic['model_ensemble'] = xr.DataArray(
-                [model_ensemble], dims='model_ensemble')
-            diagnostics.append(diagnostic)
-            logger.debug('Calculate diagnostics for file {}... DONE'.format(filename))
-
-        diagnostics = xr.concat(diagnostics, dim='model_ensemble')
+        diagn_key = expand_diagnostic(diagn)[0]
+        diagnostics_idx = diagnostics[('performance', idx)]
+
+        if idx in stored:
+            store_key, distances, found = stored[idx]
+            logger.info(f'Found {found.sum()} of {len(found)} distances in the store')
+            if found.all():
+                diffs.append(xr.DataArray(
+                    distances, dims='model_ensemble',
+                    coords={'model_ensemble': model_ensembles},
+                    name=diagn_key).expand_dims({'diagnostic': [idx]}))
+                continue
+            diagnostics_idx = diagnostics_idx.isel(model_ensemble=~found)
 
         logger.debug('Read observations & calculate model quality...')
-        obs_list = []
-        for obs_path, obs_id in zip(cfg.obs_path, cfg.obs_id):
-            filename = os.path.join(obs_path, f'{varn}_mon_{obs_id}_g025.nc')
-
-            with utils.LogTime(f'Calculate diagnostic for {obs_id}', level='debug'):
-                obs = calculate_diagnostic(
-                    infile=filename,
-                    diagn=diagn,
-                    base_path=base_path,
-                    time_period=(
-                        cfg.performance_startyears[idx],
-                        cfg.performance_endyears[idx]),
-                    season=cfg.performance_seasons[idx],
-                    time_aggregation=cfg.performance_aggs[idx],
-                    mask_land_sea=cfg.performance_masks[idx],
-                    region=cfg.performance_regions[idx],
-                    overwrite=cfg.overwrite,
-                    regrid=obs_id in REGRID_OBS,
-                    idx_lats=cfg.idx_lats,
-                    idx_lons=cfg.idx_lons,
-                )
-                obs_list.append(obs)
-
-        obs = xr.concat(obs_list, dim='dataset_dim')
+        obs = xr.concat(obs_diagnostics[('performance', idx)], dim='dataset_dim')
+
+        if cfg.precision == 'float32':  # distances in double precision
+            diagnostics_idx = diagnostics_idx.astype(np.float64)
+            obs = obs.astype(np.float64)
+
+        # all regions of the all-regions mode from the global fields
+        all_regions = cfg.performance_regions[idx] in ALL_REGIONS
 
         # NOTE: calculate differences based on global mean properties
         if cfg.performance_aggs[idx] in ['CLIM-MEAN', 'TREND-MEAN']:
             if cfg.obs_uncertainty == 'range':
                 raise NotImplementedError
-            diagnostics[diagn_key] = area_weighted_mean(diagnostics[diagn_key])
-            obs = area_weighted_mean(obs)
+            if all_regions:
+                diagnostics_idx = reduce_regions(diagnostics_idx, cfg)
+                obs = reduce_regions(obs, cfg)
+            else:
+                if diagnostics_idx[diagn_key].dims != ('model_ensemble',):  # gridded (not from the series store)
+                    diagnostics_idx = area_weighted_mean(diagnostics_idx)
+                obs = area_weighted_mean(obs)
         # ---
 
-        if cfg.obs_uncertainty == 'range':
-            with warnings.catch_warnings():
-                warnings.filterwarnings('ignore')
-                obs_min = obs.min('dataset_dim', skipna=False)
-                obs_max = obs.max('dataset_dim', skipna=False)
-                diff = xr.apply_ufunc(
-                    distance_uncertainty, diagnostics[diagn_key],
-                    obs_min[diagn_key], obs_max[diagn_key],
-                    input_core_dims=[['lat', 'lon'], ['lat', 'lon'], ['lat', 'lon']],
-                    output_core_dims=[['lat', 'lon']],
-                    vectorize=True)
-        elif cfg.obs_uncertainty == 'center':
-            with warnings.catch_warnings():
-                warnings.filterwarnings('ignore')
-                obs_min = obs.min('dataset_dim', skipna=False)
-                obs_max = obs.max('dataset_dim', skipna=False)
-            diff = diagnostics[diagn_key] - .5*(obs_min[diagn_key] + obs_max[diagn_key])
-        elif cfg.obs_uncertainty == 'mean':
-            diff = diagnostics[diagn_key] - obs.mean('dataset_dim', skipna=False)[diagn_key]
-        elif cfg.obs_uncertainty == 'median':
-            diff = diagnostics[diagn_key] - obs.median('dataset_dim', skipna=False)[diagn_key]
-        elif cfg.obs_uncertainty is None:
-            # obs_min and obs_max are the same for this case
-            diff = diagnostics[diagn_key] - obs[diagn_key].squeeze()
-        else:
-            raise NotImplementedError
-
-        # --- plot map of each difference ---
-        # takes a long time -> only commend in if needed
-        # if cfg.plot:
-        #     with utils.LogTime('Plotting maps', level='info'):
-        #         plot_maps(diff, idx, cfg)
-        # ---------------------------------------
+        # distances within [obs_min, obs_max] are zero
+        obs_min, obs_max = obs_envelope(obs[diagn_key], cfg.obs_uncertainty)
 
         if cfg.performance_aggs[idx] in ['CLIM-MEAN', 'TREND-MEAN']:
-            diff = np.abs(diff)
+            diff = np.abs(diagnostics_idx[diagn_key] - obs_min)
+        elif all_regions:
+            spatial = spatial_dims(obs_min)
+            labels, abbrevs = region_labels(obs_min, cfg.all_regions)
+            diff = xr.apply_ufunc(
+                labelled_obs_distance,
+                diagnostics_idx[diagn_key].transpose('model_ensemble', ...),
+                obs_min, obs_max,
+                kwargs={'labels': labels, 'nr_labels': len(abbrevs),
+                        'lat': obs_min['lat'].data, 'cells': spatial == ['cells']},
+                input_core_dims=[spatial, spatial, spatial],
+                output_core_dims=[['region']]).assign_coords(region=abbrevs)
         else:
-            diff = np.sqrt(area_weighted_mean(diff**2))
+            spatial = spatial_dims(obs_min)
+            diff = xr.apply_ufunc(
+                weighted_obs_distance,
+                diagnostics_idx[diagn_key].transpose('model_ensemble', ...),
+                obs_min, obs_max,
+                kwargs={'lat': obs_min['lat'].data, 'cells': spatial == ['cells']},
+                input_core_dims=[spatial, spatial, spatial])
 
         if cfg.performance_aggs[idx] == 'CYC':
             diff = diff.mean('month')
 
+        if idx in stored:
+            store.write_obs(store_key, model_ensembles[~found], diff.data)
+            distances[~found] = diff.data
+            diff = xr.DataArray(
+                distances, dims='model_ensemble',
+                coords={'model_ensemble': model_ensembles}, name=diff.name)
+
         diff = diff.expand_dims({'diagnostic': [idx]})
         logger.debug('Read observations & calculate model quality... DONE')
 
         diffs.append(diff)
         logger.info(f'Calculate performance diagnostic {diagn_key}{cfg.performance_aggs[idx]}... DONE')
 
-    return xr.concat(diffs, dim='diagnostic')
+    diffs = xr.concat(broadcast_regions(diffs, cfg), dim='diagnostic')
+    if cache is not None:
+        cache[key] = diffs
+    return diffs
 
 
-def calc_independence(filenames, cfg):
+def calc_independence(diagnostics, cfg, cache=None):
     """
-    TODO
     Calculates the independence predictor diagnostics for each model.
 
     For each predictor calculate the corresponding diagnostic, i.e.,
@@ -350,87 +520,327 @@ def calc_independence(filenames, cfg):
 
     Parameters
     ----------
-    filenames : nested dictionary
-        See get_filenames() docstring for more information.
+    diagnostics : dictionary
+        See calc_diagnostics() docstring for more information.
     cfg : configuration object
         See read_config() docstring for more information.
+    cache : dict, optional
+        If given the result is stored in (and re-used from) cache based on
+        the independence settings. A cached distance matrix is re-used for
+        each sub-set of its models.
+
+    If cfg.distance_store is given only the distances of models which are not
+    yet in the store are calculated (see core.distances.DistanceStore).
 
     Returns
     -------
     differences : xarray.DataArray, shape (N, M, M)
         A data array with dimensions (number of diagnostics, number of models,
-        number of models).
+        number of models). In the all-regions mode with the additional
+        dimension region.
     """
-    # for each file in filenames calculate all diagnostics for each time period
-    diffs = []
+    first = diagnostics[('independence', 0)]
+    if isinstance(first, DistanceAccumulator):
+        model_ensembles = np.array(first.model_ensemble)
+    else:
+        model_ensembles = first['model_ensemble'].data
+    key = utils.parameter_key(
+        'independence', [*get_diagnostic_settings(cfg, ('independence',)).values()],
+        cfg.model_path, cfg.model_scenario, cfg.idx_lats, cfg.idx_lons, cfg.precision)
+    cached = get_cached(cache, key, model_ensembles)
+    if cached is not None:
+        return cached
+
+    if cfg.distance_store is not None:
+        store = DistanceStore(cfg.distance_store)
+        settings = get_diagnostic_settings(cfg, ('independence',))
+
+    diffs, gridded, regional, stored = {}, {}, {}, {}
     for idx, diagn in enumerate(cfg.independence_diagnostics):
-        logger.info(f'Calculate independence diagnostic {diagn}{cfg.independence_aggs[idx]}...')
-
-        base_path = os.path.join(cfg.save_path, diagn)
-        os.makedirs(base_path, exist_ok=True)
-
-        # if its a derived diagnostic: get first basic variable to get one of
-        # the filenames (the others will be created by replacement)
-        varn = [*diagn.values()][0][0] if isinstance(diagn, dict) else diagn
-        diagn_key = [*diagn.keys()][0] if isinstance(diagn, dict) else diagn
-
-        diagnostics = []
-        for model_ensemble, filename in filenames[varn].items():
-            with utils.LogTime(model_ensemble, level='debug'):
-
-                diagnostic = calculate_diagnostic(
-                    infile=filename,
-                    id_=model_ensemble.split('_')[2],
-                    diagn=diagn,
-                    base_path=base_path,
-                    time_period=(
-                        cfg.independence_startyears[idx],
-                        cfg.independence_endyears[idx]),
-                    season=cfg.independence_seasons[idx],
-                    time_aggregation=cfg.independence_aggs[idx],
-                    mask_land_sea=cfg.independence_masks[idx],
-                    region=cfg.independence_regions[idx],
-                    overwrite=cfg.overwrite,
-                    idx_lats=cfg.idx_lats,
-                    idx_lons=cfg.idx_lons,
-                )
-
-            diagnostic['model_ensemble'] = xr.DataArray(
-                [model_ensemble], dims='model_ensemble')
-            diagnostics.append(diagnostic)
-            logger.debug('Calculate diagnostics for file {}... DONE'.format(filename))
-
-        diagnostics = xr.concat(diagnostics, dim='model_ensemble')
-        logger.debug('Calculate model independence matrix...')
+        diagn_key = expand_diagnostic(diagn)[0]
+        diagnostics_idx = diagnostics[('independence', idx)]
+
+        if isinstance(diagnostics_idx, DistanceAccumulator):
+            logger.info(f'Finalize independence diagnostic {diagn}{cfg.independence_aggs[idx]}...')
+            diffs[idx] = diagnostics_idx.finalize()
+            continue
+
+        if cfg.precision == 'float32':  # distances in double precision
+            diagnostics_idx = diagnostics_idx.astype(np.float64)
+
+        # all regions of the all-regions mode from the global fields
+        all_regions = cfg.independence_regions[idx] in ALL_REGIONS
 
         if cfg.independence_aggs[idx] in ['CLIM-MEAN', 'TREND-MEAN']:
-            diff = xr.apply_ufunc(
-                distance_matrix, area_weighted_mean(diagnostics[diagn_key]),
-                input_core_dims=[['model_ensemble']],
-                output_core_dims=[['perfect_model_ensemble', 'model_ensemble']]
-            )
+            data = diagnostics_idx[diagn_key]
+            if all_regions:
+                data = reduce_regions(data, cfg)
+            elif data.dims != ('model_ensemble',):  # gridded (not from the series store)
+                data = area_weighted_mean(data)
+            mask = None  # the distances do not depend on the other models
         else:
-            diff = xr.apply_ufunc(
-                weighted_distance_matrix, diagnostics[diagn_key],
-                input_core_dims=[['model_ensemble', 'lat', 'lon']],
+            data = diagnostics_idx[diagn_key]
+            data = data.transpose(..., 'model_ensemble', *spatial_dims(data))
+            mask = mask_hash(np.all(
+                np.isfinite(data.data), axis=data.get_axis_num('model_ensemble')))
+
+        if cfg.distance_store is not None:
+            store_key = utils.parameter_key(
+                'independence', settings[('independence', idx)], cfg.model_path,
+                cfg.model_scenario, cfg.idx_lats, cfg.idx_lons, cfg.precision)
+            d_matrix, found = store.read_matrix(store_key, model_ensembles, mask)
+            rows = select_rows(found)
+            if len(rows) < .5 * len(model_ensembles):
+                logger.info(' '.join([
+                    f'Calculate {len(rows)} of {len(model_ensembles)} rows of',
+                    f'independence diagnostic {diagn}{cfg.independence_aggs[idx]}...']))
+                diffs[idx] = calc_distance_rows(data, rows, d_matrix)
+                store.write_matrix(store_key, model_ensembles, diffs[idx].data, rows, mask)
+                continue
+            stored[idx] = (store_key, mask)  # too many missing: re-calculate all
+
+        if cfg.independence_aggs[idx] in ['CLIM-MEAN', 'TREND-MEAN']:
+            logger.info(f'Calculate independence diagnostic {diagn}{cfg.independence_aggs[idx]}...')
+            diffs[idx] = xr.apply_ufunc(
+                distance_matrix, data,
+                input_core_dims=[['model_ensemble']],
                 output_core_dims=[['perfect_model_ensemble', 'model_ensemble']],
-                kwargs={'lat': diagnostics['lat'].data},  # NOTE: comment out for unweighted
-                vectorize=True,
+                vectorize=all_regions,
             )
+        elif all_regions:
+            regional[idx] = data
+        else:
+            gridded[idx] = data
+
+    if len(gridded) > 0:
+        logger.info('Calculate independence diagnostics {} in one batch...'.format(', '.join([
+            f'{cfg.independence_diagnostics[idx]}{cfg.independence_aggs[idx]}'
+            for idx in gridded])))
+        diffs.update(calc_distance_matrices(gridded))
+
+    for idx, data in regional.items():
+        logger.info(' '.join([
+            f'Calculate independence diagnostic {cfg.independence_diagnostics[idx]}',
+            f'{cfg.independence_aggs[idx]} for all regions...']))
+        diffs[idx] = calc_region_distance_matrices(data, cfg)
+
+    for idx in range(len(cfg.independence_diagnostics)):
+        diff = diffs[idx]
         # fill newly defined dimension
         diff['perfect_model_ensemble'] = diff['model_ensemble'].data
 
-        if cfg.independence_aggs[idx] == 'CYC':
+        if 'month' in diff.dims:
             diff = diff.mean('month')
 
+        if idx in stored:
+            store.write_matrix(stored[idx][0], model_ensembles, diff.data, mask=stored[idx][1])
+
         diff.name = 'data'
-        diff = diff.expand_dims({'diagnostic': [idx]})
-        diffs.append(diff)
+        diffs[idx] = diff.expand_dims({'diagnostic': [idx]})
+    diffs = [diffs[idx] for idx in range(len(cfg.independence_diagnostics))]
+    logger.info('Calculate independence diagnostics...DONE')
+
+    diffs = xr.concat(broadcast_regions(diffs, cfg), dim='diagnostic')
+    if cache is not None:
+        cache[key] = diffs
+    return diffs
 
-        logger.debug('Calculate independence matrix... DONE')
 
-        logger.info(f'Calculate independence diagnostic {diagn}{cfg.independence_aggs[idx]}...DONE')
-    return xr.concat(diffs, dim='diagnostic')
+def calc_distance_matrices(gridded):
+    """
+    Calculate the model-model distance matrices of several gridded diagnostics
+    in one batch (see utils_xarray.weighted_distance_matrices).
+
+    Parameters
+    ----------
+    gridded : dict of xarray.DataArray
+        Each DataArray has to contain the dimensions (model_ensemble, lat,
+        lon) or (model_ensemble, cells) and can contain others (e.g., month).
+        All diagnostics on the same grid are concatenated and processed in
+        one call.
+
+    Returns
+    -------
+    diffs : dict of xarray.DataArray
+        Same keys as gridded with the dimensions (lat, lon) or cells
+        replaced by (perfect_model_ensemble, model_ensemble).
+    """
+    groups = {}
+    for key, da in gridded.items():
+        spatial = spatial_dims(da)
+        da = da.transpose(..., 'model_ensemble', *spatial)
+        grid = (tuple(spatial), da['lat'].data.tobytes(), da['lon'].data.tobytes())
+        groups.setdefault(grid, []).append((key, da))
+
+    diffs = {}
+    for (spatial, *_), group in groups.items():
+        lat = group[0][1]['lat'].data
+        nr_dims = len(spatial) + 1  # model_ensemble and the spatial dimensions
+        data = np.concatenate([
+            da.data.reshape((-1,) + da.shape[-nr_dims:]) for _, da in group])
+        d_matrices = weighted_distance_matrices(
+            data, lat, compensated=True, cells=spatial == ('cells',))
+
+        start = 0
+        for key, da in group:
+            dims = da.dims[:-nr_dims]
+            size = int(np.prod(da.shape[:-nr_dims]))
+            diffs[key] = xr.DataArray(
+                d_matrices[start:start+size].reshape(
+                    da.shape[:-nr_dims] + d_matrices.shape[-2:]),
+                dims=dims + ('perfect_model_ensemble', 'model_ensemble'),
+                coords={**{dim: da[dim] for dim in dims if dim in da.coords},
+                        'model_ensemble': da['model_ensemble']})
+            start += size
+    return diffs
+
+
+def calc_region_distance_matrices(data, cfg):
+    """
+    Calculate the model-model distance matrices of a global diagnostic for
+    all regions of the all-regions mode (see
+    utils_xarray.labelled_distance_matrices).
+
+    Parameters
+    ----------
+    data : xarray.DataArray
+        Dimensions (..., model_ensemble, lat, lon) or (..., model_ensemble,
+        cells).
+    cfg : configuration object
+        See read_config() docstring for more information.
+
+    Returns
+    -------
+    diff : xarray.DataArray
+        Dimensions (..., region, perfect_model_ensemble, model_ensemble).
+    """
+    spatial = spatial_dims(data)
+    labels, abbrevs = region_labels(data, cfg.all_regions)
+    d_matrices = labelled_distance_matrices(
+        data.data, labels, len(abbrevs), data['lat'].data, compensated=True,
+        cells=spatial == ['cells'])
+    dims = data.dims[:-len(spatial)-1]
+    return xr.DataArray(
+        d_matrices, dims=dims + ('region', 'perfect_model_ensemble', 'model_ensemble'),
+        coords={**{dim: data[dim] for dim in dims if dim in data.coords},
+                'region': abbrevs, 'model_ensemble': data['model_ensemble']})
+
+
+def calc_distance_rows(data, rows, d_matrix):
+    """
+    Fill the given rows (and columns) of a distance matrix.
+
+    Parameters
+    ----------
+    data : xarray.DataArray
+        Either only the dimension model_ensemble (area mean diagnostics) or
+        (..., model_ensemble, lat, lon) or (..., model_ensemble, cells). A
+        month dimension is averaged
+        after the distances are calculated (same as in calc_independence).
+    rows : list of int
+        Indices of the models for which the distances are calculated.
+    d_matrix : ndarray, shape (N, N)
+        Distance matrix with the other distances (e.g., from the store).
+
+    Returns
+    -------
+    d_matrix : xarray.DataArray, shape (N, N)
+        Dimensions (perfect_model_ensemble, model_ensemble).
+    """
+    if data.ndim == 1:
+        values = data.data
+        d_rows = np.abs(values[rows, np.newaxis] - values[np.newaxis, :])
+        d_rows[np.arange(len(rows)), rows] = np.nan
+    else:
+        spatial = spatial_dims(data)
+        d_rows = xr.DataArray(
+            weighted_distance_rows(
+                data.data, rows, data['lat'].data, cells=spatial == ['cells']),
+            dims=data.dims[:-len(spatial)-1] + ('row', 'model_ensemble'))
+        if 'month' in d_rows.dims:
+            d_rows = d_rows.mean('month')
+        d_rows = d_rows.data
+
+    d_matrix = d_matrix.copy()
+    d_matrix[rows, :] = d_rows
+    d_matrix[:, rows] = d_rows.T
+    return xr.DataArray(
+        d_matrix, dims=('perfect_model_ensemble', 'model_ensemble'),
+        coords={'model_ensemble': data['model_ensemble']})
+
+
+def covered_regions(*diffs):
+    """
+    Regions of the all-regions mode in which all diagnostics are defined.
+
+    Regions without (valid) grid points, e.g., outside of the model grid,
+    are skipped.
+
+    Parameters
+    ----------
+    diffs : xarray.DataArray or None
+        See calc_performance() and calc_independence().
+
+    Returns
+    -------
+    regions : ndarray of str
+    """
+    regions, valid = None, None
+    for diff in diffs:
+        if diff is None:
+            continue
+        regions = diff['region'].data
+        dims = [dim for dim in diff.dims if dim not in ['diagnostic', 'region']]
+        valid_diff = np.isfinite(diff).any(dims).all('diagnostic').data
+        valid = valid_diff if valid is None else valid & valid_diff
+
+    if not valid.all():
+        logger.warning('Skipping regions without valid grid points: {}'.format(
+            ', '.join(regions[~valid])))
+    if not valid.any():
+        errmsg = 'All regions masked! Wrong masking settings?'
+        logger.error(errmsg)
+        raise ValueError(errmsg)
+    return regions[valid]
+
+
+def per_region(func, regions, *args):
+    """
+    Call a function separately for each region of the all-regions mode.
+
+    Parameters
+    ----------
+    func : callable
+    regions : array_like of str
+    args : tuple
+        Arguments of func. xarray objects with the dimension region are
+        selected for each region, all others are passed on unchanged.
+
+    Returns
+    -------
+    results : same as func
+        With the additional dimension region. Numbers and arrays are
+        converted to xarray.DataArrays, None is kept.
+    """
+    results = []
+    for region in regions:
+        logger.debug(f'Region {region}')
+        results.append(func(*[
+            arg.sel(region=region)
+            if isinstance(arg, (xr.DataArray, xr.Dataset)) and 'region' in arg.dims
+            else arg for arg in args]))
+
+    def _concat(values):
+        if values[0] is None:
+            return None
+        if isinstance(values[0], (xr.DataArray, xr.Dataset)):
+            return xr.concat(values, dim='region').assign_coords(region=regions)
+        return xr.DataArray(np.array(values)).rename(
+            {'dim_0': 'region'}).assign_coords(region=regions)
+
+    if isinstance(results[0], tuple):
+        return tuple(_concat(values) for values in zip(*results))
+    return _concat(results)
 
 
 def _normalize(data, normalize_by):
@@ -474,7 +884,15 @@ def calc_deltas(performance_diagnostics, independence_diagnostics, cfg):
     -------
     delta_p : xarray.DataArray, shape(M,) or None
     delta_i : xarray.DataArray, shape(M, M)
+
+    In the all-regions mode each region is processed separately and all
+    returned arrays have the additional dimension region.
     """
+    if 'region' in independence_diagnostics.dims:
+        return per_region(
+            calc_deltas, covered_regions(performance_diagnostics, independence_diagnostics),
+            performance_diagnostics, independence_diagnostics, cfg)
+
     # make this to DataArray
     # NOTE: I belief the 'temp' dimension is necessary to pass to xarray.apply_ufunc
     # as core dimension. I can not pass no dimension because this will be interpreted
@@ -523,6 +941,82 @@ def calc_deltas(performance_diagnostics, independence_diagnostics, cfg):
     return delta_q, delta_i, sigma_i
 
 
+def get_sigma_ranges(delta_i, sigma_i_variants, cfg, n_sigmas=50):
+    """Return the sigma values to test in the perfect model test.
+
+    Returns
+    -------
+    sigmas_q : ndarray, shape (M,)
+    sigmas_i : ndarray, shape (L,)
+    """
+    sigma_base = np.nanmean(delta_i)  # an estimated sigma to start
+
+    # a large value means all models have equal quality -> we want this as small as possible
+    if isinstance(cfg.sigma_q, (int, float)):
+        # if the user has given one of the sigmas use it
+        # NOTE: if sigma is -99 the corresponding weights will be set to 1 by convention
+        sigmas_q = np.array([cfg.sigma_q])
+    else:
+        # otherwise allow a range
+        sigmas_q = np.linspace(.2*sigma_base, 2*sigma_base, n_sigmas)
+    # a large value means all models depend on each other, a small value means all models
+    # are independent -> we want this ~delta_i
+    if isinstance(cfg.sigma_i, (int, float)):
+        sigmas_i = np.array([cfg.sigma_i])
+    elif sigma_i_variants is not None:
+        sigmas_i = np.asarray(sigma_i_variants)
+    else:
+        sigmas_i = np.linspace(.2*sigma_base, 2*sigma_base, n_sigmas)
+    return sigmas_q, sigmas_i
+
+
+def select_sigmas(inside_ratio, cfg):
+    """Select the smallest sigma combination passing the perfect model test.
+
+    Parameters
+    ----------
+    inside_ratio : ndarray, shape (M, L)
+        Output of perfect_model_test.
+    cfg : configuration object
+        See read_config() docstring for more information.
+
+    Returns
+    -------
+    idx_q_min, idx_i_min : int
+    """
+    force_inside_ratio = isinstance(cfg.inside_ratio, str)  # then it is 'force'
+    if force_inside_ratio:
+        inside_ratio_min = cfg.percentiles[1] - cfg.percentiles[0]
+    else:
+        inside_ratio_min = cfg.inside_ratio
+    inside_ok = inside_ratio >= inside_ratio_min
+
+    if not np.any(inside_ok):
+        logmsg = f'Perfect model test failed ({inside_ratio.max():.4f} < {inside_ratio_min:.4f})!'
+        if force_inside_ratio:
+            # adjust inside_ratio to force a result (probably not recommended?)
+            inside_ok = inside_ratio >= np.max(inside_ratio)
+            logmsg += ' force=True: Setting inside_ratio to max: {}'.format(
+                np.max(inside_ratio))
+            logger.warning(logmsg)
+        else:
+            raise ValueError(logmsg)
+
+    # find the element with the smallest sum i+j which is True
+    index_sum = 9999
+    idx_q_min = None
+    for idx_q, qq in enumerate(inside_ok):
+        if qq.sum() == 0:
+            continue  # no fitting element
+        elif idx_q >= index_sum:
+            break  # no further optimization possible
+        idx_i = np.where(qq)[0][0]
+        if idx_i + idx_q < index_sum:
+            index_sum = idx_i + idx_q
+            idx_i_min, idx_q_min = idx_i, idx_q
+    return idx_q_min, idx_i_min
+
+
 def calc_sigmas(targets, delta_i, sigma_i_variants, cfg, n_sigmas=50):
     """
     Perform a perfect model test to estimate the optimal shape parameters.
@@ -547,35 +1041,76 @@ def calc_sigmas(targets, delta_i, sigma_i_variants, cfg, n_sigmas=50):
         Optimal shape parameter for quality weighing
     sigma_i : float
         Optimal shape parameter for independence weighting
+
+    In the all-regions mode the perfect model test is performed separately
+    for each region and sigma_q and sigma_i have the dimension region.
     """
     if cfg.sigma_i is not None and cfg.sigma_q is not None:
         logger.info('Using user sigmas: q={}, i={}'.format(cfg.sigma_q, cfg.sigma_i))
         return cfg.sigma_q, cfg.sigma_i
 
-    sigma_base = np.nanmean(delta_i)  # an estimated sigma to start
-
-    # a large value means all models have equal quality -> we want this as small as possible
-    if isinstance(cfg.sigma_q, (int, float)):
-        # if the user has given one of the sigmas use it
-        # NOTE: if sigma is -99 the corresponding weights will be set to 1 by convention
-        sigmas_q = np.array([cfg.sigma_q])
-    else:
-        # otherwise allow a range
-        sigmas_q = np.linspace(.2*sigma_base, 2*sigma_base, n_sigmas)
-    # a large value means all models depend on each other, a small value means all models
-    # are independent -> we want this ~delta_i
-    if isinstance(cfg.sigma_i, (int, float)):
-        sigmas_i = np.array([cfg.sigma_i])
-    elif sigma_i_variants is not None:
-        sigmas_i = sigma_i_variants
-    else:
-        sigmas_i = np.linspace(.2*sigma_base, 2*sigma_base, n_sigmas)
+    if 'region' in delta_i.dims:
+        return per_region(
+            calc_sigmas, delta_i['region'].data, targets, delta_i, sigma_i_variants, cfg)
 
+    sigmas_q, sigmas_i = get_sigma_ranges(delta_i, sigma_i_variants, cfg, n_sigmas)
     if len(sigmas_q) == 1 and len(sigmas_i) == 1:
         logger.info('Using sigmas: q={}, i={}'.format(sigmas_q[0], sigmas_i[0]))
         return sigmas_q[0], sigmas_i[0]
 
-    targets_mean = area_weighted_mean(targets)
+    targets_mean_1ens, delta_i_1ens, sigmas_i = prepare_perfect_model_test(
+        targets, delta_i, sigmas_i, cfg)
+
+    weights_sigmas = calculate_weights_sigmas(delta_i_1ens, sigmas_q, sigmas_i)
+
+    # ratio of perfect models inside their respective weighted percentiles
+    # for each sigma combination
+    inside_ratio = perfect_model_test(
+        targets_mean_1ens, weights_sigmas,
+        perc_lower=cfg.percentiles[0],
+        perc_upper=cfg.percentiles[1])
+
+    idx_q_min, idx_i_min = select_sigmas(inside_ratio, cfg)
+
+    logger.info('sigma_q: {:.4f}; sigma_i: {:.4f}'.format(
+        sigmas_q[idx_q_min], sigmas_i[idx_i_min]))
+
+    if cfg.plot:
+        plot_fraction_matrix(
+            sigmas_i, sigmas_q, inside_ratio, cfg, (idx_i_min, idx_q_min),
+            'Fraction of models within {} to {} percentile'.format(
+                *cfg.percentiles))
+
+    return sigmas_q[idx_q_min], sigmas_i[idx_i_min]
+
+
+def prepare_perfect_model_test(targets, delta_i, sigmas_i, cfg):
+    """Select the target and distances of the models used in the perfect model test.
+
+    Parameters
+    ----------
+    targets : xarray.DataArray
+        See calc_sigmas.
+    delta_i : xarray.DataArray, shape (N, N)
+    sigmas_i : ndarray, shape (L,)
+        See get_sigma_ranges.
+    cfg : configuration object
+        See read_config() docstring for more information.
+
+    Returns
+    -------
+    targets_mean_1ens : array_like, shape (M,)
+        Target mean of one member per model (or of all members if there is
+        only one model).
+    delta_i_1ens : array_like, shape (M, M)
+    sigmas_i : ndarray, shape (L,)
+        Estimated from the initial-condition members if variants_independence
+        is True and variants_combine is False.
+    """
+    if targets.dims == ('model_ensemble',):  # regional means (all-regions mode)
+        targets_mean = targets
+    else:
+        targets_mean = area_weighted_mean(targets)
     targets_mean = process_variants_target(targets_mean, cfg)
 
     if cfg.variants_combine:
@@ -601,55 +1136,47 @@ def calc_sigmas(targets, delta_i, sigma_i_variants, cfg, n_sigmas=50):
     if cfg.variants_independence and not cfg.variants_combine:
         # old way if variants are not combined
         sigmas_i = independence_sigma(delta_i, sigmas_i)
+    return targets_mean_1ens, delta_i_1ens, sigmas_i
 
-    weights_sigmas = calculate_weights_sigmas(delta_i_1ens, sigmas_q, sigmas_i)
 
-    # ratio of perfect models inside their respective weighted percentiles
-    # for each sigma combination
-    inside_ratio = perfect_model_test(
-        targets_mean_1ens, weights_sigmas,
-        perc_lower=cfg.percentiles[0],
-        perc_upper=cfg.percentiles[1])
-
-    force_inside_ratio = isinstance(cfg.inside_ratio, str)  # then it is 'force'
-    if force_inside_ratio:
-        cfg.inside_ratio = cfg.percentiles[1] - cfg.percentiles[0]
-    inside_ok = inside_ratio >= cfg.inside_ratio
-
-    if not np.any(inside_ok):
-        logmsg = f'Perfect model test failed ({inside_ratio.max():.4f} < {cfg.inside_ratio:.4f})!'
-        if force_inside_ratio:
-            # adjust inside_ratio to force a result (probably not recommended?)
-            inside_ok = inside_ratio >= np.max(inside_ratio)
-            logmsg += ' force=True: Setting inside_ratio to max: {}'.format(
-                np.max(inside_ratio))
-            logger.warning(logmsg)
-        else:
-            raise ValueError(logmsg)
-
-    # find the element with the smallest sum i+j which is True
-    index_sum = 9999
-    idx_q_min = None
-    for idx_q, qq in enumerate(inside_ok):
-        if qq.sum() == 0:
-            continue  # no fitting element
-        elif idx_q >= index_sum:
-            break  # no further optimization possible
-        idx_i = np.where(qq)[0][0]
-        if idx_i + idx_q < index_sum:
-            index_sum = idx_i + idx_q
-            idx_i_min, idx_q_min = idx_i, idx_q
+def calc_sigmas_batched(targets_mean, delta_i, sigmas_q, sigmas_i, cfg):
+    """
+    Perform the perfect model test of K cases (e.g., subsets of models) at once.
 
-    logger.info('sigma_q: {:.4f}; sigma_i: {:.4f}'.format(
-        sigmas_q[idx_q_min], sigmas_i[idx_i_min]))
+    The perfect model test is vectorized over all sigma combinations and
+    over chunks of cases (limiting the memory of the weights to about 2**24
+    values).
 
-    if cfg.plot:
-        plot_fraction_matrix(
-            sigmas_i, sigmas_q, inside_ratio, cfg, (idx_i_min, idx_q_min),
-            'Fraction of models within {} to {} percentile'.format(
-                *cfg.percentiles))
+    Parameters
+    ----------
+    targets_mean : ndarray, shape (K, N)
+    delta_i : ndarray, shape (K, N, N)
+    sigmas_q : ndarray, shape (K, M)
+    sigmas_i : ndarray, shape (K, L)
+    cfg : configuration object
+        See read_config() docstring for more information.
 
-    return sigmas_q[idx_q_min], sigmas_i[idx_i_min]
+    Returns
+    -------
+    sigma_q, sigma_i : ndarray, shape (K,)
+        Optimal shape parameters of each case (see select_sigmas).
+    """
+    nr_cases, nr_models = targets_mean.shape
+    chunk_size = max(1, 2**24 // (sigmas_q.shape[1] * sigmas_i.shape[1] * nr_models**2))
+    inside_ratio = []
+    for idx in range(0, nr_cases, chunk_size):
+        chunk = slice(idx, idx + chunk_size)
+        weights_sigmas = calculate_weights_sigmas_batched(
+            delta_i[chunk], sigmas_q[chunk], sigmas_i[chunk])
+        inside_ratio.append(perfect_model_test_batched(
+            targets_mean[chunk], weights_sigmas,
+            perc_lower=cfg.percentiles[0],
+            perc_upper=cfg.percentiles[1]))
+    inside_ratio = np.concatenate(inside_ratio)
+
+    idx_q_min, idx_i_min = np.array([select_sigmas(ir, cfg) for ir in inside_ratio]).T
+    return (sigmas_q[np.arange(nr_cases), idx_q_min],
+            sigmas_i[np.arange(nr_cases), idx_i_min])
 
 
 def calc_weights(delta_q, delta_i, sigma_q, sigma_i, cfg):
@@ -675,8 +1202,14 @@ def calc_weights(delta_q, delta_i, sigma_q, sigma_i, cfg):
     Returns
     -------
     weights : xarray.Dataset
-        A Dataset containing several DataArrays.
+        A Dataset containing several DataArrays. In the all-regions mode
+        the weights are calculated separately for each region and all
+        DataArrays have the additional dimension region.
     """
+    if 'region' in delta_i.dims:
+        return per_region(
+            calc_weights, delta_i['region'].data, delta_q, delta_i, sigma_q, sigma_i, cfg)
+
     # make sure the perfect model dimension is still the first one!
     delta_i = delta_i.transpose('perfect_model_ensemble', 'model_ensemble')
 
@@ -765,6 +1298,219 @@ def calc_weights(delta_q, delta_i, sigma_q, sigma_i, cfg):
     return ds
 
 
+def calc_subsets(delta_q, delta_i, targets, sigma_i_variants, cfg, n_sigmas=50):
+    """
+    Calculate sigmas and weights for random subsets of the models.
+
+    Draws subset_samples subsets of subset_size models from the full pool
+    (without replacement within a subset). For each subset the sigmas are
+    estimated with the perfect model test on the corresponding rows and
+    columns of delta_i (see calc_sigmas_batched) and the weights of all
+    subsets are calculated at once.
+
+    Parameters
+    ----------
+    delta_q : xarray.DataArray, shape (N,)
+    delta_i : xarray.DataArray, shape (N, N)
+    targets : None or xarray.DataArray
+        Only needed if the sigmas are not given by the user.
+    sigma_i_variants : None or ndarray
+        See calc_deltas.
+    cfg : configuration object
+        See read_config() docstring for more information.
+
+    Returns
+    -------
+    weights : xarray.Dataset
+        A Dataset containing weights with shape (subset, model_ensemble).
+    """
+    models = delta_q['model_ensemble'].data
+    if cfg.subset_size > len(models):
+        raise ValueError(f'subset_size ({cfg.subset_size}) > number of models ({len(models)})')
+
+    # make sure the perfect model dimension is still the first one!
+    delta_i = delta_i.transpose('perfect_model_ensemble', 'model_ensemble')
+
+    rng = np.random.default_rng(cfg.subset_seed)
+    masks = np.zeros((cfg.subset_samples, len(models)), dtype=bool)
+    for mask in masks:
+        mask[rng.choice(len(models), cfg.subset_size, replace=False)] = True
+
+    if cfg.sigma_i is not None and cfg.sigma_q is not None:
+        logger.info('Using user sigmas: q={}, i={}'.format(cfg.sigma_q, cfg.sigma_i))
+        sigmas_q = np.full(cfg.subset_samples, float(cfg.sigma_q))
+        sigmas_i = np.full(cfg.subset_samples, float(cfg.sigma_i))
+    else:
+        if targets is None:
+            raise ValueError('target_diagnostic is needed to estimate the sigmas')
+        targets_mean = area_weighted_mean(targets)
+        targets_mean = process_variants_target(targets_mean, cfg).data
+
+        # all subsets have the same size: stack their models along a new dimension
+        idx_models = np.array([np.where(mask)[0] for mask in masks])
+        delta_i_sub = delta_i.data[idx_models[:, :, None], idx_models[:, None, :]]
+        sigmas_q_sub, sigmas_i_sub = map(np.array, zip(*[
+            get_sigma_ranges(dd, sigma_i_variants, cfg, n_sigmas) for dd in delta_i_sub]))
+
+        sigmas_q, sigmas_i = calc_sigmas_batched(
+            targets_mean[idx_models], delta_i_sub, sigmas_q_sub, sigmas_i_sub, cfg)
+
+    weights, numerator, denominator = calculate_weights_subsets(
+        delta_q.data, delta_i.data, sigmas_q, sigmas_i, masks)
+    logger.info('Calculated weights for {} subsets of {} models (sigma_q: {:.4f}+-{:.4f};'
+                ' sigma_i: {:.4f}+-{:.4f})'.format(
+                    cfg.subset_samples, cfg.subset_size, sigmas_q.mean(), sigmas_q.std(),
+                    sigmas_i.mean(), sigmas_i.std()))
+
+    dims = ('subset', 'model_ensemble')
+    ds = xr.Dataset(coords={'subset': np.arange(cfg.subset_samples),
+                            'model_ensemble': models})
+    ds['weights'] = xr.DataArray(weights, dims=dims, attrs={
+        'units': '1',
+        'long_name': 'Normalized Model Weights',
+        'description': ' '.join([
+            '(weights_q/weights_i) / sum(weights_q/weights_i) for each subset,',
+            '0 for models not in the subset'])})
+    ds['weights_q'] = xr.DataArray(numerator, dims=dims, attrs={
+        'units': '1',
+        'long_name': 'Quality Weights (not Normalized)',
+    })
+    ds['weights_i'] = xr.DataArray(denominator, dims=dims, attrs={
+        'units': '1',
+        'long_name': 'Independence Weights (not Normalized)',
+        'description': 'Higher values mean more dependence!',
+    })
+    ds['subset_mask'] = xr.DataArray(masks.astype(np.int8), dims=dims, attrs={
+        'units': '1',
+        'long_name': 'Models in Subset',
+        'description': '1 if a model is part of the subset, 0 otherwise',
+    })
+    ds['delta_q'] = delta_q
+    ds['delta_i'] = delta_i
+    ds['sigma_q'] = xr.DataArray(sigmas_q, dims='subset', attrs={
+        'units': '1',
+        'long_name': 'Observational Distance Shape Parameter',
+    })
+    ds['sigma_i'] = xr.DataArray(sigmas_i, dims='subset', attrs={
+        'units': '1',
+        'long_name': 'Model Distance Shape Parameter',
+    })
+    ds.attrs.update({
+        'subset_samples': cfg.subset_samples,
+        'subset_size': cfg.subset_size,
+        'subset_seed': str(cfg.subset_seed),
+    })
+    return ds
+
+
+def calc_bootstrap(performance_diagnostics, independence_diagnostics, targets, cfg):
+    """
+    Calculate the weights for random re-samplings of the model variants.
+
+    For each of the variants_bootstrap realizations variants_use variants per
+    model are drawn (see select_variants) and the diagnostics of the selected
+    variants are passed through calc_deltas and calc_weights. The perfect
+    model tests of all realizations (with the same number of models) are
+    performed at once (see calc_sigmas_batched). The diagnostics are only
+    calculated once for all variants.
+
+    Parameters
+    ----------
+    performance_diagnostics : None or xarray.DataArray
+        See calc_performance()
+    independence_diagnostics : xarray.DataArray
+        See calc_independence()
+    targets : None or xarray.DataArray
+        See calc_target()
+    cfg : configuration object
+        See read_config() docstring for more information.
+
+    Returns
+    -------
+    weights : xarray.Dataset
+        A Dataset containing the output of calc_weights for each
+        realization. Variables on the variant dimension contain all variants,
+        the weights of variants which are not selected are zero.
+    """
+    variants = independence_diagnostics['model_ensemble'].data
+    rng = np.random.default_rng(cfg.variants_seed)
+
+    selections, deltas = [], []
+    for realization in range(cfg.variants_bootstrap):
+        _, selected = select_variants(list(variants), cfg.variants_use, 'random', rng)
+        perf = None if performance_diagnostics is None else \
+            performance_diagnostics.sel(model_ensemble=selected)
+        indep = independence_diagnostics.sel(
+            model_ensemble=selected, perfect_model_ensemble=selected)
+        selections.append(selected)
+        deltas.append(calc_deltas(perf, indep, cfg))
+
+    sigmas = [(cfg.sigma_q, cfg.sigma_i)] * cfg.variants_bootstrap
+    if targets is not None and (cfg.sigma_q is None or cfg.sigma_i is None):
+        # group the realizations by the shape of their perfect model test
+        cases = {}
+        for realization, (selected, (_, delta_i, sigma_i_variants)) in enumerate(
+                zip(selections, deltas)):
+            sigmas_q, sigmas_i = get_sigma_ranges(delta_i, sigma_i_variants, cfg)
+            if len(sigmas_q) == 1 and len(sigmas_i) == 1:
+                sigmas[realization] = sigmas_q[0], sigmas_i[0]
+                continue
+            targets_mean, delta_i_1ens, sigmas_i = prepare_perfect_model_test(
+                targets.sel(model_ensemble=selected), delta_i, sigmas_i, cfg)
+            case = (np.asarray(targets_mean), np.asarray(delta_i_1ens), sigmas_q, sigmas_i)
+            cases.setdefault(tuple(np.shape(arr) for arr in case), []).append(
+                (realization, *case))
+        for group in cases.values():
+            realizations, *arrays = map(np.array, zip(*group))
+            for realization, sigma_q, sigma_i in zip(
+                    realizations, *calc_sigmas_batched(*arrays, cfg)):
+                sigmas[realization] = sigma_q, sigma_i
+
+    ds_list, masks, weights_variants = [], [], []
+    for selected, (delta_q, delta_i, _), (sigma_q, sigma_i) in zip(selections, deltas, sigmas):
+        ds = calc_weights(delta_q, delta_i, sigma_q, sigma_i, cfg)
+        if targets is not None and cfg.variants_combine:
+            ds[f'{cfg.target_diagnostic}_mean'] = process_variants_target(
+                targets.sel(model_ensemble=selected), cfg)
+
+        # weight of each variant (split equally if variants are combined)
+        weights = dict.fromkeys(variants, 0.)
+        if cfg.variants_combine:
+            for weight, model_ensemble in zip(
+                    ds['weights'].data, get_model_variants(selected)):
+                for variant in model_ensemble:
+                    weights[variant] = weight / len(model_ensemble)
+        else:
+            weights.update(zip(ds['model_ensemble'].data, ds['weights'].data))
+        weights_variants.append([*weights.values()])
+        masks.append(np.isin(variants, selected))
+        ds_list.append(ds)
+
+    ds = xr.concat(ds_list, dim='realization', join='outer')
+    ds['realization'] = np.arange(cfg.variants_bootstrap)
+    ds['weights_variants'] = xr.DataArray(
+        weights_variants, dims=('realization', 'variant'),
+        coords={'variant': variants},
+        attrs={
+            'units': '1',
+            'long_name': 'Normalized Weights per Variant',
+            'description': 'Weights of each variant, 0 for variants not selected',
+        })
+    ds['variant_mask'] = xr.DataArray(
+        np.array(masks, dtype=np.int8), dims=('realization', 'variant'),
+        attrs={
+            'units': '1',
+            'long_name': 'Selected Variants',
+            'description': '1 if a variant is selected in a realization, 0 otherwise',
+        })
+    logger.info('Calculated weights for {} realizations (sigma_q: {:.4f}+-{:.4f};'
+                ' sigma_i: {:.4f}+-{:.4f})'.format(
+                    cfg.variants_bootstrap,
+                    float(ds['sigma_q'].mean()), float(ds['sigma_q'].std()),
+                    float(ds['sigma_i'].mean()), float(ds['sigma_i'].std())))
+    return ds
+
+
 def save_data(ds, targets, clim, filenames, cfg):
     """Save the given Dataset to a file.
 
@@ -783,6 +1529,8 @@ def save_data(ds, targets, clim, filenames, cfg):
     -------
     None
     """
+    # restore the (lat, lon) dimensions of fields in the cells layout
+    targets, clim = [None if da is None else from_cells(da) for da in [targets, clim]]
     if targets is not None:
         targets = targets.sel(model_ensemble=natsorted(targets['model_ensemble'].data))
         if cfg.variants_combine:  # targets still has all variants!
@@ -793,9 +1541,10 @@ def save_data(ds, targets, clim, filenames, cfg):
 
         # save additional variables for convenience
         ds[cfg.target_diagnostic] = targets
+        varn = expand_diagnostic(cfg.target_diagnostic)[1][0]
         ds['filename'] = xr.DataArray(
-            [*filenames[cfg.target_diagnostic].values()],
-            coords={'model_ensemble': [*filenames[cfg.target_diagnostic].keys()]},
+            [*filenames[varn].values()],
+            coords={'model_ensemble': [*filenames[varn].keys()]},
             dims='model_ensemble',
             attrs={
                 'units': '1',
@@ -812,7 +1561,38 @@ def save_data(ds, targets, clim, filenames, cfg):
             ds[f'{cfg.target_diagnostic}_clim_mean'] = clim_mean
         ds[f'{cfg.target_diagnostic}_clim'] = clim
 
-    # add some metadata
+    write_data(ds, cfg)
+
+
+def save_bootstrap(ds, targets, clim, filenames, cfg):
+    """Same as save_data for the output of calc_bootstrap."""
+    targets, clim = [None if da is None else from_cells(da) for da in [targets, clim]]
+    if targets is not None:
+        targets = targets.rename({'model_ensemble': 'variant'})
+        ds[cfg.target_diagnostic] = targets.sel(variant=ds['variant'])
+        varn = expand_diagnostic(cfg.target_diagnostic)[1][0]
+        ds['filename'] = xr.DataArray(
+            [filenames[varn][variant] for variant in ds['variant'].data],
+            dims='variant',
+            attrs={
+                'units': '1',
+                'long_name': 'Full Path and Filename',
+            })
+
+        ds.attrs['target'] = cfg.target_diagnostic
+        ds.attrs['region'] = cfg.target_region
+
+    if clim is not None:
+        clim = clim.rename({'model_ensemble': 'variant'})
+        ds[f'{cfg.target_diagnostic}_clim'] = clim.sel(variant=ds['variant'])
+
+    ds.attrs['variants_bootstrap'] = cfg.variants_bootstrap
+    ds.attrs['variants_seed'] = str(cfg.variants_seed)
+    write_data(ds, cfg)
+
+
+def write_data(ds, cfg):
+    """Add metadata to the given Dataset and write it to <save_path>/<config>.nc"""
     ds.attrs.update({
         'config': cfg.config,
         'config_path': cfg.config_path,
@@ -830,25 +1610,74 @@ def save_data(ds, targets, clim, filenames, cfg):
     logger.info('Saved file: {}'.format(filename))
 
 
-def main(args):
-    """Call functions"""
+def run_config(config, filename, cache=None, resume=False):
+    """Run one configuration (see main)"""
     log = utils.LogTime()
 
     log.start('main().read_config()')
-    cfg = read_config(args.config, args.filename)
+    cfg = read_config(config, filename)
+    checkpoint = Checkpoint(cfg, resume)
 
     log.start('main().set_up_filenames(**kwargs)')
-    filenames = get_filenames(cfg)
+    filenames = checkpoint('filenames', get_filenames, cfg, cache)
+
+    stages = ['independence']
+    if cfg.performance_diagnostics is not None and cfg.obs_id is not None:
+        stages.append('performance')
+    if cfg.target_diagnostic is not None:
+        stages.append('targets')
+
+    log.start('main().calc_diagnostics(**kwargs)')
+    if checkpoint.done(*stages):
+        diagnostics = None  # not needed by any remaining stage
+    else:
+        diagnostics = calc_diagnostics(filenames, cfg, cache)
 
     log.start('main().calc_predictors(**kwargs)')
-    if cfg.performance_diagnostics is None or cfg.obs_id is None:
-        performance_diagnostics = None
+    if 'performance' in stages:
+        performance_diagnostics = checkpoint(
+            'performance', calc_performance, diagnostics, cfg, cache)
     else:
-        performance_diagnostics = calc_performance(filenames, cfg)
-    independence_diagnostics = calc_independence(filenames, cfg)
+        performance_diagnostics = None
+    independence_diagnostics = checkpoint(
+        'independence', calc_independence, diagnostics, cfg, cache)
+
+    if cfg.variants_bootstrap is not None:
+        if cfg.target_diagnostic is None:
+            targets, clim = None, None
+        else:
+            log.start('main().calc_target(**kwargs)')
+            targets, clim = checkpoint('targets', calc_target, diagnostics, cfg)
+        log.start('main().calc_bootstrap(**kwargs)')
+        weights = checkpoint(
+            'bootstrap', calc_bootstrap, performance_diagnostics,
+            independence_diagnostics, targets, cfg)
+
+        log.start('main().save_data(**kwargs)')
+        save_bootstrap(weights, targets, clim, filenames, cfg)
+        log.stop
+        checkpoint.remove()  # the run is complete
+        return
 
     log.start('main().calc_deltas(**kwargs)')
-    delta_q, delta_i, sigma_i_variants = calc_deltas(performance_diagnostics, independence_diagnostics, cfg)
+    delta_q, delta_i, sigma_i_variants = checkpoint(
+        'deltas', calc_deltas, performance_diagnostics, independence_diagnostics, cfg)
+
+    if cfg.subset_samples is not None:
+        if cfg.target_diagnostic is None:
+            targets, clim = None, None
+        else:
+            log.start('main().calc_target(**kwargs)')
+            targets, clim = checkpoint('targets', calc_target, diagnostics, cfg)
+        log.start('main().calc_subsets(**kwargs)')
+        weights = checkpoint(
+            'subsets', calc_subsets, delta_q, delta_i, targets, sigma_i_variants, cfg)
+
+        log.start('main().save_data(**kwargs)')
+        save_data(weights, targets, clim, filenames, cfg)
+        log.stop
+        checkpoint.remove()  # the run is complete
+        return
 
     if cfg.target_diagnostic is None:
         logger.info('Using user sigmas: q={}, i={}'.format(cfg.sigma_q, cfg.sigma_i))
@@ -858,9 +1687,10 @@ def main(args):
         clim = None
     else:
         log.start('main().calc_target(**kwargs)')
-        targets, clim = calc_target(filenames[cfg.target_diagnostic], cfg)
+        targets, clim = checkpoint('targets', calc_target, diagnostics, cfg)
         log.start('main().calc_sigmas(**kwargs)')
-        sigma_q, sigma_i = calc_sigmas(targets, delta_i, sigma_i_variants, cfg)
+        sigma_q, sigma_i = checkpoint(
+            'sigmas', calc_sigmas, targets, delta_i, sigma_i_variants, cfg)
 
     log.start('main().calc_weights(**kwargs)')
     weights = calc_weights(delta_q, delta_i, sigma_q, sigma_i, cfg)
@@ -872,6 +1702,26 @@ def main(args):
     if cfg.plot:
         logger.info('Plots are at: {}'.format(
             os.path.join(cfg.plot_path, cfg.config)))
+    checkpoint.remove()  # the run is complete
+
+
+def main(args):
+    """Call functions"""
+    configs = args.configs
+    if args.all_sections:
+        config = ConfigParser()
+        config.read(os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), args.filename))
+        configs = config.sections()
+
+    if len(configs) == 1:
+        return run_config(configs[0], args.filename, resume=args.resume)
+
+    # share files, diagnostics, and distances between configurations
+    cache = {}
+    for config in configs:
+        with utils.LogTime(f'Configuration {config}'):
+            run_config(config, args.filename, cache, args.resume)
 
 
 if __name__ == "__main__":
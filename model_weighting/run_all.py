@@ -9,11 +9,17 @@ Authors:
 
 Abstract: A convenience function which calls model_weighting with all
 [sections] from a given configuration file (excluding [DEFAULT]).
+
+Sections are run concurrently by a given number of workers, each in its own
+process and with its own logfile. Failed sections are retried and a summary
+of the status and runtime of each section is written to the main logfile.
 """
 import os
 import argparse
+import subprocess
 from datetime import datetime
 from configparser import ConfigParser
+from concurrent.futures import ThreadPoolExecutor
 
 now = datetime.today().strftime('%Y%m%d_%H%M%S')
 
@@ -21,6 +27,14 @@ parser = argparse.ArgumentParser()
 parser.add_argument(dest='filename', help='Relative path of the config file.')
 parser.add_argument('-p', dest='paper', action='store_true',
                     help='Save to a dedicated folder for easier tracking')
+parser.add_argument('--workers', '-n', dest='workers', default=1, type=int,
+                    help='Number of sections to run at the same time')
+parser.add_argument('--memory-limit', '-m', dest='memory_limit', default=None, type=float,
+                    help=' '.join([
+                        'Maximum memory per section in GB (limits the virtual address',
+                        'space, RLIMIT_AS, which is larger than the resident memory)']))
+parser.add_argument('--retries', '-r', dest='retries', default=1, type=int,
+                    help='Number of times a failed section is restarted')
 args = parser.parse_args()
 config = ConfigParser()
 config.read(args.filename)
@@ -32,17 +46,65 @@ if args.paper:
     logname = os.path.join('logfiles_paper', logname)
 else:
     logname = os.path.join('logfiles', logname)
+logdir = logname.replace('.log', '')  # one logfile per section
+os.makedirs(logdir, exist_ok=True)
+
+
+# set the limit in a launcher and replace it by the section (preexec_fn is not
+# safe if other threads are running)
+LIMIT_MEMORY = '; '.join([
+    'import os, sys, resource',
+    'limit = int(sys.argv[1])',
+    'resource.setrlimit(resource.RLIMIT_AS, (limit, limit))',
+    'os.execvp(sys.argv[2], sys.argv[2:])'])
+
+
+def get_command(section, section_logname):
+    """Command running one section (with the memory limit if given)."""
+    command = ['python', 'model_weighting_main.py', section,
+               '-f', args.filename, '-log-file', section_logname]
+    if args.memory_limit is not None:
+        command = ['python', '-c', LIMIT_MEMORY,
+                   str(int(args.memory_limit * 1024**3)), *command]
+    return ['nice', *command]
+
+
+def run_section(section):
+    """Run one section (with retries) and return its status and runtime."""
+    section_logname = os.path.join(logdir, f'{section}.log')
+    t0 = datetime.now()
+    for attempt in range(args.retries + 1):
+        with open(section_logname, 'a') as logfile:
+            logfile.write('-' * 79)
+            logfile.write('\n{0} {1} (attempt {2}) {0}\n'.format('-' * 5, section, attempt + 1))
+            logfile.write('-' * 79)
+            logfile.write('\n')
+        with open(section_logname, 'a') as logfile:
+            returncode = subprocess.call(
+                get_command(section, section_logname),
+                stdout=logfile, stderr=subprocess.STDOUT)
+        if returncode == 0:
+            break
+    status = 'DONE' if returncode == 0 else f'FAIL ({returncode})'
+    return section, status, attempt + 1, datetime.now() - t0
+
 
 with open(logname, 'w') as logfile:
     logfile.write('=' * 79)
     logfile.write('\n{0} {1} {0}\n'.format('=' * 5, config_name))
     logfile.write('=' * 79)
+    logfile.write(f'\n\nLogfiles of the individual sections: {logdir}\n')
+
+with ThreadPoolExecutor(max_workers=args.workers) as pool:
+    results = list(pool.map(run_section, config.sections()))
 
-for section in config.sections():
-    with open(logname, 'a') as logfile:
-        logfile.write('\n\n')
-        logfile.write('-' * 79)
-        logfile.write('\n{0} {1} {0}\n'.format('-' * 5, section))
-        logfile.write('-' * 79)
-        logfile.write('\n')
-    os.system(f'nice python model_weighting_main.py {section} -f {args.filename} -log-file {logname}')
+summary = '\n'.join([
+    '',
+    '{:<40} {:<12} {:>8} {:>16}'.format('section', 'status', 'attempts', 'runtime'),
+    '-' * 79,
+    *['{:<40} {:<12} {:>8} {:>16}'.format(section, status, attempts, str(runtime))
+      for section, status, attempts, runtime in results],
+    ''])
+with open(logname, 'a') as logfile:
+    logfile.write(summary)
+print(summary)
@@ -7,12 +7,15 @@
 Authors:
 - Lukas Brunner || lukas.brunner@env.ethz.ch
 
-Abstract:
-
+Abstract: Screen the performance_diagnostics of a configuration as potential
+constraints (predictors) of the target. Each predictor is calculated once for
+all models, then the scores of all predictors and the correlation between
+all pairs of predictors are calculated at once.
 """
 import os
 import argparse
 import logging
+import warnings
 import traceback
 import numpy as np
 import xarray as xr
@@ -20,7 +23,9 @@ from scipy import stats
 # from sklearn.linear_model import TheilSenRegressor as TSR
 import matplotlib.pyplot as plt
 import seaborn as sns
+from itertools import repeat
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 # from sklearn import linear_model
 from sklearn.linear_model import (LinearRegression,
@@ -31,12 +36,17 @@ from sklearn.linear_model import (LinearRegression,
                                   # RandomizedLasso,
                                   BayesianRidge,
                                   TheilSenRegressor)
-from sklearn.feature_selection import f_regression
 
 from core import utils
-from core.get_filenames import get_filenames
+from core.get_filenames import get_filenames_var, select_variants
 from core.diagnostics import calculate_diagnostic
+from core.diagnostic_graph import (
+    DiagnosticGraph,
+    expand_diagnostic,
+    get_diagnostic_settings,
+)
 from core.read_config import read_config
+from core.series_store import SeriesStore, is_supported
 from core.utils_xarray import area_weighted_mean
 
 
@@ -54,92 +64,338 @@ def read_args():
     parser.add_argument(
         '--filename', '-f', dest='filename', default='configs/config.ini',
         help='Relative or absolute path/filename.ini of the config file.')
+    parser.add_argument(
+        '--maps', dest='maps', action='store_true',
+        help='Also write a map of the correlation with the target for each predictor.')
+    parser.add_argument(
+        '--theil-sen', dest='theil_sen', default='sklearn',
+        choices=['sklearn', 'exact', 'auto'],
+        help=' '.join([
+            'Theil-Sen method: sklearn (TheilSenRegressor), exact (median of',
+            'pairwise slopes, a different estimator with different scores), or',
+            'auto (exact for up to 500 models, sklearn otherwise).']))
+    parser.add_argument(
+        '--workers', '-w', dest='max_workers', default=None, type=int,
+        help='Number of processes used for the sklearn Theil-Sen regression.')
+    parser.add_argument(
+        '--seed', dest='seed', default=0, type=int,
+        help='Random seed of the sklearn Theil-Sen regression.')
     return parser.parse_args()
 
 
-def calc_target(filenames, cfg):
-    # build and create path
-    base_path = os.path.join(cfg.save_path, cfg.target_diagnostic)
-    os.makedirs(base_path, exist_ok=True)
-
-    targets = []
-    for model_ensemble, filename in filenames[cfg.target_diagnostic].items():
-        target = calculate_diagnostic(
-            infile=filename,
-            diagn=cfg.target_diagnostic,
-            id_=model_ensemble.split('_')[2],
-            base_path=base_path,
-            time_period=(
-                cfg.target_startyear,
-                cfg.target_endyear),
-            season=cfg.target_season,
-            time_aggregation=cfg.target_agg,
-            mask_land_sea=cfg.target_mask,
-            region=cfg.target_region,
-            overwrite=cfg.overwrite,
-            idx_lats=None,
-            idx_lons=None,
-        )
-
-        # calculate change rather than absolute value
-        if cfg.target_startyear_ref is not None:
-            target_hist = calculate_diagnostic(
-                infile=filename,
-                id_=model_ensemble.split('_')[2],
-                diagn=cfg.target_diagnostic,
-                base_path=base_path,
-                time_period=(
-                    cfg.target_startyear_ref,
-                    cfg.target_endyear_ref),
-                season=cfg.target_season,
-                time_aggregation=cfg.target_agg,
-                mask_land_sea=cfg.target_mask,
-                region=cfg.target_region,
-                overwrite=cfg.overwrite,
-                idx_lats=None,
-                idx_lons=None,
-            )
-            target[cfg.target_diagnostic] -= target_hist[cfg.target_diagnostic]
-
-        target['model_ensemble'] = xr.DataArray([model_ensemble], dims='model_ensemble')
-        targets.append(target)
-        logger.debug('Calculate diagnostics for file {}... DONE'.format(filename))
-
-    return area_weighted_mean(xr.concat(targets, dim='model_ensemble')[cfg.target_diagnostic])
-
-
-def calc_predictor(filenames, idx, cfg):
-    diagn = cfg.performance_diagnostics[idx]
-
-    base_path = os.path.join(cfg.save_path, diagn)
-    os.makedirs(base_path, exist_ok=True)
-
-    varn = [*diagn.values()][0][0] if isinstance(diagn, dict) else diagn
-    diagn_key = [*diagn.keys()][0] if isinstance(diagn, dict) else diagn
-
-    diagnostics = []
-    for model_ensemble, filename in filenames[varn].items():
-        diagnostic = calculate_diagnostic(
-            infile=filename,
-            id_=model_ensemble.split('_')[2],
+def get_filenames_screening(cfg):
+    """
+    Collect the files of all variables needed by the target or any predictor.
+
+    Each variable is only looked up once per archive. Models are selected
+    based on the target variable (see select_variants) and predictors which
+    are not available for a model are later set to NaN.
+
+    Returns
+    -------
+    filenames : nested dictionary
+        See get_filenames() docstring for more information. Contrary to
+        get_filenames not all variables are available for all models.
+    """
+    varns = set(expand_diagnostic(cfg.target_diagnostic)[1])
+    for diagn in cfg.performance_diagnostics:
+        varns.update(expand_diagnostic(diagn)[1])
+
+    filenames = {}
+    for varn in varns:
+        filenames[varn] = {}
+        for id_, scenario, base_path in zip(cfg.model_id, cfg.model_scenario, cfg.model_path):
+            try:
+                filenames[varn].update(
+                    get_filenames_var(varn, id_, scenario, base_path, cfg.catalog))
+            except AssertionError:
+                logger.warning(f'No files found for {varn}, {id_}, {scenario}')
+
+    model_ensembles = [*filenames[expand_diagnostic(cfg.target_diagnostic)[1][0]].keys()]
+    for varn in expand_diagnostic(cfg.target_diagnostic)[1]:
+        model_ensembles = [mm for mm in model_ensembles if mm in filenames[varn]]
+    if cfg.subset is not None:
+        model_ensembles = [mm for mm in model_ensembles if mm in cfg.subset]
+    _, model_ensembles = select_variants(model_ensembles, cfg.variants_use, cfg.variants_select)
+
+    return {varn: {mm: filenames[varn][mm] for mm in model_ensembles if mm in filenames[varn]}
+            for varn in varns}
+
+
+def _execute(graph, model_ensemble):
+    """Execute a graph, if it fails execute each diagnostic separately."""
+    try:
+        return graph.execute()
+    except Exception:
+        logger.error(f'Unexpected error encountered in {model_ensemble}, retry separately')
+    results = {}
+    for name in graph.diagnostics:
+        graph_name = DiagnosticGraph(graph.id_, graph.overwrite, graph.dtype)
+        graph_name.fields = OrderedDict(
+            (field_key, nodes) for field_key, nodes in graph.fields.items()
+            if nodes & set(graph.diagnostics[name]['nodes'] or [])
+            or nodes & set(graph.diagnostics[name]['nodes_global'] or []))
+        graph_name.diagnostics[name] = graph.diagnostics[name]
+        try:
+            results.update(graph_name.execute())
+        except Exception:
+            logger.error(f'Unexpected error encountered in {name} of {model_ensemble}')
+            logger.error(traceback.format_exc())
+    return results
+
+
+def calc_predictors(filenames, cfg, maps=False):
+    """
+    Calculate the target and all predictors for each model.
+
+    For each model all diagnostics are calculated in one diagnostic graph
+    (see core.diagnostic_graph), i.e., each field is only read once. If
+    cfg.series_store is given all diagnostics which are supported by the
+    store are calculated from the regional mean time series instead (see
+    core.series_store), i.e., model files are only read once per archive.
+
+    Parameters
+    ----------
+    filenames : nested dictionary
+        See get_filenames_screening()
+    cfg : configuration object
+    maps : bool, optional
+        If True also return the gridded predictors.
+
+    Returns
+    -------
+    predictors : xarray.DataArray, shape (D, N)
+        Area-weighted mean of each predictor (NaN if not available).
+    target : xarray.DataArray, shape (N,)
+        Change of the target relative to the reference period if given (NaN
+        if the reference period is not available for a model).
+    fields : OrderedDict, only if maps=True
+        Gridded predictors of shape (N, lat, lon). Keys are the indices of
+        the predictors (along the diagnostic dimension of predictors), since
+        several predictors can share the same diagnostic and aggregation.
+    """
+    # NOTE: not using get_diagnostic_settings for the predictors since
+    # observations are optional here
+    settings = OrderedDict()
+    for idx, diagn in enumerate(cfg.performance_diagnostics):
+        settings[('performance', idx)] = dict(
             diagn=diagn,
-            base_path=base_path,
-            time_period=(
-                cfg.performance_startyears[idx],
-                cfg.performance_endyears[idx]),
+            time_period=(cfg.performance_startyears[idx], cfg.performance_endyears[idx]),
             season=cfg.performance_seasons[idx],
             time_aggregation=cfg.performance_aggs[idx],
             mask_land_sea=cfg.performance_masks[idx],
             region=cfg.performance_regions[idx],
-            overwrite=cfg.overwrite,
-            idx_lats=None,
-            idx_lons=None,
         )
-
-        diagnostic['model_ensemble'] = xr.DataArray([model_ensemble], dims='model_ensemble')
-        diagnostics.append(diagnostic)
-
-    return area_weighted_mean(xr.concat(diagnostics, dim='model_ensemble')[diagn_key])
+    settings.update(get_diagnostic_settings(cfg, kinds=('target',)))
+    varn_target = expand_diagnostic(cfg.target_diagnostic)[1][0]
+    model_ensembles = [*filenames[varn_target].keys()]
+
+    keys = [f'{diagn}{agg}' for diagn, agg in zip(
+        cfg.performance_diagnostics, cfg.performance_aggs)]
+    data = np.full((len(cfg.performance_diagnostics), len(model_ensembles)), np.nan)
+    target = np.full(len(model_ensembles), np.nan)
+    fields = OrderedDict((idx, []) for idx in range(len(keys)))
+    series_store = None if cfg.series_store is None else SeriesStore(cfg.series_store)
+    for idx_model, model_ensemble in enumerate(model_ensembles):
+        infiles = {varn: filenames[varn][model_ensemble]
+                   for varn in filenames if model_ensemble in filenames[varn]}
+        id_ = model_ensemble.split('_')[2]
+        graph = DiagnosticGraph(id_, overwrite=cfg.overwrite, dtype=cfg.precision)
+        means = {}
+        for name, setting in settings.items():
+            key, varns = expand_diagnostic(setting['diagn'])
+            if not set(varns).issubset(infiles):
+                continue  # predictor not available for this model
+            if (series_store is not None and not (maps and name[0] == 'performance')
+                    and is_supported(id_=id_, **setting)):
+                try:
+                    means[name] = float(series_store.diagnostic(infiles, id_=id_, **setting)[0])
+                except Exception:
+                    logger.error(f'Unexpected error encountered in {name} of {model_ensemble}')
+                    logger.error(traceback.format_exc())
+                continue
+            base_path = os.path.join(cfg.save_path, key)
+            os.makedirs(base_path, exist_ok=True)
+            graph.add_diagnostic(name, infiles=infiles, base_path=base_path, **setting)
+        results = _execute(graph, model_ensemble)
+
+        for name, ds in results.items():
+            key = expand_diagnostic(settings[name]['diagn'])[0]
+            means[name] = float(area_weighted_mean(ds[key]))
+            if maps and name[0] == 'performance':
+                fields[name[1]].append(
+                    ds[key].expand_dims({'model_ensemble': [model_ensemble]}))
+        for (kind, idx), mean in means.items():
+            if kind == 'performance':
+                data[idx, idx_model] = mean
+        if ('target', None) in means:
+            if ('target_ref', None) in settings:
+                # NaN if the reference is missing (no absolute value among the changes)
+                target[idx_model] = (
+                    means[('target', None)] - means.get(('target_ref', None), np.nan))
+            else:
+                target[idx_model] = means[('target', None)]
+        logger.debug(f'Calculate diagnostics for {model_ensemble}... DONE')
+
+    predictors = xr.DataArray(
+        data, dims=('diagnostic', 'model_ensemble'),
+        coords={'diagnostic': keys, 'model_ensemble': model_ensembles})
+    target = xr.DataArray(target, dims='model_ensemble',
+                          coords={'model_ensemble': model_ensembles})
+    if maps:
+        fields = OrderedDict(
+            (idx, xr.concat(field, dim='model_ensemble').reindex(model_ensemble=model_ensembles))
+            for idx, field in fields.items() if len(field) > 0)
+        return predictors, target, fields
+    return predictors, target
+
+
+def correlation_map(field, target):
+    """
+    Correlation and regression slope between a target and a predictor field.
+
+    Calculated across models at every grid cell at once (models with missing
+    values are ignored for the respective cell).
+
+    Parameters
+    ----------
+    field : xarray.DataArray, shape (N, lat, lon)
+        Gridded predictor with dimension model_ensemble.
+    target : xarray.DataArray, shape (N,)
+
+    Returns
+    -------
+    ds : xarray.Dataset
+        Containing correlation, slope, and nr_models with shape (lat, lon).
+    """
+    field = field.transpose('model_ensemble', ...)
+    xx = field.data.astype(float)
+    yy = target.sel(model_ensemble=field['model_ensemble']).data.astype(float)
+    yy = np.broadcast_to(yy.reshape((-1,) + (1,) * (xx.ndim - 1)), xx.shape)
+    valid = ~np.isnan(xx) & ~np.isnan(yy)
+    xx, yy = np.where(valid, xx, 0.), np.where(valid, yy, 0.)
+
+    nr = valid.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_x = xx.sum(axis=0) / nr
+        mean_y = yy.sum(axis=0) / nr
+        anom_x = np.where(valid, xx - mean_x, 0.)
+        anom_y = np.where(valid, yy - mean_y, 0.)
+        cov = (anom_x * anom_y).sum(axis=0)
+        var_x = (anom_x**2).sum(axis=0)
+        var_y = (anom_y**2).sum(axis=0)
+        slope = cov / var_x
+        corr = cov / np.sqrt(var_x * var_y)
+    slope[nr < 3] = np.nan
+    corr[nr < 3] = np.nan
+
+    dims = field.dims[1:]
+    coords = {dim: field[dim] for dim in dims if dim in field.coords}
+    ds = xr.Dataset(coords=coords)
+    ds['correlation'] = xr.DataArray(corr, dims=dims, attrs={
+        'units': '1',
+        'long_name': 'Correlation between Predictor and Target across Models',
+    })
+    ds['slope'] = xr.DataArray(slope, dims=dims, attrs={
+        'units': f'{target.attrs.get("units", "1")} / ({field.attrs.get("units", "1")})',
+        'long_name': 'Regression Slope of Target on Predictor across Models',
+    })
+    ds['nr_models'] = xr.DataArray(nr, dims=dims, attrs={
+        'units': '1',
+        'long_name': 'Number of Models',
+    })
+    return ds
+
+
+def predictor_name(idx, cfg):
+    """Unique name of a predictor, e.g., tasCLIM_JJA_EUR_1981-2010 (prefixed by its index)."""
+    return '_'.join([
+        f'{idx:02d}',
+        f'{cfg.performance_diagnostics[idx]}{cfg.performance_aggs[idx]}',
+        cfg.performance_seasons[idx],
+        cfg.performance_regions[idx],
+        f'{cfg.performance_startyears[idx]}-{cfg.performance_endyears[idx]}',
+    ] + ([str(cfg.performance_masks[idx])] if cfg.performance_masks[idx] else []))
+
+
+def save_correlation_maps(fields, target, cfg):
+    """Write one correlation map per predictor to <save_path>/<config>_maps/ (see predictor_name)."""
+    path = os.path.join(cfg.save_path, f'{cfg.config}_maps')
+    os.makedirs(path, exist_ok=True)
+    for idx, field in fields.items():
+        ds = correlation_map(field, target)
+        ds.attrs.update({
+            'predictor': f'{cfg.performance_diagnostics[idx]}{cfg.performance_aggs[idx]}',
+            'predictor_season': cfg.performance_seasons[idx],
+            'predictor_region': cfg.performance_regions[idx],
+            'predictor_period': (
+                f'{cfg.performance_startyears[idx]}-{cfg.performance_endyears[idx]}'),
+            'target': cfg.target_diagnostic,
+            'target_region': cfg.target_region,
+            'config': cfg.config,
+            'config_path': cfg.config_path,
+        })
+        filename = os.path.join(path, f'{predictor_name(idx, cfg)}.nc')
+        ds.to_netcdf(filename)
+        logger.info(f'Saved file: {filename}')
+
+
+def masked_corrcoef(data):
+    """
+    Correlation matrix of all rows using pairwise complete observations.
+
+    Parameters
+    ----------
+    data : array_like, shape (D, N)
+        D variables with N observations each (may contain NaN).
+
+    Returns
+    -------
+    corr : ndarray, shape (D, D)
+        Same as np.corrcoef(data) if data contains no NaN.
+    nr : ndarray, shape (D, D)
+        Number of observations used for each pair.
+    """
+    data = np.asarray(data, dtype=float)
+    mask = ~np.isnan(data)
+    if np.all(mask):
+        return np.corrcoef(data), np.full((data.shape[0],) * 2, data.shape[1])
+
+    mask = mask.astype(float)
+    data = np.where(mask, data, 0.)
+    nr = mask @ mask.T
+    sum_x = data @ mask.T  # sum_x[i, j]: sum of x_i where x_i and x_j are valid
+    sum_xx = data**2 @ mask.T
+    sum_xy = data @ data.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = nr * sum_xy - sum_x * sum_x.T
+        var = nr * sum_xx - sum_x**2
+        corr = cov / np.sqrt(var * var.T)
+    corr[nr < 2] = np.nan
+    return corr, nr.astype(int)
+
+
+def calc_scores(predictors, target):
+    """
+    Calculate the scores of all predictors at once.
+
+    Parameters
+    ----------
+    predictors : array_like, shape (D, N)
+    target : array_like, shape (N,)
+
+    Returns
+    -------
+    r2, ff, nr : ndarray, shape (D,)
+        Coefficient of determination (same as stats.linregress), F-statistic
+        (same as sklearn.feature_selection.f_regression), and number of
+        models used for each predictor.
+    """
+    corr, nr = masked_corrcoef(np.vstack([predictors, target]))
+    rr, nr = corr[-1, :-1], nr[-1, :-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ff = rr**2 / (1 - rr**2) * (nr - 2)
+    return rr**2, ff, nr
 
 
 def calc_obs(diagn, idx, cfg):
@@ -272,8 +528,7 @@ def plot(xx, yy, obs, reg, idx, cfg):
     fn = ''.join([
         'Correlation_',
         cfg.target_diagnostic, cfg.target_agg, '_',
-        cfg.performance_diagnostics[idx], cfg.performance_aggs[idx],
-        str(cfg.performance_startyears[idx]), '-', str(cfg.performance_endyears[idx]),
+        predictor_name(idx, cfg),
         '.png'
     ])
 
@@ -282,126 +537,153 @@ def plot(xx, yy, obs, reg, idx, cfg):
     plt.close()
 
 
-def calc_correlation(predictor, target, obs):
-
-    def _theil_sen(xx, yy):
-        """
-
-        Returns
-        -------
-        coef_ : float
-        """
-        reg = TheilSenRegressor().fit(xx, yy)
-        return reg.score(xx, yy)
-
-    def _f_regression(xx, yy):
-        """
-        Univariate linear regression tests.
-
-        Returns
-        -------
-        ff : float
-            F values of features.
-        pvalue : float
-            p-values of F-scores.
-        """
-        return f_regression(xx, yy, center=True)[0][0]
-
-    scores = {}
-    reg = stats.linregress(predictor, target)
-    scores['stats.linregress'] = reg.rvalue**2
-    scores['sklearn.TheilSenRegressor'] = _theil_sen(predictor.reshape(-1, 1), target)
-    scores['sklearn.f_regression'] = _f_regression(predictor.reshape(-1, 1), target)
-
-    return scores, reg
+def theil_sen_exact(predictors, target):
+    """
+    Exact Theil-Sen regression score of all predictors at once.
+
+    The slope is the median of the slopes between all pairs of models, the
+    intercept the median of target - slope * predictor. NOTE: this is not
+    the same estimator as sklearn.linear_model.TheilSenRegressor (which uses
+    the spatial median of the least-squares solutions of sub-populations),
+    so the scores differ.
+
+    Parameters
+    ----------
+    predictors : array_like, shape (D, N)
+        May contain NaN (pairs with missing values are ignored).
+    target : array_like, shape (N,)
+
+    Returns
+    -------
+    score : ndarray, shape (D,)
+        Coefficient of determination of the Theil-Sen fit (same definition
+        as sklearn.linear_model.TheilSenRegressor.score).
+    """
+    xx = np.atleast_2d(np.asarray(predictors, dtype=float))
+    yy = np.broadcast_to(np.asarray(target, dtype=float), xx.shape)
+    yy = np.where(np.isnan(xx), np.nan, yy)
+    xx = np.where(np.isnan(yy), np.nan, xx)
+
+    idx1, idx2 = np.triu_indices(xx.shape[1], k=1)
+    dx = xx[:, idx2] - xx[:, idx1]
+    dy = yy[:, idx2] - yy[:, idx1]
+    dx[dx == 0] = np.nan  # vertical pairs have no slope
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)  # all-NaN rows
+        slope = np.nanmedian(dy / dx, axis=-1)
+        intercept = np.nanmedian(yy - slope[:, None] * xx, axis=-1)
+        residuals = yy - (intercept[:, None] + slope[:, None] * xx)
+        ss_res = np.nansum(residuals**2, axis=-1)
+        ss_tot = np.nansum((yy - np.nanmean(yy, axis=-1, keepdims=True))**2, axis=-1)
+        return 1 - ss_res / ss_tot
+
+
+def _theil_sen_sklearn(xx, yy, random_state=None):
+    """Score of sklearn.linear_model.TheilSenRegressor (for the process pool)."""
+    valid = ~np.isnan(xx) & ~np.isnan(yy)
+    xx, yy = xx[valid].reshape(-1, 1), yy[valid]
+    return TheilSenRegressor(random_state=random_state).fit(xx, yy).score(xx, yy)
+
+
+def theil_sen_scores(predictors, target, method='sklearn', max_workers=None, seed=0,
+                     max_exact=500):
+    """
+    Theil-Sen regression score of each predictor.
+
+    Parameters
+    ----------
+    predictors : array_like, shape (D, N)
+    target : array_like, shape (N,)
+    method : {'sklearn', 'exact', 'auto'}, optional
+        * sklearn (default): TheilSenRegressor (with sub-population sampling
+          for large N) fitted for each predictor in a process pool
+        * exact: see theil_sen_exact (faster, but a different estimator)
+        * auto: exact if N <= max_exact, otherwise sklearn
+    max_workers : int, optional
+        Number of processes (only used for method sklearn).
+    seed : int, optional
+        random_state of TheilSenRegressor to make the scores reproducible.
+
+    Returns
+    -------
+    score : ndarray, shape (D,)
+    """
+    predictors = np.asarray(predictors, dtype=float)
+    target = np.asarray(target, dtype=float)
+    if method == 'auto':
+        method = 'exact' if predictors.shape[1] <= max_exact else 'sklearn'
+    if method == 'exact':
+        return theil_sen_exact(predictors, target)
+    if method != 'sklearn':
+        raise ValueError(f'method has to be one of auto, exact, sklearn not {method}')
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        return np.array([*pool.map(
+            _theil_sen_sklearn, predictors, repeat(target), repeat(seed))])
 
 
 def main():
     cfg = read_config(args.config, args.filename)
 
     diagns = cfg.performance_diagnostics
-
-    scores_list = []
-    nr_models = []
-    pointless = []
-    nr_obs = []
-    cfg.independence_diagnostics = None
+    keys = [f'{diagn}{agg}' for diagn, agg in zip(diagns, cfg.performance_aggs)]
+
+    logger.info('Get filenames')
+    filenames = get_filenames_screening(cfg)
+    logger.info(f'Calculate target and {len(diagns)} predictors')
+    if args.maps:
+        predictors, target, fields = calc_predictors(filenames, cfg, maps=True)
+        save_correlation_maps(fields, target, cfg)
+    else:
+        predictors, target = calc_predictors(filenames, cfg)
+
+    r2_list, fr_list, nr_models = calc_scores(predictors.data, target.data)
+    r2_list, fr_list = np.nan_to_num(r2_list), np.nan_to_num(fr_list)
+
+    valid = (~np.isnan(predictors.data) & ~np.isnan(target.data)).sum(axis=-1) >= 3
+    ts_list = np.zeros(len(diagns))
+    ts_list[valid] = theil_sen_scores(
+        predictors.data[valid], target.data, args.theil_sen, args.max_workers, args.seed)
+    pointless = ['   '] * len(diagns)
+    nr_obs = [0] * len(diagns)
     for idx, diagn in enumerate(diagns):
-        key = f'{diagn}{cfg.performance_aggs[idx]}'
+        valid = ~np.isnan(predictors.data[idx]) & ~np.isnan(target.data)
+        if valid.sum() < 3:
+            logger.warning(f'Not enough models for {keys[idx]}')
+            continue
+        xx, yy = predictors.data[idx, valid], target.data[valid]
         try:
-            logger.info(f'Process {key}')
-            # small hack to get the full set of filenames for target and
-            # one diagnostic (as opposed to the subset which contains all
-            # diagnostics).
-            cfg.performance_diagnostics = [diagn]
-            filenames, unique_models = get_filenames(cfg)
-            cfg.performance_diagnostics = diagns
-
-            target = calc_target(filenames, cfg)
-            predictor = calc_predictor(filenames, idx, cfg)
-            try:
-                obs = calc_obs(diagn, idx, cfg)
-            except Exception:
-                obs = None
-
-            # make sure order is the same
-            target = target.sel(model_ensemble=predictor['model_ensemble'].data)
-            assert tuple(target['model_ensemble'].data) == tuple(predictor['model_ensemble'].data)
-
-            scores, reg = calc_correlation(predictor.data, target.data, obs)
-            plot(predictor.data, target.data, obs, reg, idx, cfg)
-
-            if obs is not None:
-                if min(obs) > max(predictor) or max(obs) < min(predictor):
-                    pointless.append(' x ')
-                elif min(obs) < min(predictor) and max(obs) > max(predictor):
-                    pointless.append(' x ')
-                else:
-                    pointless.append('   ')
-                nr_obs.append(len(obs['obs_id']))
-            else:
-                pointless.append('   ')
-                nr_obs.append(0)
+            obs = calc_obs(diagn, idx, cfg)
+        except Exception:
+            obs = None
 
-            scores_list.append(scores)
-            nr_models.append(len(filenames[cfg.target_diagnostic]))
+        reg = stats.linregress(xx, yy)
+        try:
+            plot(xx, yy, obs, reg, idx, cfg)
         except Exception:
-            cfg.performance_diagnostics = diagns
-            scores_list.append(None)
-            nr_models.append(0)
-            pointless.append('   ')
-            nr_obs.append(0)
-            logger.error(f'Unexpected error encountered in {diagn}')
+            logger.error(f'Unexpected error encountered plotting {keys[idx]}')
             logger.error(traceback.format_exc())
 
-    r2_list = [xx['stats.linregress'] if xx is not None else 0 for xx in scores_list]
-    ts_list = [xx['sklearn.TheilSenRegressor'] if xx is not None else 0 for xx in scores_list]
-    fr_list = [xx['sklearn.f_regression'] if xx is not None else 0 for xx in scores_list]
-    sort_idx = np.argsort(r2_list)[::-1]
-
-    def get_rank_from_scores(scores_list):
-        r2 = [xx['stats.linregress'] if xx is not None else 0 for xx in scores_list]
-        ts = [xx['sklearn.TheilSenRegressor'] if xx is not None else 0 for xx in scores_list]
-        fr = [xx['sklearn.f_regression'] if xx is not None else 0 for xx in scores_list]
-
-        points1 = np.argsort(np.argsort(r2))
-        points2 = np.argsort(np.argsort(ts))
-        points3 = np.argsort(np.argsort(fr))
-
-        points = [p1 + p2 + p3 for (p1, p2, p3) in zip(points1, points2, points3)]
+        if obs is not None:
+            if min(obs) > max(xx) or max(obs) < min(xx):
+                pointless[idx] = ' x '
+            elif min(obs) < min(xx) and max(obs) > max(xx):
+                pointless[idx] = ' x '
+            nr_obs[idx] = len(obs['obs_id'])
 
+    def get_rank_from_scores(*scores):
+        points = np.sum([np.argsort(np.argsort(score)) for score in scores], axis=0)
         return np.argsort(points)[::-1]
 
-    sort_idx = get_rank_from_scores(scores_list)
+    sort_idx = get_rank_from_scores(r2_list, ts_list, fr_list)
 
     lines = OrderedDict()
     rank = 1
     for idx in sort_idx:
         if r2_list[idx] > .01:
-            key = f'{cfg.performance_diagnostics[idx]}{cfg.performance_aggs[idx]}'
-            lines[key] = ' | '.join([
+            lines[idx] = ' | '.join([
                 f'{rank:<4}',
-                f'{key:<12}',
+                f'{keys[idx]:<12}',
                 f'{nr_models[idx]:<7}',
                 f'{r2_list[idx]:.3f} ',
                 f'{ts_list[idx]:+.3f}  ',
@@ -412,41 +694,14 @@ def main():
             ])
             rank += 1
 
-    for idx1, diagn1 in enumerate(diagns):
-        key1 = f'{diagn1}{cfg.performance_aggs[idx1]}'
-
-        if key1 not in lines.keys():
+    # correlation between all predictors (each pair on their common models)
+    corr, _ = masked_corrcoef(predictors.data)
+    for idx1 in range(len(keys)):
+        if idx1 not in lines.keys():
             continue
-
-        for idx2, diagn2 in enumerate(diagns):
-            key2 = f'{diagn2}{cfg.performance_aggs[idx2]}'
-
-            if key1 == key2:
-                continue
-
-            try:
-                logger.info(f'Process {key1} and {key2}')
-
-                # now I want target and two diagnostics
-                cfg.performance_diagnostics = [diagn1, diagn2]
-                filenames, unique_models = get_filenames(cfg)
-                cfg.performance_diagnostics = diagns
-
-                predictor1 = calc_predictor(filenames, idx1, cfg)
-                predictor2 = calc_predictor(filenames, idx2, cfg)
-
-                predictor2 = predictor2.sel(model_ensemble=predictor1['model_ensemble'].data)
-                assert tuple(predictor1['model_ensemble'].data) == tuple(predictor2['model_ensemble'].data)
-
-                _, reg = calc_correlation(predictor1.data, predictor2.data, None)
-
-                if reg.rvalue**2 > .85:
-                    lines[key1] += f'{key2}, '
-
-            except Exception:
-                pass
-                # cfg.performance_diagnostics = diagns
-                # logger.error(traceback.format_exc())
+        for idx2, key2 in enumerate(keys):
+            if idx1 != idx2 and corr[idx1, idx2]**2 > .85:
+                lines[idx1] += f'{key2}, '
 
     print('rank | varAGG       | #models | linear | TheilSen | F-Reg. | obs | bad | correlated to ')
     print('\n'.join([line for line in lines.values()]))
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2020 Lukas Brunner, ETH Zurich
+
+This file is part of ClimWIP.
+
+ClimWIP is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Authors
+-------
+- Lukas Brunner || lukas.brunner@env.ethz.ch
+
+Abstract
+--------
+Sweep the time period of the CLIM and TREND performance and independence
+diagnostics of a configuration. Each field is read once for the years
+covering all windows and the diagnostics of all windows are calculated from
+cumulative sums of the seasonal (annual) means (see
+diagnostics.aggregate_windows). The performance (model-observation) and
+independence (model-model) distances of each window are written to
+<save_path>/<config>_period_sweep.nc. They are the same as the distances
+calculated by model_weighting_main.py (before normalization) with the
+respective *_startyears and *_endyears.
+
+Example: python sweep_periods.py DEFAULT -f configs/config.ini --lengths 20 30 --years 1950 2014
+"""
+import os
+import argparse
+import logging
+import xarray as xr
+
+from core import utils
+from core.get_filenames import get_filenames
+from core.read_config import read_config
+from core.diagnostics import aggregate_windows
+from core.diagnostic_graph import (
+    DiagnosticGraph,
+    expand_diagnostic,
+    get_diagnostic_settings,
+)
+from core.utils_xarray import (
+    spatial_dims,
+    obs_envelope,
+    weighted_obs_distance,
+    weighted_distance_matrices,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def read_args():
+    """Read the given configuration from the config file"""
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        dest='config', nargs='?', default='DEFAULT',
+        help='Name of the configuration to use (optional).')
+    parser.add_argument(
+        '--filename', '-f', dest='filename', default='configs/config.ini',
+        help='Relative or absolute path/filename.ini of the config file.')
+    parser.add_argument(
+        '--lengths', '-l', dest='lengths', default=None, type=int, nargs='+',
+        help='Lengths of the windows in years (default: the lengths of the time periods in the config).')
+    parser.add_argument(
+        '--years', '-y', dest='years', default=None, type=int, nargs=2,
+        help='First and last year covered by the windows (default: all time periods in the config).')
+    parser.add_argument(
+        '--step', '-s', dest='step', default=1, type=int,
+        help='Shift between two consecutive windows in years.')
+    return parser.parse_args()
+
+
+def get_windows(lengths, first_year, last_year, step=1):
+    """All windows of the given lengths between first_year and last_year.
+
+    Returns
+    -------
+    windows : list of tuple of int
+        First and last year of each window.
+    """
+    return [(start, start + length - 1) for length in lengths
+            for start in range(first_year, last_year - length + 2, step)]
+
+
+def get_settings(cfg):
+    """Settings of all CLIM and TREND diagnostics (see get_diagnostic_settings)."""
+    settings = get_diagnostic_settings(cfg, kinds=('performance', 'independence'))
+    for name in [*settings.keys()]:
+        if settings[name]['time_aggregation'] not in ['CLIM', 'TREND']:
+            logger.warning(f'Can only sweep CLIM and TREND diagnostics, skipping {name}')
+            settings.pop(name)
+    return settings
+
+
+def calc_windows(infiles, settings, windows, cfg, id_=None):
+    """
+    Calculate the diagnostics of one model (or observational dataset) for all windows.
+
+    Parameters
+    ----------
+    infiles : dict
+        Input filename for each basic variable, e.g., {'tas': filename, ...}
+    settings : OrderedDict
+        See get_settings.
+    windows : list of tuple of int
+        See get_windows.
+    cfg : configuration object
+    id_ : {'CMIP6', 'CMIP5', 'CMIP3', 'LE'}, optional
+
+    Returns
+    -------
+    diagnostics : dict
+        Same keys as settings, values are xarray.DataArrays with the
+        additional dimension window (see diagnostics.aggregate_windows).
+    """
+    time_period = (min(start for start, _ in windows), max(end for _, end in windows))
+    graph = DiagnosticGraph(id_, overwrite=True, dtype=cfg.precision, cells=cfg.region_cells)
+    for name, setting in settings.items():
+        # read each field once for all windows and aggregate later
+        graph.add_diagnostic(
+            name, infiles=infiles, idx_lats=cfg.idx_lats, idx_lons=cfg.idx_lons,
+            **dict(setting, time_period=time_period, time_aggregation=None))
+
+    diagnostics = {}
+    for name, ds in graph.execute().items():
+        diagn_key = expand_diagnostic(settings[name]['diagn'])[0]
+        diagnostics[name] = aggregate_windows(
+            ds[diagn_key], settings[name]['season'],
+            settings[name]['time_aggregation'], windows)
+    return diagnostics
+
+
+def calc_performance(diagnostics, settings, windows, cfg):
+    """
+    Calculate the distance of each model to the observations for all windows.
+
+    Returns
+    -------
+    differences : xarray.DataArray, shape (L, N, W)
+        Dimensions (diagnostic, model_ensemble, window).
+    """
+    obs_diagnostics = {}
+    for obs_path, obs_id in zip(cfg.obs_path, cfg.obs_id):
+        with utils.LogTime(f'Calculate diagnostics for {obs_id}', level='debug'):
+            infiles = {}
+            for setting in settings.values():
+                for varn in expand_diagnostic(setting['diagn'])[1]:
+                    infiles[varn] = os.path.join(obs_path, f'{varn}_mon_{obs_id}_g025.nc')
+            for name, obs in calc_windows(infiles, settings, windows, cfg).items():
+                obs_diagnostics.setdefault(name, []).append(obs)
+
+    diffs = []
+    for name in settings:
+        _, idx = name
+        obs = xr.concat(obs_diagnostics[name], dim='dataset_dim')
+        # distances within [obs_min, obs_max] are zero
+        obs_min, obs_max = obs_envelope(obs, cfg.obs_uncertainty)
+        spatial = spatial_dims(obs_min)
+        diff = xr.apply_ufunc(
+            weighted_obs_distance,
+            diagnostics[name].transpose('model_ensemble', ...),
+            obs_min, obs_max,
+            kwargs={'lat': obs_min['lat'].data, 'cells': spatial == ['cells']},
+            input_core_dims=[spatial, spatial, spatial])
+        diffs.append(diff.expand_dims({'diagnostic': [idx]}))
+    return xr.concat(diffs, dim='diagnostic')
+
+
+def calc_independence(diagnostics, settings):
+    """
+    Calculate the distance between each pair of models for all windows.
+
+    Returns
+    -------
+    differences : xarray.DataArray, shape (L, W, N, N)
+        Dimensions (diagnostic, window, perfect_model_ensemble, model_ensemble).
+    """
+    diffs = []
+    for name in settings:
+        _, idx = name
+        data = diagnostics[name]
+        spatial = spatial_dims(data)
+        data = data.transpose('window', 'model_ensemble', *spatial)
+        d_matrices = weighted_distance_matrices(
+            data.data, data['lat'].data, compensated=True, cells=spatial == ['cells'])
+        diffs.append(xr.DataArray(
+            d_matrices, dims=('window', 'perfect_model_ensemble', 'model_ensemble'),
+            coords={'window_start': data['window_start'], 'window_end': data['window_end'],
+                    'perfect_model_ensemble': data['model_ensemble'].data,
+                    'model_ensemble': data['model_ensemble'].data},
+        ).expand_dims({'diagnostic': [idx]}))
+    return xr.concat(diffs, dim='diagnostic')
+
+
+def main(args):
+    cfg = read_config(args.config, args.filename)
+    settings = get_settings(cfg)
+    if len(settings) == 0:
+        raise ValueError('No CLIM or TREND diagnostics found')
+
+    time_periods = [setting['time_period'] for setting in settings.values()]
+    if args.years is None:
+        years = (min(start for start, _ in time_periods), max(end for _, end in time_periods))
+    else:
+        years = args.years
+    if args.lengths is None:
+        lengths = sorted({end - start + 1 for start, end in time_periods})
+    else:
+        lengths = args.lengths
+    windows = get_windows(lengths, *years, args.step)
+    logger.info(f'Sweep {len(settings)} diagnostics over {len(windows)} windows in {years[0]}-{years[1]}')
+
+    filenames = get_filenames(cfg)
+    model_ensembles = [*filenames[[*filenames.keys()][0]].keys()]
+
+    diagnostics = {}
+    for model_ensemble in model_ensembles:
+        with utils.LogTime(model_ensemble, level='debug'):
+            infiles = {varn: filenames[varn][model_ensemble] for varn in filenames}
+            for name, diagnostic in calc_windows(
+                    infiles, settings, windows, cfg, model_ensemble.split('_')[2]).items():
+                diagnostics.setdefault(name, []).append(
+                    diagnostic.expand_dims({'model_ensemble': [model_ensemble]}))
+    diagnostics = {name: xr.concat(diagnostic, dim='model_ensemble')
+                   for name, diagnostic in diagnostics.items()}
+
+    ds = xr.Dataset()
+    settings_performance = {name: setting for name, setting in settings.items()
+                            if name[0] == 'performance'}
+    if len(settings_performance) > 0 and cfg.obs_id is not None:
+        with utils.LogTime('Calculate performance distances'):
+            ds['performance'] = calc_performance(
+                diagnostics, settings_performance, windows, cfg).rename(
+                    {'diagnostic': 'performance_diagnostic'})
+
+    settings_independence = {name: setting for name, setting in settings.items()
+                             if name[0] == 'independence'}
+    if len(settings_independence) > 0:
+        with utils.LogTime('Calculate independence distances'):
+            ds['independence'] = calc_independence(
+                diagnostics, settings_independence).rename(
+                    {'diagnostic': 'independence_diagnostic'})
+
+    filename = os.path.join(cfg.save_path, f'{cfg.config}_period_sweep.nc')
+    ds.to_netcdf(filename)
+    logger.info(f'Saved distances of {len(windows)} windows to {filename}')
+
+
+if __name__ == '__main__':
+    args = read_args()
+    utils.set_logger()
+    with utils.LogTime(os.path.basename(__file__).replace('py', 'main()')):
+        main(args)
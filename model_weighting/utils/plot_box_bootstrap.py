@@ -8,10 +8,13 @@ Authors:
 - Lukas Brunner || lukas.brunner@env.ethz.ch
 
 Abstract: Plots multiple boxes based on a given filename pattern. Indented
-for plotting the output of bootstrapping model variants.
+for plotting the output of bootstrapping model variants. The pattern can
+either match one file per realization or a single file created with
+variants_bootstrap (containing a realization dimension).
 
 """
 import os
+import glob
 import argparse
 import numpy as np
 import xarray as xr
@@ -68,17 +71,47 @@ def preprocess(ds):
     return ds
 
 
+def read_bootstrap(filename):
+    """Read a file created with variants_bootstrap into the same format as
+    the output of preprocess (concatenated along realization)."""
+    ds = xr.open_dataset(filename, use_cftime=True)
+    varn = ds.attrs['target']
+    data = area_weighted_mean(ds[varn])
+
+    ds_list = []
+    for idx in ds['realization'].data:
+        mask = ds['variant_mask'].sel(realization=idx).data == 1
+        ds_sel = xr.Dataset({
+            varn: data.isel(variant=mask),
+            'weights': ds['weights_variants'].sel(realization=idx).isel(variant=mask),
+        })
+        models, counts = [], {}
+        for variant in ds_sel['variant'].data:
+            model = variant.split('_')[0]
+            models.append(f'{model}_{counts.get(model, 0)}')
+            counts[model] = counts.get(model, 0) + 1
+        ds_sel['model'] = xr.DataArray(models, dims='variant')
+        ds_list.append(ds_sel.swap_dims({'variant': 'model'}).drop_vars('variant'))
+    ds_out = xr.concat(ds_list, dim='realization')
+    ds_out.attrs = ds.attrs
+    return ds_out
+
+
 def main():
     args = read_input()
 
     fig, ax = plt.subplots(figsize=(15, 5))
     fig.subplots_adjust(left=.1, right=.88, bottom=.22, top=.91)
 
-    ds = xr.open_mfdataset(os.path.join(args.path, args.filename_pattern),
-                           use_cftime=True,
-                           concat_dim='realization',
-                           combine='nested',
-                           preprocess=preprocess).load()
+    filenames = glob.glob(os.path.join(args.path, args.filename_pattern))
+    if len(filenames) == 1 and 'realization' in xr.open_dataset(filenames[0]).dims:
+        ds = read_bootstrap(filenames[0])
+    else:
+        ds = xr.open_mfdataset(os.path.join(args.path, args.filename_pattern),
+                               use_cftime=True,
+                               concat_dim='realization',
+                               combine='nested',
+                               preprocess=preprocess).load()
     varn = ds.attrs['target']
 
     percentiles = []
@@ -13,15 +13,14 @@ Abstract:
 import os
 import argparse
 import regionmask
-import numpy as np
 import xarray as xr
 import matplotlib.pyplot as plt
-from properscoring import crps_ensemble
 import seaborn as sns
 from glob import glob
 
 from utils_python.xarray import area_weighted_mean, flip_antimeridian
 from model_weighting.core.utils import read_config, log_parser
+from model_weighting.core.crps import crps_skill
 
 from boxplot import boxplot
 
@@ -68,34 +67,14 @@ def read_input():
 
 
 def get_skill(da, da_obs, weights, mean_of_crps):
-    if mean_of_crps:
-        crps_baseline = xr.apply_ufunc(
-            crps_ensemble, da_obs, da,
-            input_core_dims=[['lat', 'lon'], ['lat', 'lon', 'model_ensemble']],
-            output_core_dims=[['lat', 'lon']],
-        )
-
-        crps_weighted = xr.apply_ufunc(
-            crps_ensemble, da_obs, da,
-            input_core_dims=[['lat', 'lon'], ['lat', 'lon', 'model_ensemble']],
-            output_core_dims=[['lat', 'lon']],
-            kwargs={'weights': np.tile(weights, (da['lat'].size, da['lon'].size, 1))},
-        )
-    else:
-        crps_baseline = xr.apply_ufunc(
-            crps_ensemble,
-            area_weighted_mean(da_obs),
-            area_weighted_mean(da),
-            input_core_dims=[[], ['model_ensemble']],
-        )
-
-        crps_weighted = xr.apply_ufunc(
-            crps_ensemble,
-            area_weighted_mean(da_obs),
-            area_weighted_mean(da),
-            input_core_dims=[[], ['model_ensemble']],
-            kwargs={'weights': weights},
-        )
+    if not mean_of_crps:
+        da_obs, da = area_weighted_mean(da_obs), area_weighted_mean(da)
+
+    crps_baseline, crps_weighted = xr.apply_ufunc(
+        crps_skill, da_obs, da, weights,
+        input_core_dims=[[], ['model_ensemble'], ['model_ensemble']],
+        output_core_dims=[[], []],
+    )
 
     return (crps_baseline - crps_weighted) / crps_baseline * 100
 
@@ -29,6 +29,7 @@ import os
 import warnings
 import argparse
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 import xarray as xr
 import matplotlib as mpl
 mpl.use('Agg')
@@ -93,25 +94,68 @@ def preprocess(ds, varn, relative=False):
     ds['difference'] = av_diff
 
 
-def bootstrap(ds, varn, percentile=(.05, .95), relative=False):
-    diffs = []
+def _bootstrap_tile(data, weights, mean, percentile, relative):
+    """Percentiles of the resampled weighted mean minus the mean for one tile.
+
+    Parameters
+    ----------
+    data : ndarray, shape (N, M)
+        N models and M grid cells.
+    weights : ndarray, shape (K, N)
+        K resampled weights.
+    mean : ndarray, shape (M,)
+    """
+    avw = (weights @ data) / weights.sum(axis=-1, keepdims=True)
+    av_diff = avw - mean
+    if relative:
+        av_diff /= 0.01 * mean
+    with warnings.catch_warnings():
+        # suppress warnings on masked ocean grid cells
+        warnings.filterwarnings('ignore')
+        return np.nanquantile(av_diff, percentile, axis=0)
+
+
+def bootstrap(ds, varn, percentile=(.05, .95), relative=False, nr_samples=1000,
+              chunk_size=None, max_workers=None):
+    """Significance of the difference between weighted and unweighted mean.
+
+    The weights are shuffled nr_samples times (same sequence of shuffles as
+    drawing them one after another) and all resampled weighted means are
+    calculated with a single matrix product per tile of grid cells.
+
+    Parameters
+    ----------
+    chunk_size : int, optional
+        Maximum number of grid cells processed at once (limits the memory to
+        about nr_samples * chunk_size values). Default: all.
+    max_workers : int, optional
+        If larger than 1 process the tiles in a process pool.
+    """
     weights = ds['weights'].copy().data
-    for idx in range(1000):
+    weights_resampled = np.empty((nr_samples, weights.size))
+    for idx in range(nr_samples):
         np.random.RandomState(idx).shuffle(weights)
-        with warnings.catch_warnings():
-            warnings.filterwarnings('ignore')
-            avw = xr.apply_ufunc(
-                np.average, ds[varn],
-                input_core_dims=[['model_ensemble']],
-                kwargs={'weights': weights},
-                vectorize=True)
-        av_diff = avw - ds['mean']
-        if relative:
-            av_diff /= 0.01 * ds['mean']
-        diffs.append(av_diff)
-
-    ds_diff = xr.concat(diffs, dim='realizations')
-    lower, upper = ds_diff.quantile(percentile, 'realizations')
+        weights_resampled[idx] = weights
+
+    dims = ds['mean'].dims
+    data = ds[varn].transpose('model_ensemble', *dims).data
+    data = data.reshape(data.shape[0], -1)
+    mean = ds['mean'].data.reshape(-1)
+
+    if chunk_size is None:
+        chunk_size = mean.size
+    tiles = [slice(idx, idx + chunk_size) for idx in range(0, mean.size, chunk_size)]
+    args = [(data[:, tile], weights_resampled, mean[tile], percentile, relative)
+            for tile in tiles]
+    if max_workers is not None and max_workers > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            results = [*pool.map(_bootstrap_tile, *zip(*args))]
+    else:
+        results = [_bootstrap_tile(*arg) for arg in args]
+
+    lower, upper = np.concatenate(results, axis=-1).reshape((2,) + ds['mean'].shape)
+    lower = xr.DataArray(lower, dims=dims)
+    upper = xr.DataArray(upper, dims=dims)
     ds['significant'] = (ds['difference'] < lower) | (ds['difference'] > upper)
 
 
@@ -228,6 +272,12 @@ def main():
     parser.add_argument(
         '--no-hatching', '-nh', dest='hatch', action='store_false',
         help='')
+    parser.add_argument(
+        '--chunk-size', dest='chunk_size', default=None, type=int,
+        help='Maximum number of grid cells bootstrapped at once (limits memory).')
+    parser.add_argument(
+        '--workers', '-w', dest='max_workers', default=None, type=int,
+        help='Number of processes used to bootstrap the grid cells.')
     args = parser.parse_args()
 
     ds = xr.open_dataset(os.path.join(DATAPATH, args.filename))
@@ -238,7 +288,8 @@ def main():
 
     preprocess(ds, varn, relative=relative)
     if args.hatch:
-        bootstrap(ds, varn, relative=relative)
+        bootstrap(ds, varn, relative=relative,
+                  chunk_size=args.chunk_size, max_workers=args.max_workers)
     plot_kwargs, title = get_plot_config(varn, region)
     plot_map(ds, title, plot_kwargs, region == 'GLOBAL')
 
@@ -35,64 +35,15 @@ mpl.use('Agg')
 import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
 from cartopy.mpl.ticker import LongitudeFormatter, LatitudeFormatter
-from properscoring import crps_ensemble
 
 from model_weighting.core.utils_xarray import area_weighted_mean
+from model_weighting.core.crps import crps_perfect_model
 
 DATAPATH = '../../data/ModelWeighting/'
 PLOTPATH = '../../plots/maps_crps/'
 os.makedirs(PLOTPATH, exist_ok=True)
 
 
-def crps_data(data, weights, model_ensemble=None, exclude_ensembles='all'):
-    """Calculate the CRPS.
-
-    Parameters
-    ----------
-    data : np.array, shape (N,)
-    weights : np.array, shape (N,)
-        Exactly one element of data has to be NaN. This will be used to
-        identify the index of the perfect model.
-    model_ensemble : np.array, shape (N,), optional
-        List of model identifiers. Only needs to be given if exclude_ensembles
-        is not 'none'.
-    exclude_ensembles : {'all', 'same', 'none'}, optional
-        - all: only use one ensemble member per model
-        - same: use all ensemble members but exclude ensemble members from
-          the same model as the perfect model
-        - none: use all models and members except the perfect one
-
-    Returns
-    -------
-    skill : float
-    """
-    assert np.isnan(weights).sum() == 1, 'exactly one weight has to be np.nan!'
-    assert exclude_ensembles in ['all', 'same', 'none']
-    if exclude_ensembles != 'none' and model_ensemble is None:
-        raise ValueError('If exclude_ensembles is not none model_ensemble has to be given!')
-
-    idx_perfect = np.where(np.isnan(weights))[0][0]
-    if exclude_ensembles != 'none':
-        models = [mm.split('_')[0] for mm in model_ensemble.data]
-        if exclude_ensembles == 'all':
-            _, idx_sel = np.unique(models, return_index=True)
-            idx_sel = idx_sel[idx_sel != idx_perfect]
-        elif exclude_ensembles == 'same':
-            idx_sel = np.where(np.array(models) != models[idx_perfect])
-        else:
-            raise ValueError
-    else:
-        idx_sel = np.delete(np.arange(len(data)), idx_perfect)
-
-    data_ref = data[idx_perfect]
-    data_test = data[idx_sel]
-    weights_test = weights[idx_sel]
-
-    baseline = crps_ensemble(data_ref, data_test)
-    weighted = crps_ensemble(data_ref, data_test, weights=weights_test)
-    return (baseline - weighted) / baseline * 100.
-
-
 def crps_xarray(ds, varn, exclude_ensembles='all'):
     """
     Handle ensemble members and call CRPS calculation.
@@ -101,18 +52,25 @@ def crps_xarray(ds, varn, exclude_ensembles='all'):
     ----------
     ds : xarray.Dataset
     varn : string
+    exclude_ensembles : {'all', 'same', 'none'}, optional
+        - all: only use one ensemble member per model
+        - same: use all ensemble members but exclude ensemble members from
+          the same model as the perfect model
+        - none: use all models and members except the perfect one
 
     Returns
     -------
     skill : xarray.DataArray
     """
-    skill = xr.apply_ufunc(
-        crps_data, ds[varn], ds['weights'],
-        input_core_dims=[['model_ensemble'], ['model_ensemble']],
-        kwargs={'model_ensemble': ds['model_ensemble'],
-                'exclude_ensembles': exclude_ensembles},
-        vectorize=True,
-    )
+    data = ds[varn].transpose(..., 'model_ensemble')
+    weights = ds['weights'].transpose('perfect_model_ensemble', 'model_ensemble')
+    baseline, weighted = crps_perfect_model(
+        data.data, weights.data, ds['model_ensemble'].data, exclude_ensembles)
+    skill = xr.DataArray(
+        (baseline - weighted) / baseline * 100.,
+        dims=('perfect_model_ensemble',) + data.dims[:-1],
+        coords={dim: data[dim] for dim in data.dims[:-1] if dim in data.coords})
+    skill['perfect_model_ensemble'] = weights['perfect_model_ensemble']
     return skill
 
 
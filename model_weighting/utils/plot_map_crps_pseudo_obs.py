@@ -23,10 +23,10 @@ import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
 from glob import glob
 from cartopy.mpl.ticker import LongitudeFormatter, LatitudeFormatter
-from properscoring import crps_ensemble
 
 from model_weighting.core.utils import read_config, log_parser
-from model_weighting.core.utils_xarray import quantile, flip_antimeridian, area_weighted_mean
+from model_weighting.core.utils_xarray import flip_antimeridian, area_weighted_mean
+from model_weighting.core.crps import crps_skill
 
 warnings.filterwarnings('ignore')
 
@@ -112,12 +112,6 @@ def weighted_mean(data, weights):
     return np.average(data, weights=weights)
 
 
-def weighted_quantile(data, weights, q):
-    if np.any(np.isnan(data)):
-        return np.nan
-    return quantile(data, q, weights=weights)
-
-
 def plot_maps(da, da_obs, weights, cfg, fn):
     proj = ccrs.PlateCarree(central_longitude=0)
     fig, axes = plt.subplots(ncols=3, nrows=5, subplot_kw={'projection': proj}, figsize=(10, 16))
@@ -138,27 +132,13 @@ def plot_maps(da, da_obs, weights, cfg, fn):
         input_core_dims=[['model_ensemble'], ['model_ensemble']],
         vectorize=True)
 
-    wdiff_p10 = xr.apply_ufunc(
-        weighted_quantile, diff, weights, .1,
-        input_core_dims=[['model_ensemble'], ['model_ensemble'], []],
-        vectorize=True)
-
-    wdiff_p90 = xr.apply_ufunc(
-        weighted_quantile, diff, weights, .9,
-        input_core_dims=[['model_ensemble'], ['model_ensemble'], []],
-        vectorize=True)
-
-    crps_baseline = xr.apply_ufunc(
-        crps_ensemble, da_obs, da,
-        input_core_dims=[['lat', 'lon'], ['lat', 'lon', 'model_ensemble']],
-        output_core_dims=[['lat', 'lon']],
-    )
+    wdiff_p10 = diff.weighted_quantile(.1, weights)
+    wdiff_p90 = diff.weighted_quantile(.9, weights)
 
-    crps_weighted = xr.apply_ufunc(
-        crps_ensemble, da_obs, da,
-        input_core_dims=[['lat', 'lon'], ['lat', 'lon', 'model_ensemble']],
-        output_core_dims=[['lat', 'lon']],
-        kwargs={'weights': np.tile(weights, (da['lat'].size, da['lon'].size, 1))},
+    crps_baseline, crps_weighted = xr.apply_ufunc(
+        crps_skill, da_obs, da, weights,
+        input_core_dims=[[], ['model_ensemble'], ['model_ensemble']],
+        output_core_dims=[[], []],
     )
 
     # CRPS is the relative change in the CRPS
@@ -21,12 +21,11 @@ import regionmask
 import matplotlib.pyplot as plt
 
 from model_weighting.core.utils import read_config, log_parser
-from model_weighting.core.utils_xarray import area_weighted_mean, quantile, flip_antimeridian
+from model_weighting.core.utils_xarray import area_weighted_mean, weighted_quantile, flip_antimeridian
 from boxplot import boxplot
 
 warnings.filterwarnings('ignore')
 
-quantile = np.vectorize(quantile, signature='(n)->()', excluded=[1, 'weights'])
 period_ref = slice('1995', '2014')
 
 PLOTPATH = os.path.join(
@@ -200,8 +199,8 @@ def plot(ds_models, ds_obs, weights, args, ds):
 
     # --- baseline ---
     h1 = plot_shading(
-        quantile(ds_models.data.swapaxes(0, 1), .25),
-        quantile(ds_models.data.swapaxes(0, 1), .75))
+        weighted_quantile(ds_models.data.swapaxes(0, 1), None, .25),
+        weighted_quantile(ds_models.data.swapaxes(0, 1), None, .75))
     h2 = plot_line(np.mean(ds_models.data, axis=0))
     handles.append((h1, h2))
     labels.append('Mean & interquartile')
@@ -221,8 +220,8 @@ def plot(ds_models, ds_obs, weights, args, ds):
     # --- weighted ----
     assert np.all(weights['model_ensemble'] == ds_models['model_ensemble'])
     h1 = plot_shading(
-        quantile(ds_models.data.swapaxes(0, 1), .25, weights=weights.data),
-        quantile(ds_models.data.swapaxes(0, 1), .75, weights=weights.data),
+        weighted_quantile(ds_models.data.swapaxes(0, 1), weights.data, .25),
+        weighted_quantile(ds_models.data.swapaxes(0, 1), weights.data, .75),
         color='darkred')
     h2 = plot_line(
         np.average(ds_models.data, weights=weights.data, axis=0),